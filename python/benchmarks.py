@@ -0,0 +1,199 @@
+# BENCHMARKS: Time/memory comparisons for pipeline components
+import pandas as pd
+import pyarrow as pa
+import argparse
+import logging
+import glob
+import json
+import os
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+from extraction import (DataExtractor, CLAIMS_FOLDER, CLAIMS_DATE_COLUMNS, standardize_columns,
+                        add_unified_patient_id, concat_frames)
+from transform import DataTransformer, run_all_transformations
+from dimensional_modeling import DimensionalModeler, run_modeling
+from scd_implementation import SCDType2Engine, SCD_DIMENSIONS
+from execution_backend import open_backend, BACKENDS
+from staging import write_table
+from rollups import RollupMaintainer
+from synthetic_data import SyntheticDataGenerator, hospital_name, parse_ddl
+from instrumentation import profiler
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+BENCHMARK_DIR = './Data/benchmarks'
+BENCHMARK_SIZES = [10_000, 100_000, 1_000_000]  # Transactions per hospital.
+REGRESSION_THRESHOLD = 1.2  # A phase more than 20% slower than the baseline is reported as a regression.
+
+def _time_reader(read, file_paths, repeats):
+    """Returns the best-of-`repeats` wall time and the in-memory size of the frames produced."""
+    best, frames = float('inf'), []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        frames = [read(f) for f in file_paths]
+        best = min(best, time.perf_counter() - start)
+    return best, sum(int(df.memory_usage(deep=True).sum()) for df in frames), sum(len(df) for df in frames)
+
+def compare_claims_readers(file_paths=None, repeats=3) -> pd.DataFrame:
+    """Compares the untyped pandas claims reader with the typed Arrow reader.
+    The pandas path includes the date parsing that clean_and_enrich_claims would otherwise do later,
+    so both rows describe the cost of getting the same typed frame."""
+    file_paths = file_paths or glob.glob(os.path.join(CLAIMS_FOLDER, '*.csv'))
+    extractor = DataExtractor({})
+    logging.disable(logging.INFO)
+    def pandas_path(file_path):
+        df = pd.read_csv(file_path)
+        for col in CLAIMS_DATE_COLUMNS:
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        return df
+    try:
+        results = []
+        for name, reader in [('pandas.read_csv + to_datetime', pandas_path), ('arrow typed reader', extractor.extract_claims_csv)]:
+            seconds, nbytes, rows = _time_reader(reader, file_paths, repeats)
+            results.append({'reader': name, 'files': len(file_paths), 'rows': rows, 'seconds': round(seconds, 4), 'memory_mb': round(nbytes / 2**20, 2)})
+    finally:
+        logging.disable(logging.NOTSET)
+    return pd.DataFrame(results)
+
+# Phase benchmarks over synthetic data ---
+def extract_generated(data_dir, n_hospitals, db_configs=None):
+    """Extracts and integrates generated hospitals like run_extraction does: from the CSV files under
+    `data_dir`, or from the databases in `db_configs` (see SyntheticDataGenerator.load_sqlite)."""
+    extractor = DataExtractor(db_configs or {})
+    tables, claims_dfs = {}, []
+    for number in range(1, n_hospitals + 1):
+        db_name, db_dir = hospital_name(number), os.path.join(data_dir, 'hospital_dbs', f"hospital{number}_db")
+        for table_name in parse_ddl(os.path.join(db_dir, 'ddl.sql')):
+            if db_configs:
+                df = extractor.extract_from_mysql(db_name, table_name)
+            else:
+                df = extractor.extract_from_csv(os.path.join(db_dir, f"{table_name}.csv"))
+            df['source_hospital'] = db_name
+            tables.setdefault(table_name, []).append(standardize_columns(db_name, table_name, df))
+        claims_df = extractor.extract_claims_csv(os.path.join(data_dir, 'claims', f"hospital{number}_claim_data.csv"))
+        claims_df['source_hospital'] = db_name
+        claims_dfs.append(claims_df)
+    db_data = {name: pd.concat(frames, ignore_index=True) for name, frames in tables.items()}
+    add_unified_patient_id(db_data['patients'])
+    return db_data, concat_frames(claims_dfs)
+
+def _changed_dimensions(generator, registry_dir, generation=1):
+    """dim_patients and dim_providers built from generation `generation` of the generated sources."""
+    frames = {}
+    for table_name in ['patients', 'providers', 'departments']:
+        parts = []
+        for number in range(1, generator.n_hospitals + 1):
+            df = pa.concat_tables(generator.generate(number, table_name, generation)).to_pandas(date_as_object=False)
+            df['source_hospital'] = hospital_name(number)
+            parts.append(standardize_columns(hospital_name(number), table_name, df))
+        frames[table_name] = pd.concat(parts, ignore_index=True)
+    add_unified_patient_id(frames['patients'])
+    transformer, modeler = DataTransformer(registry_dir), DimensionalModeler(registry_dir)
+    frames['patients'] = transformer.clean_and_enrich_patients(frames['patients'])
+    frames = transformer.generate_surrogate_keys(frames)
+    return {'dim_patients': modeler.build_dim_patients(frames['patients']),
+            'dim_providers': modeler.build_dim_providers(frames['providers'], frames['departments'])}
+
+def benchmark_phases(rows_per_hospital, n_hospitals=2, key_skew=0.0, scd_change_rate=0.05, use_sqlite=False, trace_memory=True, backend='pandas') -> list:
+    """
+    Generates `rows_per_hospital` transactions for each of `n_hospitals` hospitals in a scratch directory
+    and runs every phase on them in order: extract (from CSV, and from SQLite with `use_sqlite`), transform,
+    modeling, the initial SCD load, an SCD run over one generation of changes, the staging write and the rollups.
+    Returns one result per phase with its wall and CPU seconds, rows out, and (with `trace_memory`) the
+    peak of memory allocated through Python and NumPy during the phase; Arrow buffers are not traced.
+    Modeling and SCD run on the execution `backend`; DuckDB's own memory is not traced either.
+    """
+    results = []
+    def phase(name, func, *args):
+        if trace_memory: tracemalloc.start()
+        try:
+            with profiler.stage(f"benchmark.{name}", 'benchmark') as record:
+                result = func(*args)
+                record.output(result)
+            peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory: tracemalloc.stop()
+        results.append({'rows_per_hospital': rows_per_hospital, 'hospitals': n_hospitals, 'phase': name,
+                        'seconds': round(record.wall_s, 4), 'cpu_seconds': round(record.cpu_s, 4), 'rows_out': record.rows_out,
+                        'py_peak_mb': round(peak / 2**20, 2) if peak is not None else None})
+        logging.info(f"  > [{rows_per_hospital} rows x {n_hospitals}] {name}: {record.wall_s:.2f}s")
+        return result
+
+    generator = SyntheticDataGenerator(rows_per_hospital, n_hospitals, key_skew=key_skew, scd_change_rate=scd_change_rate)
+    with tempfile.TemporaryDirectory() as work_dir:
+        registry_dir, staging_dir = os.path.join(work_dir, 'key_registry'), os.path.join(work_dir, 'staging')
+        data_dir = phase('generate', generator.write, os.path.join(work_dir, 'synthetic'))
+        logging.disable(logging.INFO)
+        try:
+            db_data, claims = phase('extract_csv', extract_generated, data_dir, n_hospitals)
+            if use_sqlite:
+                configs = generator.load_sqlite(data_dir)
+                phase('extract_sqlite', extract_generated, data_dir, n_hospitals, configs)
+            db_data, claims = phase('transform', run_all_transformations, db_data, claims, registry_dir)
+            engine = open_backend(backend)
+            dimensions, facts = phase('modeling', run_modeling, db_data, claims, registry_dir, os.path.join(work_dir, 'quarantine'), None, engine)
+            engines = {name: SCDType2Engine.for_dimension(name, staging_dir, registry_dir, engine) for name in SCD_DIMENSIONS}
+            phase('scd_initial', lambda: [engines[name].apply(dimensions[name]) for name in SCD_DIMENSIONS])
+            changed = _changed_dimensions(generator, registry_dir)
+            phase('scd_changes', lambda: [engines[name].apply(changed[name]) for name in SCD_DIMENSIONS])
+            for name in SCD_DIMENSIONS:
+                dimensions[name] = engines[name].load_history()
+            phase('staging_write', lambda: [write_table(df, name, staging_dir) for name, df in {**dimensions, **facts}.items()])
+            phase('rollups', RollupMaintainer(os.path.join(work_dir, 'rollups'), registry_dir=registry_dir).update, facts)
+            engine.close()
+        finally:
+            logging.disable(logging.NOTSET)
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def run_benchmark_suite(sizes=BENCHMARK_SIZES, n_hospitals=2, key_skew=0.0, scd_change_rate=0.05, use_sqlite=False, out_dir=BENCHMARK_DIR, backend='pandas') -> str:
+    """Benchmarks every phase at every size and saves the results, tagged with the current commit, for compare_benchmark_runs()."""
+    results = [row for size in sizes for row in benchmark_phases(size, n_hospitals, key_skew, scd_change_rate, use_sqlite, backend=backend)]
+    commit = _git_commit()
+    os.makedirs(out_dir, exist_ok=True)
+    path = os.path.join(out_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    with open(path, 'w') as f:
+        json.dump({'commit': commit, 'created': time.time(), 'key_skew': key_skew, 'scd_change_rate': scd_change_rate, 'backend': backend, 'results': results}, f, indent=2)
+    logging.info(f"Saved benchmark results to '{path}'.")
+    return path
+
+def compare_benchmark_runs(baseline_path, current_path) -> pd.DataFrame:
+    """Joins two saved runs on (size, phase); `slowdown` is current/baseline seconds, flagged above REGRESSION_THRESHOLD."""
+    runs = []
+    for path in [baseline_path, current_path]:
+        with open(path) as f:
+            runs.append(pd.DataFrame(json.load(f)['results']))
+    keys = ['rows_per_hospital', 'hospitals', 'phase']
+    comparison = runs[0].merge(runs[1], on=keys, suffixes=('_baseline', '_current'))
+    comparison['slowdown'] = (comparison['seconds_current'] / comparison['seconds_baseline']).round(2)
+    comparison['regression'] = comparison['slowdown'] > REGRESSION_THRESHOLD
+    return comparison[keys + ['seconds_baseline', 'seconds_current', 'slowdown', 'py_peak_mb_baseline', 'py_peak_mb_current', 'regression']]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline benchmarks. Without options, compares the claims CSV readers.")
+    parser.add_argument('--phases', action='store_true', help="Benchmark every phase on synthetic data and save the results.")
+    parser.add_argument('--sizes', type=int, nargs='+', default=BENCHMARK_SIZES, help="Transactions per hospital.")
+    parser.add_argument('--hospitals', type=int, default=2)
+    parser.add_argument('--skew', type=float, default=0.0)
+    parser.add_argument('--change-rate', type=float, default=0.05)
+    parser.add_argument('--sqlite', action='store_true', help="Also benchmark extraction from a SQLite stand-in of the databases.")
+    parser.add_argument('--backend', default='pandas', choices=list(BACKENDS), help="Execution backend of modeling and SCD.")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="Compare two saved benchmark runs.")
+    args = parser.parse_args()
+    if args.compare:
+        print(compare_benchmark_runs(*args.compare).to_string(index=False))
+    elif args.phases:
+        path = run_benchmark_suite(args.sizes, args.hospitals, args.skew, args.change_rate, args.sqlite, backend=args.backend)
+        with open(path) as f:
+            print(pd.DataFrame(json.load(f)['results']).to_string(index=False))
+    else:
+        print("\n--- Claims CSV reader comparison ---")
+        print(compare_claims_readers().to_string(index=False))
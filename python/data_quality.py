@@ -0,0 +1,199 @@
+# DATA QUALITY: Declarative rules checked in one vectorized pass per table, with quarantine output
+import pandas as pd
+import numpy as np
+import logging
+import json
+import os
+import time
+
+from procedure_catalog import open_catalog
+from instrumentation import stage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+QUARANTINE_DIR = './Data/quarantine'
+DQ_REPORT_FILE = 'dq_report.json'  # Written into the quarantine directory.
+SAMPLE_THRESHOLD = 5_000_000  # With sampling on, warning rules of larger tables are checked on a sample of this many rows.
+
+# Rules per table, by name. Checks:
+#   not_null     every listed column is set
+#   foreign_key  the column(s) match a row of `references` (table, column(s)); nulls fail unless allow_null
+#   range        min <= column <= max (either bound optional, `exclusive` makes both strict); nulls pass
+#   order        columns[0] <= columns[1], e.g. on YYYYMMDD date keys; nulls pass
+#   cpt_code     the column holds a code of the CPT catalog (procedure_catalog.py); nulls pass
+# Rows failing a 'reject' rule are removed from the table; 'warn' rules only report them. Every failing
+# row is written to the quarantine table of its table, with the names of the rules it failed, except
+# for rules with 'quarantine': False, which are only counted (e.g. checks on the large source tables).
+QUALITY_RULES = {
+    'fact_transactions': {
+        'key_not_null': {'check': 'not_null', 'columns': ['TransactionID', 'source_hospital'], 'severity': 'reject'},
+        'patient_sk_fk': {'check': 'foreign_key', 'columns': ['patient_sk'], 'references': ('dim_patients', ['patient_sk'])},
+        'provider_sk_fk': {'check': 'foreign_key', 'columns': ['provider_sk'], 'references': ('dim_providers', ['provider_sk'])},
+        'procedure_sk_fk': {'check': 'foreign_key', 'columns': ['procedure_sk'], 'references': ('dim_procedures', ['procedure_sk'])},
+        'date_sk_fk': {'check': 'foreign_key', 'columns': ['date_sk'], 'references': ('dim_date', ['date_sk'])},
+        'paid_date_sk_fk': {'check': 'foreign_key', 'columns': ['paid_date_sk'], 'references': ('dim_date', ['date_sk']), 'allow_null': True},
+        'amount_positive': {'check': 'range', 'column': 'Amount', 'min': 0, 'exclusive': True},
+        'paid_amount_not_negative': {'check': 'range', 'column': 'PaidAmount', 'min': 0},
+        'paid_after_service': {'check': 'order', 'columns': ['date_sk', 'paid_date_sk']},
+    },
+    'fact_claims': {
+        'key_not_null': {'check': 'not_null', 'columns': ['ClaimID', 'source_hospital'], 'severity': 'reject'},
+        'transaction_fk': {'check': 'foreign_key', 'columns': ['TransactionID', 'source_hospital'], 'references': ('fact_transactions', ['TransactionID', 'source_hospital'])},
+        'patient_sk_fk': {'check': 'foreign_key', 'columns': ['patient_sk'], 'references': ('dim_patients', ['patient_sk'])},
+        'date_sk_fk': {'check': 'foreign_key', 'columns': ['date_sk'], 'references': ('dim_date', ['date_sk'])},
+        'claim_date_sk_fk': {'check': 'foreign_key', 'columns': ['claim_date_sk'], 'references': ('dim_date', ['date_sk'])},
+        'claim_after_service': {'check': 'order', 'columns': ['date_sk', 'claim_date_sk']},
+        'status_not_null': {'check': 'not_null', 'columns': ['ClaimStatus', 'PayorType']},
+        'claim_amount_positive': {'check': 'range', 'column': 'ClaimAmount', 'min': 0, 'exclusive': True},
+        'paid_amount_not_negative': {'check': 'range', 'column': 'PaidAmount', 'min': 0},
+        'days_to_payment_not_negative': {'check': 'range', 'column': 'days_to_payment', 'min': 0},
+    },
+    'dim_procedures': {
+        'code_in_catalog': {'check': 'cpt_code', 'column': 'ProcedureCode'},
+    },
+    'transactions': {
+        'procedure_code_in_catalog': {'check': 'cpt_code', 'column': 'ProcedureCode', 'quarantine': False},
+    },
+    'encounters': {
+        'procedure_code_in_catalog': {'check': 'cpt_code', 'column': 'ProcedureCode', 'quarantine': False},
+    },
+    'dim_patients': {
+        'key_not_null': {'check': 'not_null', 'columns': ['patient_sk', 'unified_patient_id'], 'severity': 'reject'},
+        'enterprise_id_not_null': {'check': 'not_null', 'columns': ['enterprise_patient_id']},
+        'age_range': {'check': 'range', 'column': 'age', 'min': 0, 'max': 120},
+    },
+    'dim_providers': {
+        'key_not_null': {'check': 'not_null', 'columns': ['provider_sk', 'ProviderID', 'source_hospital'], 'severity': 'reject'},
+        'department_known': {'check': 'not_null', 'columns': ['DepartmentName']},
+    },
+}
+
+def _plain(series: pd.Series) -> pd.Series:
+    return series.astype(series.cat.categories.dtype) if isinstance(series.dtype, pd.CategoricalDtype) else series
+
+def _key_index(df: pd.DataFrame, columns) -> pd.Index:
+    if len(columns) == 1: return pd.Index(_plain(df[columns[0]]))
+    return pd.MultiIndex.from_arrays([_plain(df[col]) for col in columns])
+
+class DataQualityEngine:
+    """
+    Evaluates QUALITY_RULES. All rules of a table are computed as boolean masks over the same column
+    arrays and combined into one failure matrix, so each table is scanned once however many rules it has,
+    and the quarantine rows are taken out in a single selection. Foreign-key targets are indexed once per
+    referenced (table, columns) and shared by every rule using them. With `sample`, 'warn' rules of tables
+    above SAMPLE_THRESHOLD rows are checked on a seeded random sample; 'reject' rules always see every row.
+    """
+    def __init__(self, rules=QUALITY_RULES, quarantine_dir=QUARANTINE_DIR, sample=False, sample_rows=SAMPLE_THRESHOLD, seed=0):
+        self.rules, self.quarantine_dir = rules, quarantine_dir
+        self.sample, self.sample_rows, self.seed = sample, sample_rows, seed
+        self.results, self._references = {}, {}
+
+    def _reference(self, tables: dict, table_name, columns):
+        key = (table_name, tuple(columns))
+        if key not in self._references:
+            self._references[key] = _key_index(tables[table_name], columns).dropna().unique()
+        return self._references[key]
+
+    def _passes(self, rule, df: pd.DataFrame, tables: dict):
+        """The boolean mask of the rows that pass `rule`, or None when the rule cannot be checked."""
+        check = rule['check']
+        if check == 'not_null':
+            return df[rule['columns']].notna().all(axis=1).to_numpy()
+        if check == 'foreign_key':
+            table_name, ref_columns = rule['references']
+            if table_name not in tables: return None
+            values = _key_index(df, rule['columns'])
+            passes = values.isin(self._reference(tables, table_name, ref_columns))
+            if rule.get('allow_null'):
+                passes |= df[rule['columns']].isna().any(axis=1).to_numpy()
+            return np.asarray(passes, dtype=bool)
+        if check == 'range':
+            values = pd.to_numeric(_plain(df[rule['column']]), errors='coerce').astype('float64').to_numpy()
+            passes = np.ones(len(df), dtype=bool)
+            with np.errstate(invalid='ignore'):
+                if rule.get('min') is not None: passes &= (values > rule['min']) if rule.get('exclusive') else (values >= rule['min'])
+                if rule.get('max') is not None: passes &= (values < rule['max']) if rule.get('exclusive') else (values <= rule['max'])
+            return passes | np.isnan(values)
+        if check == 'order':
+            first, second = (pd.to_numeric(_plain(df[col]), errors='coerce').astype('float64').to_numpy() for col in rule['columns'])
+            with np.errstate(invalid='ignore'):
+                return (first <= second) | np.isnan(first) | np.isnan(second)
+        if check == 'cpt_code':
+            values = df[rule['column']]
+            return open_catalog().contains(values) | values.isna().to_numpy()
+        raise ValueError(f"Unknown data quality check '{check}'.")
+
+    def check(self, table_name, df: pd.DataFrame, tables: dict) -> pd.DataFrame:
+        """Checks one table against its rules, records the result, quarantines the failing rows
+        and returns the table without the rows that failed a 'reject' rule."""
+        rules = {name: rule for name, rule in self.rules.get(table_name, {}).items()
+                 if all(col in df.columns for col in rule.get('columns', [rule.get('column')]))}
+        with stage(f"quality.{table_name}", 'quality', table_name) as record:
+            record.input(df)
+            sampled = self.sample and len(df) > self.sample_rows
+            positions = np.sort(np.random.default_rng(self.seed).choice(len(df), self.sample_rows, replace=False)) if sampled else None
+            names, failures, skipped = [], [], []
+            for name, rule in rules.items():
+                on_sample = sampled and rule.get('severity', 'warn') == 'warn'
+                passes = self._passes(rule, df.iloc[positions] if on_sample else df, tables)
+                if passes is None:
+                    skipped.append(name)
+                    continue
+                failed = np.zeros(len(df), dtype=bool)
+                failed[positions if on_sample else slice(None)] = ~passes
+                names.append(name)
+                failures.append(failed)
+            matrix = np.vstack(failures) if failures else np.zeros((0, len(df)), dtype=bool)
+            rejected = np.zeros(len(df), dtype=bool)
+            for name, failed in zip(names, matrix):
+                if rules[name].get('severity', 'warn') == 'reject': rejected |= failed
+            failing = matrix.any(axis=0)
+            quarantined = [i for i, name in enumerate(names) if rules[name].get('quarantine', True)]
+            self._quarantine(table_name, df, matrix[quarantined], [names[i] for i in quarantined], matrix[quarantined].any(axis=0))
+            result = df[~rejected] if rejected.any() else df
+            record.output(result)
+        counts = matrix.sum(axis=1)
+        self.results[table_name] = {
+            'rows': len(df), 'sampled_rows': int(len(positions)) if sampled else None, 'failing_rows': int(failing.sum()),
+            'rejected_rows': int(rejected.sum()), 'skipped_rules': skipped,
+            'rules': {name: {'check': rules[name]['check'], 'severity': rules[name].get('severity', 'warn'), 'failed': int(count)}
+                      for name, count in zip(names, counts)},
+        }
+        for name, count in zip(names, counts):
+            if count: logging.warning(f"  > {table_name}: {count} rows failed '{name}' ({rules[name].get('severity', 'warn')}).")
+        for name in skipped:
+            logging.warning(f"  > {table_name}: skipped '{name}', its reference table is not available.")
+        if not failing.any():
+            logging.info(f"  >  {table_name}: all {len(names)} data quality rules PASSED{f' (warnings on a {len(positions)}-row sample)' if sampled else ''}.")
+        return result
+
+    def _quarantine(self, table_name, df, matrix, names, failing):
+        path = os.path.join(self.quarantine_dir, f"{table_name}.parquet")
+        if not failing.any():
+            if os.path.exists(path): os.remove(path)
+            return
+        rows = df[failing].copy()
+        labels = np.array(names, dtype=object)
+        rows['dq_failed_rules'] = [','.join(labels[column]) for column in matrix[:, failing].T]
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+        rows.to_parquet(path, index=False)
+
+    def run(self, tables: dict, references: dict = None) -> dict:
+        """Checks every table in `tables` (dimensions and facts together, since rules reference each other)
+        and returns them with rejected rows removed. Foreign keys are checked against the tables as passed
+        in, or against the table of the same name in `references` (e.g. every version of an SCD dimension)."""
+        checked, targets = dict(tables), {**tables, **(references or {})}
+        for table_name in [name for name in self.rules if name in tables]:
+            checked[table_name] = self.check(table_name, tables[table_name], targets)
+        return checked
+
+    def report(self) -> dict:
+        return {'created': time.time(), 'tables': self.results}
+
+    def save_report(self, path=None):
+        path = path or os.path.join(self.quarantine_dir, DQ_REPORT_FILE)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        failing = {name: result['failing_rows'] for name, result in self.results.items() if result['failing_rows']}
+        logging.info(f"  > Data quality report saved to '{path}'. Tables with failing rows: {failing or 'none'}")
@@ -1,112 +1,349 @@
 # PHASE 4: DIMENSIONAL MODELING (Master Orchestrator for Phases 2, 3, & 4)
 import pandas as pd
+import numpy as np
 import logging
+from pandas.tseries.holiday import USFederalHolidayCalendar
+
+from key_registry import open_registry, open_fact_map, KEY_REGISTRY_DIR
+from data_quality import DataQualityEngine, QUARANTINE_DIR
+from procedure_catalog import open_catalog
+from instrumentation import instrument
 
 # Configure Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
 
+# dim_date is a generated calendar over this range, independent of the dates seen in the data.
+DATE_DIM_START, DATE_DIM_END = '2015-01-01', '2030-12-31'
+FISCAL_YEAR_START_MONTH = 7  # Fiscal year N runs from July 1 of N-1 to June 30 of N.
+SURROGATE_KEYS = {'dim_patients': 'patient_sk', 'dim_providers': 'provider_sk'}
+
+# Columns the star schema copies as they are from the transformed sources.
+DIMENSION_COLUMNS = {
+    'dim_patients': ['patient_sk', 'unified_patient_id', 'enterprise_patient_id', 'FirstName', 'LastName', 'Gender', 'age', 'Address', 'source_hospital'],
+    'dim_providers': ['provider_sk', 'ProviderID', 'FirstName', 'LastName', 'Specialization', 'DepartmentName', 'NPI', 'source_hospital'],
+}
+CLAIM_FACT_COLUMNS = ['ClaimAmount', 'PaidAmount', 'ClaimStatus', 'PayorType', 'Deductible', 'Coinsurance', 'Copay', 'days_to_payment', 'source_hospital']
+# The source columns (common-model names) each star schema table is built from, by source table. Derived
+# columns in these lists (keys, age) are simply absent from the sources; extraction_plan.py pulls the rest.
+MODELING_SOURCE_COLUMNS = {
+    'dim_patients': {'patients': ['PatientID', 'DOB'] + DIMENSION_COLUMNS['dim_patients']},
+    'dim_providers': {'providers': ['DeptID'] + DIMENSION_COLUMNS['dim_providers'], 'departments': ['DeptID', 'Name']},
+    'dim_procedures': {'transactions': ['ProcedureCode']},
+    'fact_transactions': {'transactions': ['TransactionID', 'EncounterID', 'PatientID', 'ProviderID', 'ProcedureCode', 'ServiceDate', 'PaidDate', 'Amount', 'PaidAmount']},
+    'fact_claims': {'claims': ['ClaimID', 'TransactionID', 'ServiceDate', 'ClaimDate', 'ModifiedDate'] + CLAIM_FACT_COLUMNS},
+}
+
+def date_key(dates: pd.Series):
+    """The integer YYYYMMDD smart key of every date, computed with array arithmetic; nulls stay null."""
+    dates = pd.to_datetime(dates, errors='coerce').dt
+    return (dates.year * 10000 + dates.month * 100 + dates.day).astype('Int64').array
+
+class KeyLookup:
+    """
+    A prebuilt hash index from a dimension's natural key to its surrogate key.
+    Each key column is encoded against the dimension's distinct values and the codes are packed
+    into one int64, so resolve() maps every fact row to its key with integer hash lookups in one
+    vectorized pass, without merging (and copying) the fact frame. Unmatched rows are counted.
+    """
+    def __init__(self, name, natural_key_columns: dict, surrogate_keys):
+        self.name = name
+        frame = pd.DataFrame(natural_key_columns)
+        frame['_sk'] = pd.array(surrogate_keys, dtype='Int64')
+        frame = frame.drop_duplicates(subset=list(natural_key_columns), keep='last')
+        self.levels = [pd.Index(self._values(frame[col]).unique()) for col in natural_key_columns]
+        self.index = pd.Index(self._encode([frame[col] for col in natural_key_columns]))
+        self.surrogate_keys = frame['_sk'].array
+
+    @staticmethod
+    def _values(series: pd.Series) -> pd.Series:
+        return series.astype(series.cat.categories.dtype) if isinstance(series.dtype, pd.CategoricalDtype) else series
+
+    def _encode(self, columns) -> np.ndarray:
+        packed = np.zeros(len(columns[0]), dtype=np.int64)
+        valid = np.ones(len(columns[0]), dtype=bool)
+        for level, col in zip(self.levels, columns):
+            if isinstance(col.dtype, pd.CategoricalDtype):
+                # Encode the few categories, then broadcast by category code.
+                category_codes = np.append(level.get_indexer(self._values(pd.Series(col.cat.categories))), -1)
+                codes = category_codes[col.cat.codes.to_numpy()]
+            else:
+                codes = level.get_indexer(col)
+            valid &= codes >= 0
+            packed = packed * len(level) + codes
+        packed[~valid] = -1
+        return packed
+
+    def resolve(self, natural_key_columns: dict):
+        """Returns (nullable Int64 surrogate keys, number of unmatched rows)."""
+        positions = self.index.get_indexer(self._encode(list(natural_key_columns.values())))
+        return self.surrogate_keys.take(positions, allow_fill=True), int((positions < 0).sum())
+
+class DateKeyLookup:
+    """
+    The dim_date counterpart of KeyLookup. date_sk is the YYYYMMDD smart key of the date itself,
+    so it is computed from the fact's date column without any index; only the calendar bounds are
+    kept, to null out and count dates that fall outside dim_date.
+    """
+    def __init__(self, name, first_key, last_key):
+        self.name, self.first_key, self.last_key = name, first_key, last_key
+
+    def resolve(self, natural_key_columns: dict):
+        """Returns (nullable Int64 date keys, number of null or out-of-calendar dates)."""
+        keys = date_key(next(iter(natural_key_columns.values())))
+        outside = ~((keys >= self.first_key) & (keys <= self.last_key)).fillna(False).to_numpy(dtype=bool)
+        keys[outside] = pd.NA
+        return keys, int(outside.sum())
+
+class AsOfKeyLookup(KeyLookup):
+    """
+    A KeyLookup over every version of an SCD Type 2 dimension, resolving each fact row to the version
+    that was in effect on the fact's date. The versions are sorted once on one int64 key packing the
+    member's code with the effective date; a fact row's (member, date) is then placed with a single
+    np.searchsorted, landing on the member's last version effective on or before that date. Rows dated
+    before a member's first version get that version, rows without a date the current one. Resolving n
+    fact rows against v versions costs O((n + v) log v) and never joins the facts to the history.
+    """
+    DAY_BITS = 20  # Days since 1970 are packed with this offset and width, good for dates between 535 BC and 4840.
+
+    def __init__(self, name, natural_key_columns: dict, surrogate_keys, effective_dates, versions):
+        self.name = name
+        frame = pd.DataFrame(natural_key_columns)
+        self.levels = [pd.Index(self._values(frame[col]).unique()) for col in natural_key_columns]
+        codes = self._encode([frame[col] for col in natural_key_columns])
+        days = self._days(effective_dates, missing=0)
+        order = np.lexsort((np.asarray(versions, dtype=np.int64), days, codes))
+        self.codes = codes[order]
+        self.sort_keys = self._pack(self.codes, days[order])
+        self.surrogate_keys = pd.array(surrogate_keys, dtype='Int64')[order]
+
+    @classmethod
+    def _days(cls, dates, missing) -> np.ndarray:
+        days = pd.to_datetime(pd.Series(dates), errors='coerce').to_numpy(dtype='datetime64[D]')
+        offset = days.astype(np.int64) + (1 << (cls.DAY_BITS - 1))
+        return np.where(np.isnat(days), missing, offset.clip(0, (1 << cls.DAY_BITS) - 1))
+
+    def _pack(self, codes, days) -> np.ndarray:
+        return (codes << self.DAY_BITS) | days
+
+    def resolve(self, natural_key_columns: dict, dates=None):
+        """Returns (nullable Int64 surrogate keys of the versions in effect on `dates`, number of unmatched rows)."""
+        codes = self._encode(list(natural_key_columns.values()))
+        if not len(self.codes):
+            return self.surrogate_keys.take(np.full(len(codes), -1), allow_fill=True), len(codes)
+        days = self._days(dates if dates is not None else pd.Series(pd.NaT, index=range(len(codes))), missing=(1 << self.DAY_BITS) - 1)
+        positions = np.searchsorted(self.sort_keys, self._pack(codes.clip(0), days), side='right') - 1
+        # Landing before the member's block means the date precedes its first version: take that version.
+        before_first = (positions < 0) | (self.codes[positions.clip(0)] != codes)
+        positions = (positions + before_first).clip(0, len(self.codes) - 1)
+        matched = (codes >= 0) & (self.codes[positions] == codes)
+        return self.surrogate_keys.take(np.where(matched, positions, -1), allow_fill=True), int((~matched).sum())
+
 # Define the Dimensional Modeler Class
 class DimensionalModeler:
     """A toolkit for creating a star schema from our transformed RCM data."""
-    
+    def __init__(self, registry_dir=KEY_REGISTRY_DIR, calendar_start=DATE_DIM_START, calendar_end=DATE_DIM_END):
+        self.registry_dir = registry_dir
+        self.calendar_start, self.calendar_end = calendar_start, calendar_end
+        self.unmatched_keys = {}
+
     def create_dimension_tables(self, transformed_db_data: dict) -> dict:
         """Task 4.1: Creates all required dimension tables."""
         logging.info("Assembling all dimension tables...")
         dimensions = {}
 
         # dim_patients
-        patients_df = transformed_db_data['patients']
-        dim_cols = ['patient_sk', 'unified_patient_id', 'FirstName', 'LastName', 'Gender', 'age', 'Address', 'source_hospital']
-        dimensions['dim_patients'] = patients_df[dim_cols].copy()
+        dimensions['dim_patients'] = self.build_dim_patients(transformed_db_data['patients'])
 
         # dim_providers
-        providers_df = transformed_db_data['providers']
-        depts_df = transformed_db_data['departments']
-        providers_with_dept = pd.merge(providers_df, depts_df[['DeptID', 'Name', 'source_hospital']], on=['DeptID', 'source_hospital'], how='left').rename(columns={'Name': 'DepartmentName'})
-        dim_cols = ['provider_sk', 'ProviderID', 'FirstName', 'LastName', 'Specialization', 'DepartmentName', 'NPI', 'source_hospital']
-        dimensions['dim_providers'] = providers_with_dept[dim_cols].copy()
+        dimensions['dim_providers'] = self.build_dim_providers(transformed_db_data['providers'], transformed_db_data['departments'])
         
         # dim_procedures
         if 'transactions' in transformed_db_data and not transformed_db_data['transactions'].empty:
-            unique_proc_codes = transformed_db_data['transactions']['ProcedureCode'].dropna().unique()
-            dim_procedures = pd.DataFrame({'ProcedureCode': unique_proc_codes})
-            dim_procedures['procedure_sk'] = dim_procedures.index
-            dim_procedures['ProcedureDescription'] = 'Desc for Code ' + dim_procedures['ProcedureCode'].astype(str)
-            dimensions['dim_procedures'] = dim_procedures
+            dimensions['dim_procedures'] = self.build_dim_procedures(transformed_db_data['transactions']['ProcedureCode'])
 
         # dim_date
-        all_dates = pd.concat([pd.to_datetime(transformed_db_data['transactions']['ServiceDate']), pd.to_datetime(transformed_db_data['encounters']['EncounterDate'])]).dropna().unique()
-        dim_date = pd.DataFrame({'full_date': all_dates}).sort_values('full_date').reset_index(drop=True)
-        dim_date['date_sk'] = dim_date.index
-        dim_date['year'] = dim_date['full_date'].dt.year
-        dim_date['month'] = dim_date['full_date'].dt.month
-        dim_date['quarter'] = dim_date['full_date'].dt.quarter
-        dim_date['day_of_week'] = dim_date['full_date'].dt.day_name()
-        dimensions['dim_date'] = dim_date
+        dimensions['dim_date'] = self.build_dim_date()
         
         logging.info("  > All dimension tables created successfully.")
         return dimensions
 
-    def create_fact_tables(self, transformed_db_data: dict, transformed_claims_df: pd.DataFrame, dimensions: dict) -> dict:
-        """Task 4.2: Creates all required fact tables."""
+    @instrument('modeling.dim_patients')
+    def build_dim_patients(self, patients_df: pd.DataFrame) -> pd.DataFrame:
+        return patients_df[DIMENSION_COLUMNS['dim_patients']].copy()
+
+    @instrument('modeling.dim_providers')
+    def build_dim_providers(self, providers_df: pd.DataFrame, depts_df: pd.DataFrame) -> pd.DataFrame:
+        providers_with_dept = pd.merge(providers_df, depts_df[['DeptID', 'Name', 'source_hospital']], on=['DeptID', 'source_hospital'], how='left').rename(columns={'Name': 'DepartmentName'})
+        return providers_with_dept[DIMENSION_COLUMNS['dim_providers']].copy()
+
+    @instrument('modeling.dim_procedures')
+    def build_dim_procedures(self, procedure_codes: pd.Series) -> pd.DataFrame:
+        unique_proc_codes = procedure_codes.dropna().unique()
+        dim_procedures = pd.DataFrame({'ProcedureCode': unique_proc_codes})
+        dim_procedures['procedure_sk'] = open_registry('procedures', self.registry_dir).assign(dim_procedures)
+        # Category, description and status come from the CPT catalog; codes it does not know stay null.
+        reference = open_catalog().lookup(dim_procedures['ProcedureCode'])
+        for col in ['ProcedureCategory', 'ProcedureDescription', 'CodeStatus']:
+            dim_procedures[col] = reference[col].astype(object).array
+        return dim_procedures
+
+    @instrument('modeling.dim_date')
+    def build_dim_date(self, start=None, end=None) -> pd.DataFrame:
+        """Generates one row per calendar day from `start` to `end` (by default the modeler's calendar range)."""
+        full_date = pd.date_range(start or self.calendar_start, end or self.calendar_end, freq='D')
+        holidays = USFederalHolidayCalendar().holidays(full_date[0], full_date[-1], return_name=True)
+        dim_date = pd.DataFrame({'date_sk': date_key(pd.Series(full_date)).astype(np.int64), 'full_date': full_date})
+        dates = dim_date['full_date'].dt
+        dim_date['year'] = dates.year
+        dim_date['month'] = dates.month
+        dim_date['quarter'] = dates.quarter
+        dim_date['day_of_week'] = dates.day_name()
+        dim_date['day_of_month'] = dates.day
+        dim_date['month_name'] = dates.month_name()
+        dim_date['iso_week'] = dates.isocalendar().week.astype(np.int64).to_numpy()
+        dim_date['week_start_date'] = dim_date['full_date'] - pd.to_timedelta(dates.dayofweek, unit='D')
+        dim_date['is_weekend'] = dates.dayofweek >= 5
+        dim_date['holiday_name'] = dim_date['full_date'].map(holidays)
+        dim_date['is_holiday'] = dim_date['holiday_name'].notna()
+        # Fiscal years are named after the calendar year they end in.
+        dim_date['fiscal_year'] = dates.year + ((dates.month >= FISCAL_YEAR_START_MONTH) & (FISCAL_YEAR_START_MONTH > 1)).astype(int)
+        dim_date['fiscal_month'] = (dates.month - FISCAL_YEAR_START_MONTH) % 12 + 1
+        dim_date['fiscal_quarter'] = (dim_date['fiscal_month'] - 1) // 3 + 1
+        return dim_date
+
+    def create_fact_tables(self, transformed_db_data: dict, transformed_claims_df: pd.DataFrame, dimensions: dict, versions: dict = None) -> dict:
+        """Task 4.2: Creates all required fact tables. With the `versions` of the SCD dimensions, facts
+        point to the version in effect on their ServiceDate (see create_lookups)."""
         logging.info("Assembling all fact tables...")
         facts = {}
-        
-        patients_lookup, providers_lookup, date_lookup, procedures_lookup = dimensions['dim_patients'][['unified_patient_id', 'patient_sk']], dimensions['dim_providers'][['ProviderID', 'source_hospital', 'provider_sk']], dimensions['dim_date'][['full_date', 'date_sk']], dimensions['dim_procedures'][['ProcedureCode', 'procedure_sk']]
-
-        # fact_transactions
-        trans_df = transformed_db_data['transactions'].copy()
-        trans_df['unified_patient_id'] = trans_df['source_hospital'].str.replace('hospital_', '').str.upper() + '-' + trans_df['PatientID']
-        merged_trans = pd.merge(trans_df, patients_lookup, on='unified_patient_id', how='left')
-        merged_trans = pd.merge(merged_trans, providers_lookup, on=['ProviderID', 'source_hospital'], how='left')
-        merged_trans = pd.merge(merged_trans, procedures_lookup, on='ProcedureCode', how='left')
-        merged_trans['ServiceDate'] = pd.to_datetime(merged_trans['ServiceDate'])
-        merged_trans = pd.merge(merged_trans, date_lookup, left_on='ServiceDate', right_on='full_date', how='left')
-        fact_cols = ['TransactionID', 'EncounterID', 'patient_sk', 'provider_sk', 'procedure_sk', 'date_sk', 'Amount', 'PaidAmount']
-        facts['fact_transactions'] = merged_trans[fact_cols].copy()
-
-        # fact_claims
-        claims_df = transformed_claims_df.copy()
-        trans_lookup = merged_trans[['TransactionID', 'patient_sk', 'source_hospital']]
-        merged_claims = pd.merge(claims_df, trans_lookup, on=['TransactionID', 'source_hospital'], how='left')
-        merged_claims['ServiceDate'] = pd.to_datetime(merged_claims['ServiceDate'])
-        merged_claims = pd.merge(merged_claims, date_lookup, left_on='ServiceDate', right_on='full_date', how='left')
-        fact_cols = ['ClaimID', 'TransactionID', 'patient_sk', 'date_sk', 'ClaimAmount', 'PaidAmount', 'ClaimStatus', 'PayorType', 'Deductible', 'Coinsurance', 'Copay', 'days_to_payment']
-        facts['fact_claims'] = merged_claims[fact_cols].copy()
-
+        lookups = self.create_lookups(dimensions, versions)
+        facts['fact_transactions'], trans_lookup = self.build_fact_transactions(transformed_db_data['transactions'], dimensions, lookups)
+        facts['fact_claims'] = self.build_fact_claims(transformed_claims_df, self.staged_transactions(trans_lookup), dimensions, lookups)
+        self.log_unmatched_keys()
         logging.info("  > All fact tables created successfully.")
         return facts
 
-    def validate_schema(self, facts: dict, dimensions: dict):
-        """Task 4.3: Performs validation checks on the star schema."""
+    def log_unmatched_keys(self):
+        for fact_name, counts in self.unmatched_keys.items():
+            for key, count in counts.items():
+                if count: logging.warning(f"  > {fact_name}: {count} rows have no matching {key}.")
+
+    def create_lookups(self, dimensions: dict, versions: dict = None) -> dict:
+        """
+        Builds the natural key -> surrogate key index of every dimension once, for reuse across batches.
+        `versions` holds every version of the SCD dimensions (scd_implementation.scd_versions); their
+        lookups are then as-of lookups that pick the version in effect on each fact's date. Without it,
+        facts point to the current versions.
+        """
+        versions = versions or {}
+        dim_patients, dim_providers = versions.get('dim_patients', dimensions['dim_patients']), versions.get('dim_providers', dimensions['dim_providers'])
+        if 'dim_patients' not in versions and 'is_current' in dim_patients.columns: dim_patients = dim_patients[dim_patients['is_current']]
+        if 'dim_providers' not in versions and 'is_current' in dim_providers.columns: dim_providers = dim_providers[dim_providers['is_current']]
+        def lookup(name, natural_key_columns, dim):
+            if name in versions:
+                return AsOfKeyLookup(name, natural_key_columns, dim[SURROGATE_KEYS[name]], dim['effective_date'], dim['version'])
+            return KeyLookup(name, natural_key_columns, dim[SURROGATE_KEYS[name]])
+        # Facts carry the source PatientID, so index patients on (source_hospital, PatientID); splitting
+        # unified_patient_id once per member is much cheaper than building it once per fact row.
+        return {
+            'patient_sk': lookup('dim_patients', {'source_hospital': dim_patients['source_hospital'], 'PatientID': dim_patients['unified_patient_id'].str.split('-', n=1).str[1]}, dim_patients),
+            'provider_sk': lookup('dim_providers', {'ProviderID': dim_providers['ProviderID'], 'source_hospital': dim_providers['source_hospital']}, dim_providers),
+            'procedure_sk': KeyLookup('dim_procedures', {'ProcedureCode': dimensions['dim_procedures']['ProcedureCode']}, dimensions['dim_procedures']['procedure_sk']),
+            'date_sk': DateKeyLookup('dim_date', dimensions['dim_date']['date_sk'].min(), dimensions['dim_date']['date_sk'].max()),
+        }
+
+    def _resolve(self, fact_name, lookup: KeyLookup, key_name, natural_key_columns: dict, as_of=None):
+        keys, unmatched = lookup.resolve(natural_key_columns, as_of) if isinstance(lookup, AsOfKeyLookup) else lookup.resolve(natural_key_columns)
+        counts = self.unmatched_keys.setdefault(fact_name, {})
+        counts[key_name] = counts.get(key_name, 0) + unmatched
+        return keys
+
+    @instrument('modeling.fact_transactions', output=lambda result: result[0])
+    def build_fact_transactions(self, transactions_df: pd.DataFrame, dimensions: dict, lookups: dict = None):
+        """Resolves the dimension keys for a frame (or a streamed batch) of transactions.
+        Returns the fact rows and the (TransactionID, source_hospital, patient_sk) lookup used by fact_claims."""
+        lookups = lookups or self.create_lookups(dimensions)
+        trans = transactions_df
+        hospital = trans['source_hospital']
+        patient_sk = self._resolve('fact_transactions', lookups['patient_sk'], 'patient_sk', {'source_hospital': hospital, 'PatientID': trans['PatientID']}, trans['ServiceDate'])
+        fact = pd.DataFrame({
+            'TransactionID': trans['TransactionID'].array,
+            'EncounterID': trans['EncounterID'].array,
+            'patient_sk': patient_sk,
+            'provider_sk': self._resolve('fact_transactions', lookups['provider_sk'], 'provider_sk', {'ProviderID': trans['ProviderID'], 'source_hospital': hospital}, trans['ServiceDate']),
+            'procedure_sk': self._resolve('fact_transactions', lookups['procedure_sk'], 'procedure_sk', {'ProcedureCode': trans['ProcedureCode']}),
+            'date_sk': self._resolve('fact_transactions', lookups['date_sk'], 'date_sk', {'full_date': trans['ServiceDate']}),
+            'paid_date_sk': self._resolve('fact_transactions', lookups['date_sk'], 'paid_date_sk', {'full_date': trans['PaidDate']}),
+            'Amount': trans['Amount'].array,
+            'PaidAmount': trans['PaidAmount'].array,
+            'source_hospital': hospital.array,
+        })
+        trans_lookup = pd.DataFrame({'TransactionID': trans['TransactionID'].array, 'patient_sk': patient_sk, 'source_hospital': hospital.array})
+        return fact, trans_lookup
+
+    def staged_transactions(self, trans_lookup: pd.DataFrame) -> pd.DataFrame:
+        """Records this run's (TransactionID, source_hospital, patient_sk) lookup and returns it for every
+        transaction ever staged. Claims files are read whole while transactions arrive as a delta, so claims
+        must resolve their patient against all transactions, not only this run's."""
+        transactions = open_fact_map('transaction_patients', self.registry_dir)
+        if not len(transactions.rows):
+            logging.warning("  > The transaction_patients map is empty and starts from this run's transactions; if earlier runs staged transactions incrementally, run once with --full-refresh to seed it.")
+        return transactions.update(trans_lookup)
+
+    @instrument('modeling.fact_claims')
+    def build_fact_claims(self, claims_df: pd.DataFrame, trans_lookup: pd.DataFrame, dimensions: dict, lookups: dict = None) -> pd.DataFrame:
+        """Resolves the dimension keys for a frame (or a streamed batch) of claims."""
+        lookups = lookups or self.create_lookups(dimensions)
+        transactions = KeyLookup('fact_transactions', {'TransactionID': trans_lookup['TransactionID'], 'source_hospital': trans_lookup['source_hospital']}, trans_lookup['patient_sk'])
+        fact = pd.DataFrame({
+            'ClaimID': claims_df['ClaimID'].array,
+            'TransactionID': claims_df['TransactionID'].array,
+            'patient_sk': self._resolve('fact_claims', transactions, 'TransactionID', {'TransactionID': claims_df['TransactionID'], 'source_hospital': claims_df['source_hospital']}),
+            'date_sk': self._resolve('fact_claims', lookups['date_sk'], 'date_sk', {'full_date': claims_df['ServiceDate']}),
+            'claim_date_sk': self._resolve('fact_claims', lookups['date_sk'], 'claim_date_sk', {'full_date': claims_df['ClaimDate']}),
+        })
+        for col in CLAIM_FACT_COLUMNS:
+            fact[col] = claims_df[col].array
+        return fact
+
+    @instrument('modeling.validate')
+    def validate_schema(self, facts: dict, dimensions: dict, quarantine_dir=QUARANTINE_DIR, sample=False, sources: dict = None, versions: dict = None):
+        """
+        Task 4.3: Checks the star schema against the data quality rules (data_quality.QUALITY_RULES):
+        every foreign key, key nullability, amount ranges and date ordering, plus the procedure codes of
+        the transformed `sources` (transactions, encounters) against the CPT catalog. Failing rows are
+        written to the quarantine directory with a summary report. Returns (dimensions, facts) without
+        the rows a 'reject' rule removed. With the SCD `versions` the facts were resolved against, their
+        keys are checked against every version rather than this run's dimension rows. Claims are checked
+        against every transaction ever staged (see staged_transactions), since they arrive whole.
+        """
         logging.info("Performing data validation on the new star schema...")
-        fact_trans = facts.get('fact_transactions', pd.DataFrame())
-        dim_patients = dimensions.get('dim_patients', pd.DataFrame())
-
-        if not fact_trans.empty and not dim_patients.empty:
-            valid_patient_keys = dim_patients['patient_sk'].unique()
-            orphaned_patients = fact_trans[~fact_trans['patient_sk'].isin(valid_patient_keys)]
-            if len(orphaned_patients) > 0:
-                logging.error(f"  > VALIDATION FAILED: Found {len(orphaned_patients)} orphaned patient records!")
-            else:
-                logging.info("  >  Referential Integrity Check PASSED: No orphaned patient records found.")
-            
-            invalid_amounts = fact_trans[fact_trans['Amount'] <= 0]
-            if len(invalid_amounts) > 0:
-                logging.warning(f"  > VALIDATION WARNING: Found {len(invalid_amounts)} transactions with a zero or negative amount.")
-            else:
-                logging.info("  >  Business Rule Check PASSED: All transaction amounts are positive.")
-        else:
-            logging.warning("Skipping validation as fact or dimension tables are missing.")
+        engine = DataQualityEngine(quarantine_dir=quarantine_dir, sample=sample)
+        transactions = open_fact_map('transaction_patients', self.registry_dir).rows
+        references = {**(versions or {}), **({'fact_transactions': transactions} if len(transactions) else {})}
+        checked = engine.run({**(sources or {}), **dimensions, **facts}, references=references)
+        engine.save_report()
+        return {name: checked[name] for name in dimensions}, {name: checked[name] for name in facts}
 
 
-def run_modeling(transformed_db_data, transformed_claims_data):
-    """Main orchestrator function for the modeling phase logic."""
-    modeler = DimensionalModeler()
+@instrument('modeling')
+def run_modeling(transformed_db_data, transformed_claims_data, registry_dir=KEY_REGISTRY_DIR, quarantine_dir=QUARANTINE_DIR, staging_dir=None, backend='pandas'):
+    """Main orchestrator function for the modeling phase logic. With the `staging_dir` holding the SCD
+    history, facts point to the dimension version in effect on their service date. Facts are assembled
+    on the execution `backend` (execution_backend.BACKENDS)."""
+    # Both modules import this one.
+    from execution_backend import open_backend
+    from scd_implementation import scd_versions
+    modeler = DimensionalModeler(registry_dir)
     dimensions = modeler.create_dimension_tables(transformed_db_data)
-    facts = modeler.create_fact_tables(transformed_db_data, transformed_claims_data, dimensions)
-    modeler.validate_schema(facts, dimensions) # Run validation at the end
-    return dimensions, facts
+    versions = scd_versions(dimensions, staging_dir, registry_dir) if staging_dir else None
+    engine = open_backend(backend)
+    try:
+        facts = engine.create_fact_tables(modeler, transformed_db_data, transformed_claims_data, dimensions, versions)
+    finally:
+        if engine is not backend: engine.close()
+    sources = {name: transformed_db_data[name] for name in ['transactions', 'encounters'] if name in transformed_db_data}
+    return modeler.validate_schema(facts, dimensions, quarantine_dir, sources=sources, versions=versions) # Run validation at the end
 
 # --- Step 4: Main Execution Block ---
 if __name__ == "__main__":
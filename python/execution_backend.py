@@ -0,0 +1,348 @@
+# EXECUTION BACKENDS: Eager pandas or lazy, multithreaded, spilling DuckDB plans for fact assembly and SCD matching
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import argparse
+import itertools
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+
+from dimensional_modeling import DimensionalModeler, SURROGATE_KEYS, CLAIM_FACT_COLUMNS
+from instrumentation import instrument
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+DEFAULT_BACKEND = 'pandas'
+DUCKDB_TEMP_DIR = './Data/duckdb_spill'  # Joins and sorts larger than the memory limit spill here.
+DUCKDB_MEMORY_LIMIT = None  # e.g. '4GB'; DuckDB's default is 80% of the machine's RAM.
+FETCH_BATCH_ROWS = 1_000_000  # Rows per Arrow record batch when a result is fetched.
+FACT_KEYS = {
+    'fact_transactions': ['patient_sk', 'provider_sk', 'procedure_sk', 'date_sk', 'paid_date_sk'],
+    'fact_claims': ['patient_sk', 'date_sk', 'claim_date_sk'],
+}
+# Key column of each fact, with the name unmatched rows are counted under (DimensionalModeler.unmatched_keys).
+UNMATCHED_KEY_NAMES = {'fact_claims': {'patient_sk': 'TransactionID'}}
+
+class PandasBackend:
+    """
+    The default backend: the eager, in-memory DimensionalModeler and SCDType2Engine code paths.
+    Every backend offers the same operations, so callers hold a backend and never branch on which one it is.
+    """
+    name = 'pandas'
+
+    def create_lookups(self, modeler: DimensionalModeler, dimensions: dict, versions: dict = None):
+        return modeler.create_lookups(dimensions, versions)
+
+    def fact_transactions(self, modeler: DimensionalModeler, transactions_df: pd.DataFrame, lookups):
+        return modeler.build_fact_transactions(transactions_df, None, lookups)
+
+    def fact_claims(self, modeler: DimensionalModeler, claims_df: pd.DataFrame, trans_lookup: pd.DataFrame, lookups) -> pd.DataFrame:
+        return modeler.build_fact_claims(claims_df, trans_lookup, None, lookups)
+
+    def create_fact_tables(self, modeler: DimensionalModeler, transformed_db_data: dict, transformed_claims_df: pd.DataFrame, dimensions: dict, versions: dict = None) -> dict:
+        """DimensionalModeler.create_fact_tables on this backend."""
+        logging.info(f"Assembling all fact tables ({self.name} backend)...")
+        lookups = self.create_lookups(modeler, dimensions, versions)
+        fact_transactions, trans_lookup = self.fact_transactions(modeler, transformed_db_data['transactions'], lookups)
+        facts = {'fact_transactions': fact_transactions, 'fact_claims': self.fact_claims(modeler, transformed_claims_df, modeler.staged_transactions(trans_lookup), lookups)}
+        modeler.log_unmatched_keys()
+        return facts
+
+    def match_positions(self, current: pd.DataFrame, new_dim: pd.DataFrame, natural_key) -> np.ndarray:
+        """For every row of `new_dim`, the row of `current` with the same natural key, or -1 (the SCD diff's join)."""
+        def key_index(df):
+            keys = df[natural_key].astype(object)
+            return pd.Index(keys.iloc[:, 0]) if len(natural_key) == 1 else pd.MultiIndex.from_frame(keys)
+        if current.empty: return np.full(len(new_dim), -1)
+        return key_index(current).get_indexer(key_index(new_dim))
+
+    def close(self):
+        pass
+
+class DuckDBBackend(PandasBackend):
+    """
+    Runs fact assembly and the SCD key match as DuckDB query plans: dimension and version indexes are
+    materialized once as DuckDB tables, and every fact batch is resolved by one statement of hash joins
+    (ASOF joins for the SCD dimensions) that DuckDB executes on all cores and spills under DUCKDB_TEMP_DIR
+    when it outgrows the memory limit. Input frames are scanned in place through Arrow, only the
+    columns a plan reads are handed over, and the results come back with the dtypes the pandas backend
+    produces, so both backends build identical star schemas (see check_parity).
+    dim_date stays on the modeler: it is a fixed calendar, independent of the data volume.
+    """
+    name = 'duckdb'
+
+    def __init__(self, memory_limit=DUCKDB_MEMORY_LIMIT, temp_dir=DUCKDB_TEMP_DIR, threads=None):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("The DuckDB backend needs DuckDB: pip install duckdb") from None
+        os.makedirs(temp_dir, exist_ok=True)
+        # One spill directory per backend, removed by close() or when the backend is garbage collected.
+        self.spill_dir = tempfile.mkdtemp(prefix='backend-', dir=temp_dir)
+        self.connection = duckdb.connect()
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+        self.connection.execute(f"SET temp_directory = '{self.spill_dir}'")
+        if memory_limit: self.connection.execute(f"SET memory_limit = '{memory_limit}'")
+        if threads: self.connection.execute(f"SET threads TO {int(threads)}")
+        # Results are put back in input order from their row numbers, so plans need not keep it.
+        self.connection.execute("SET GLOBAL preserve_insertion_order = false")
+        try:
+            # DuckDB 1.x runs ASOF joins whose left side it estimates small as nested loops, and it estimates
+            # registered Arrow scans small; always use the sort-merge ASOF operator instead.
+            self.connection.execute("SET GLOBAL asof_loop_join_threshold = 0")
+        except duckdb.CatalogException:
+            pass  # Earlier versions have no such setting and always sort-merge.
+        self._names, self._lock = itertools.count(), threading.Lock()
+
+    def _cursor(self):
+        # Cursors share the database (and its tables) but can be used from the pipeline's worker threads.
+        return self.connection.cursor()
+
+    def _table_name(self, prefix):
+        with self._lock:
+            return f"{prefix}_{next(self._names)}"
+
+    @staticmethod
+    def _frame(columns: dict) -> pa.Table:
+        """An Arrow table of just the given columns plus their row number. DuckDB scans Arrow in place;
+        Arrow-backed string columns are not copied, categoricals become dictionary arrays."""
+        first = next(iter(columns.values()))
+        frame = pd.DataFrame({name: pd.Series(col).array for name, col in columns.items()})
+        return pa.Table.from_pandas(frame, preserve_index=False).append_column('_row', pa.array(np.arange(len(first))))
+
+    @staticmethod
+    def _fetch(relation) -> pd.DataFrame:
+        # Streamed out of the plan in record batches, so the result is never materialized inside DuckDB's
+        # memory limit. DuckDB 1.5 renamed fetch_arrow_reader to to_arrow_reader.
+        reader = getattr(relation, 'to_arrow_reader', None) or relation.fetch_arrow_reader
+        return reader(FETCH_BATCH_ROWS).read_all().to_pandas()
+
+    def _materialize(self, prefix, columns: dict, select) -> str:
+        """Loads `columns` into a DuckDB table through the `select` over them (as `src`); returns the table name."""
+        name, cursor = self._table_name(prefix), self._cursor()
+        cursor.register('src', self._frame(columns))
+        cursor.execute(f"CREATE TABLE {name} AS {select}")
+        cursor.unregister('src')
+        return name
+
+    @instrument('backend.duckdb.lookups')
+    def create_lookups(self, modeler: DimensionalModeler, dimensions: dict, versions: dict = None) -> dict:
+        """
+        The DuckDB counterpart of DimensionalModeler.create_lookups: one keyed table per dimension. Natural
+        keys duplicated in a dimension keep their last row, like KeyLookup. With `versions`, an SCD
+        dimension gets its versions by member and effective day (the latest version of a day wins), plus
+        the first and latest version of every member, matching AsOfKeyLookup.
+        """
+        versions = versions or {}
+        def member_keys(name, dim):
+            if name == 'dim_patients':
+                # Same as unified_patient_id.str.split('-', n=1).str[1]: everything after the first '-'.
+                return {'source_hospital': dim['source_hospital'], 'PatientID': dim['unified_patient_id']}, \
+                       "CAST(source_hospital AS VARCHAR) AS k1, CASE WHEN strpos(PatientID, '-') > 0 THEN substr(PatientID, strpos(PatientID, '-') + 1) END AS k2"
+            return {'ProviderID': dim['ProviderID'], 'source_hospital': dim['source_hospital']}, \
+                   "CAST(ProviderID AS VARCHAR) AS k1, CAST(source_hospital AS VARCHAR) AS k2"
+        lookups = {}
+        for name, key in SURROGATE_KEYS.items():
+            if name in versions:
+                dim = versions[name]
+                columns, keys = member_keys(name, dim)
+                table = self._materialize(f"versions_{name}", {**columns, 'sk': dim[key], 'effective_date': dim['effective_date'], 'version': dim['version']},
+                                          f"SELECT {keys}, sk, COALESCE({self._day('effective_date')}, DATE '0001-01-01') AS day, version FROM src")
+                cursor = self._cursor()
+                cursor.execute(f"CREATE TABLE {table}_asof AS SELECT * FROM {table} QUALIFY row_number() OVER (PARTITION BY k1, k2, day ORDER BY version DESC) = 1")
+                cursor.execute(f"CREATE TABLE {table}_first AS SELECT k1, k2, sk FROM {table} QUALIFY row_number() OVER (PARTITION BY k1, k2 ORDER BY day, version) = 1")
+                cursor.execute(f"CREATE TABLE {table}_latest AS SELECT k1, k2, sk FROM {table} QUALIFY row_number() OVER (PARTITION BY k1, k2 ORDER BY day DESC, version DESC) = 1")
+                lookups[key] = ('asof', table)
+            else:
+                dim = dimensions[name]
+                if 'is_current' in dim.columns: dim = dim[dim['is_current']]
+                columns, keys = member_keys(name, dim)
+                lookups[key] = ('key', self._materialize(f"keys_{name}", {**columns, 'sk': dim[key]},
+                                                         f"SELECT {keys}, sk FROM src QUALIFY row_number() OVER (PARTITION BY k1, k2 ORDER BY _row DESC) = 1"))
+        procedures = dimensions['dim_procedures']
+        lookups['procedure_sk'] = ('key', self._materialize('keys_dim_procedures', {'code': procedures['ProcedureCode'], 'sk': procedures['procedure_sk']},
+                                                            "SELECT code, sk FROM src QUALIFY row_number() OVER (PARTITION BY code ORDER BY _row DESC) = 1"))
+        lookups['date_sk'] = ('calendar', int(dimensions['dim_date']['date_sk'].min()), int(dimensions['dim_date']['date_sk'].max()))
+        return lookups
+
+    @staticmethod
+    def _day(column) -> str:
+        """SQL for the day of a date, timestamp or date string column; unparseable values are null, like pd.to_datetime(errors='coerce')."""
+        return f"CAST(TRY_CAST({column} AS TIMESTAMP) AS DATE)"
+
+    @classmethod
+    def _date_key(cls, column, calendar) -> str:
+        """SQL for the YYYYMMDD date_sk of a date column, null outside the calendar, like DateKeyLookup."""
+        _, first_key, last_key = calendar
+        day = cls._day(column)
+        key = f"(year({day}) * 10000 + month({day}) * 100 + day({day}))"
+        return f"CASE WHEN {key} BETWEEN {first_key} AND {last_key} THEN {key} END"
+
+    @staticmethod
+    def _key_join(alias, lookup, k1, k2=None, day=None) -> (str, str):
+        """(JOIN clauses, key expression) resolving the fact columns k1[, k2] (and `day`) against a lookup table."""
+        kind, table = lookup
+        on = lambda a: f"{a}.k1 = {k1}" + (f" AND {a}.k2 = {k2}" if k2 else '')
+        if kind == 'key':
+            return f"LEFT JOIN {table} {alias} ON {on(alias)}", f"{alias}.sk"
+        joins = [f"ASOF LEFT JOIN {table}_asof {alias} ON {on(alias)} AND {day} >= {alias}.day"]
+        joins += [f"LEFT JOIN {table}_{edge} {alias}_{edge} ON {on(f'{alias}_{edge}')}" for edge in ['first', 'latest']]
+        # A fact dated before the member's first version gets that version; a fact without a date the latest one.
+        return ' '.join(joins), f"CASE WHEN {day} IS NULL THEN {alias}_latest.sk ELSE COALESCE({alias}.sk, {alias}_first.sk) END"
+
+    def _finish(self, modeler, fact_name, fact: pd.DataFrame, sources: dict) -> pd.DataFrame:
+        """Restores the input row order and the pandas backend's dtypes, and counts the unmatched keys of a fact result."""
+        # _row is a permutation of the input rows, so inverting it puts the rows back in O(n), without a sort in the plan.
+        order = np.empty(len(fact), dtype=np.int64)
+        order[fact['_row'].to_numpy()] = np.arange(len(fact))
+        fact = fact.take(order).drop(columns='_row').reset_index(drop=True)
+        counts = modeler.unmatched_keys.setdefault(fact_name, {})
+        for col in FACT_KEYS[fact_name]:
+            fact[col] = fact[col].astype('Int64')
+            key_name = UNMATCHED_KEY_NAMES.get(fact_name, {}).get(col, col)
+            counts[key_name] = counts.get(key_name, 0) + int(fact[col].isna().sum())
+        for col, source in sources.items():
+            fact[col] = fact[col].astype(source.dtype)
+        return fact
+
+    @instrument('backend.duckdb.fact_transactions', output=lambda result: result[0])
+    def fact_transactions(self, modeler: DimensionalModeler, transactions_df: pd.DataFrame, lookups: dict):
+        trans = transactions_df
+        day = self._day('t.ServiceDate')
+        patient_joins, patient_sk = self._key_join('p', lookups['patient_sk'], 'CAST(t.source_hospital AS VARCHAR)', 'CAST(t.PatientID AS VARCHAR)', day)
+        provider_joins, provider_sk = self._key_join('v', lookups['provider_sk'], 'CAST(t.ProviderID AS VARCHAR)', 'CAST(t.source_hospital AS VARCHAR)', day)
+        sql = f"""
+            SELECT t.TransactionID, t.EncounterID, {patient_sk} AS patient_sk, {provider_sk} AS provider_sk, r.sk AS procedure_sk,
+                   {self._date_key('t.ServiceDate', lookups['date_sk'])} AS date_sk, {self._date_key('t.PaidDate', lookups['date_sk'])} AS paid_date_sk,
+                   t.Amount, t.PaidAmount, t.source_hospital, t._row
+            FROM trans t {patient_joins} {provider_joins}
+            LEFT JOIN {lookups['procedure_sk'][1]} r ON r.code = t.ProcedureCode"""
+        columns = ['TransactionID', 'EncounterID', 'PatientID', 'ProviderID', 'ProcedureCode', 'ServiceDate', 'PaidDate', 'Amount', 'PaidAmount', 'source_hospital']
+        cursor = self._cursor()
+        cursor.register('trans', self._frame({col: trans[col] for col in columns}))
+        fact = self._fetch(cursor.sql(sql))
+        cursor.unregister('trans')
+        fact = self._finish(modeler, 'fact_transactions', fact, {col: trans[col] for col in ['TransactionID', 'EncounterID', 'Amount', 'PaidAmount', 'source_hospital']})
+        trans_lookup = pd.DataFrame({'TransactionID': fact['TransactionID'].array, 'patient_sk': fact['patient_sk'].array, 'source_hospital': fact['source_hospital'].array})
+        return fact, trans_lookup
+
+    @instrument('backend.duckdb.fact_claims')
+    def fact_claims(self, modeler: DimensionalModeler, claims_df: pd.DataFrame, trans_lookup: pd.DataFrame, lookups: dict) -> pd.DataFrame:
+        transactions = self._materialize('keys_fact_transactions', {'TransactionID': trans_lookup['TransactionID'], 'source_hospital': trans_lookup['source_hospital'], 'sk': trans_lookup['patient_sk']},
+                                         "SELECT CAST(TransactionID AS VARCHAR) AS k1, CAST(source_hospital AS VARCHAR) AS k2, sk FROM src "
+                                         "QUALIFY row_number() OVER (PARTITION BY k1, k2 ORDER BY _row DESC) = 1")
+        sql = f"""
+            SELECT c.ClaimID, c.TransactionID, x.sk AS patient_sk, {self._date_key('c.ServiceDate', lookups['date_sk'])} AS date_sk,
+                   {self._date_key('c.ClaimDate', lookups['date_sk'])} AS claim_date_sk, {', '.join(f'c.{col}' for col in CLAIM_FACT_COLUMNS)}, c._row
+            FROM claims c LEFT JOIN {transactions} x ON x.k1 = CAST(c.TransactionID AS VARCHAR) AND x.k2 = CAST(c.source_hospital AS VARCHAR)"""
+        cursor = self._cursor()
+        cursor.register('claims', self._frame({col: claims_df[col] for col in ['ClaimID', 'TransactionID', 'ServiceDate', 'ClaimDate'] + CLAIM_FACT_COLUMNS}))
+        try:
+            fact = self._fetch(cursor.sql(sql))
+        finally:
+            cursor.unregister('claims')
+            cursor.execute(f"DROP TABLE {transactions}")
+        return self._finish(modeler, 'fact_claims', fact, {col: claims_df[col] for col in ['ClaimID', 'TransactionID'] + CLAIM_FACT_COLUMNS})
+
+    @instrument('backend.duckdb.match_positions')
+    def match_positions(self, current: pd.DataFrame, new_dim: pd.DataFrame, natural_key) -> np.ndarray:
+        if current.empty: return np.full(len(new_dim), -1)
+        cursor = self._cursor()
+        keys = [f"k{i}" for i in range(len(natural_key))]
+        cursor.register('cur', self._frame({k: current[col].astype(object) for k, col in zip(keys, natural_key)}))
+        cursor.register('new', self._frame({k: new_dim[col].astype(object) for k, col in zip(keys, natural_key)}))
+        on = ' AND '.join(f"c.{k} = n.{k}" for k in keys)
+        try:
+            matched = cursor.execute(f"SELECT n._row AS new_row, c._row AS current_row FROM new n JOIN cur c ON {on}").df()
+        finally:
+            cursor.unregister('cur')
+            cursor.unregister('new')
+        positions = np.full(len(new_dim), -1)
+        positions[matched['new_row'].to_numpy()] = matched['current_row'].to_numpy()
+        return positions
+
+    def close(self):
+        self.connection.close()
+        self._cleanup()
+
+BACKENDS = {'pandas': PandasBackend, 'duckdb': DuckDBBackend}
+
+def open_backend(backend=DEFAULT_BACKEND, **options):
+    """A backend by name (BACKENDS), or `backend` itself when it already is one."""
+    if not isinstance(backend, str): return backend
+    if backend not in BACKENDS: raise ValueError(f"Unknown execution backend '{backend}'; choose from {sorted(BACKENDS)}.")
+    return BACKENDS[backend](**options)
+
+def _differences(expected: pd.DataFrame, actual: pd.DataFrame):
+    try:
+        pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True))
+        return None
+    except AssertionError as e:
+        return ' '.join(str(e).split())
+
+def check_parity(rows_per_hospital=10_000, n_hospitals=2, scd_change_rate=0.05, backends=('pandas', 'duckdb')) -> pd.DataFrame:
+    """
+    Builds the star schema of freshly generated data with every backend and compares the results table
+    by table. The SCD dimensions get one generation of changes effective mid-way through the service dates,
+    so as-of resolution picks both old and new versions. Returns one row per (check, backend) with its time,
+    row count and the first difference from the first backend (None when identical).
+    """
+    from benchmarks import extract_generated, _changed_dimensions
+    from scd_implementation import SCDType2Engine, SCD_DIMENSIONS
+    from synthetic_data import SyntheticDataGenerator
+    from transform import run_all_transformations
+    generator = SyntheticDataGenerator(rows_per_hospital, n_hospitals, scd_change_rate=scd_change_rate)
+    results, baseline = [], {}
+    with tempfile.TemporaryDirectory() as work_dir:
+        registry_dir, staging_dir = os.path.join(work_dir, 'key_registry'), os.path.join(work_dir, 'staging')
+        logging.disable(logging.INFO)
+        try:
+            db_data, claims = extract_generated(generator.write(os.path.join(work_dir, 'synthetic')), n_hospitals)
+            db_data, claims = run_all_transformations(db_data, claims, registry_dir)
+            dimensions = DimensionalModeler(registry_dir).create_dimension_tables(db_data)
+            service_dates = pd.to_datetime(db_data['transactions']['ServiceDate'])
+            changed = _changed_dimensions(generator, registry_dir)
+            versions, current = {}, {}
+            for name in SCD_DIMENSIONS:
+                engine = SCDType2Engine.for_dimension(name, staging_dir, registry_dir)
+                engine.apply(dimensions[name], as_of=service_dates.min())
+                current[name] = engine.load_current()
+                versions[name] = engine.versions(changed[name], as_of=service_dates.quantile(0.5))
+            for backend_name in backends:
+                backend = open_backend(backend_name)
+                try:
+                    modeler = DimensionalModeler(registry_dir)
+                    start = time.perf_counter()
+                    outputs = backend.create_fact_tables(modeler, db_data, claims, dimensions, versions)
+                    seconds = time.perf_counter() - start
+                    for name in SCD_DIMENSIONS:
+                        positions = backend.match_positions(current[name], changed[name], SCD_DIMENSIONS[name]['natural_key'])
+                        outputs[f"scd_match.{name}"] = pd.DataFrame({'position': positions})
+                    outputs['unmatched_keys'] = pd.DataFrame([{'fact': fact, 'key': key, 'rows': count} for fact, counts in modeler.unmatched_keys.items() for key, count in counts.items()])
+                finally:
+                    backend.close()
+                for check, df in outputs.items():
+                    baseline.setdefault(check, df)
+                    results.append({'check': check, 'backend': backend_name, 'rows': len(df), 'fact_seconds': round(seconds, 4),
+                                    'difference': _differences(baseline[check], df)})
+        finally:
+            logging.disable(logging.NOTSET)
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Checks that every execution backend builds the same star schema from generated data.")
+    parser.add_argument('--rows', type=int, default=10_000, help="Transactions per hospital.")
+    parser.add_argument('--hospitals', type=int, default=2)
+    parser.add_argument('--change-rate', type=float, default=0.05)
+    parser.add_argument('--backends', nargs='+', default=list(BACKENDS), choices=list(BACKENDS))
+    args = parser.parse_args()
+    report = check_parity(args.rows, args.hospitals, args.change_rate, args.backends)
+    print(report.to_string(index=False))
+    different = report[report['difference'].notna()]
+    if not different.empty:
+        raise SystemExit(f"{len(different)} checks differ between backends.")
@@ -1,118 +1,347 @@
 # PHASE 2: DATA EXTRACTION (Production Version)
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from sqlalchemy import create_engine, text
 import logging
+import copy
 import os
 import glob
+import fnmatch
+import json
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from snapshot_cache import RawSnapshotCache, SNAPSHOT_DIR
+from extraction_plan import ExtractionPlanner, required_columns
+from instrumentation import instrument, stage
 
 #Configure Logging and Global Variables ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [DataExtractor] - %(message)s')
 
-DB_CONFIG = {
-    'hospital_a': {'user': 'root', 'password': 'root', 'host': '127.0.0.1', 'port': '3306', 'db': 'hospital_a_db'},
-    'hospital_b': {'user': 'root', 'password': 'root', 'host': '127.0.0.1', 'port': '3306', 'db': 'hospital_b_db'}
-}
+HOSPITALS_CONFIG_FILE = './config/hospitals.json'
 CLAIMS_FOLDER = './Data/claims' 
+WATERMARK_FILE = './Data/watermarks.json'
+EXTRACTION_WORKERS = 8  # Sources (tables and claims files) fetched concurrently.
+SOURCE_TABLES = ['departments', 'encounters', 'patients', 'providers', 'transactions']
+
+# Declared schema of the claims CSVs. Dates are parsed by the reader and the enum-like
+# columns are dictionary-encoded, so they arrive in pandas as datetime64 and category.
+CLAIMS_DATE_COLUMNS = ['ServiceDate', 'ClaimDate', 'InsertDate', 'ModifiedDate']
+CLAIMS_CATEGORICAL_COLUMNS = ['ClaimStatus', 'PayorType', 'PayorID']
+CLAIMS_SCHEMA = pa.schema(
+    [(col, pa.string()) for col in ['ClaimID', 'TransactionID', 'PatientID', 'EncounterID', 'ProviderID', 'DeptID']]
+    + [(col, pa.timestamp('s')) for col in CLAIMS_DATE_COLUMNS]
+    + [(col, pa.dictionary(pa.int32(), pa.string())) for col in CLAIMS_CATEGORICAL_COLUMNS]
+    + [(col, pa.float64()) for col in ['ClaimAmount', 'PaidAmount', 'Deductible', 'Coinsurance', 'Copay']]
+)
+
+# Change-tracking columns per table (see ddl.sql). Tables not listed here have no
+# audit dates and are always pulled in full; they are small reference tables.
+INCREMENTAL_COLUMNS = {
+    'patients': ['ModifiedDate'],
+    'encounters': ['InsertedDate', 'ModifiedDate'],
+    'transactions': ['InsertDate', 'ModifiedDate'],
+}
+
+def load_hospital_config(path=HOSPITALS_CONFIG_FILE) -> dict:
+    """
+    The onboarded hospitals, keyed by source_hospital name. Each declares its database connection ('db',
+    or a SQLAlchemy 'url'), glob patterns of its files in CLAIMS_FOLDER ('claims_files') and, per table, the
+    renames from its source column names to the common data model ('column_renames', see its ddl.sql).
+    """
+    with open(path) as f:
+        return json.load(f)
+
+HOSPITAL_CONFIG = load_hospital_config()
+HOSPITALS = list(HOSPITAL_CONFIG)
+DB_CONFIG = {name: hospital.get('db') or {'url': hospital['url']} for name, hospital in HOSPITAL_CONFIG.items()}
+SOURCE_COLUMN_RENAMES = {(name, table_name): renames for name, hospital in HOSPITAL_CONFIG.items()
+                         for table_name, renames in hospital.get('column_renames', {}).items()}
+# The columns extraction pulls from each source table (see extraction_plan.py); everything else stays in the source.
+SOURCE_COLUMNS = required_columns(INCREMENTAL_COLUMNS)
+
+class WatermarkStore:
+    """Persists the high-water mark of every (hospital, table) pair between runs."""
+    def __init__(self, path=WATERMARK_FILE):
+        self.path = path
+        self.marks = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.marks = json.load(f)
+            logging.info(f"Loaded extraction watermarks from '{path}'.")
+    def get(self, db_name, table_name):
+        return self.marks.get(db_name, {}).get(table_name)
+    def update(self, db_name, table_name, df, columns):
+        """Advances the mark to the newest change date seen in the extracted rows."""
+        if df is None or df.empty: return
+        newest = max(pd.to_datetime(df[col], errors='coerce').max() for col in columns if col in df.columns)
+        if pd.isnull(newest): return
+        with self._lock:
+            current = self.get(db_name, table_name)
+            if current is None or newest.date().isoformat() > current:
+                self.marks.setdefault(db_name, {})[table_name] = newest.date().isoformat()
+    def save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump(self.marks, f, indent=2, sort_keys=True)
+        logging.info(f"Saved extraction watermarks to '{self.path}'.")
 
 # Define the Data Extractor Class ---
 class DataExtractor:
     """A toolkit for connecting to and extracting data from various sources."""
-    def __init__(self, db_configs):
+    def __init__(self, db_configs, pool_size=5, planner=None):
+        """`pool_size` should match the number of tables read concurrently from one database.
+        A config with a 'url' (any SQLAlchemy URL, e.g. a SQLite stand-in) is used as is.
+        `planner` picks the columns read from every source, by default only the SOURCE_COLUMNS."""
         self.engines = {}
+        self.timings = {}
+        self.planner = planner or ExtractionPlanner(SOURCE_COLUMN_RENAMES, SOURCE_COLUMNS)
         for db_name, config in db_configs.items():
             try:
-                connection_str = (f"mysql+mysqlconnector://{config['user']}:{config['password']}"f"@{config['host']}:{config['port']}/{config['db']}")
-                self.engines[db_name] = create_engine(connection_str)
+                connection_str = config.get('url') or (f"mysql+mysqlconnector://{config['user']}:{config['password']}"f"@{config['host']}:{config['port']}/{config['db']}")
+                self.engines[db_name] = create_engine(connection_str, pool_size=pool_size, max_overflow=0, pool_pre_ping=True)
                 logging.info(f"Database engine for '{db_name}' created successfully.")
             except Exception as e:
                 logging.error(f"Failed to create database engine for '{db_name}'. Error: {e}", exc_info=True)
                 self.engines[db_name] = None
-    def extract_from_mysql(self, db_name, table_name):
+    def timed(self, source, func, *args, **kwargs):
+        """Runs one extraction call and records its wall-clock time under `source`."""
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.timings[source] = time.perf_counter() - start
+    def _build_query(self, db_name, table_name, since=None, change_columns=None, select=None):
+        select = select or self.planner.select_list(db_name, table_name, self.engines[db_name])
+        query, params = f"SELECT {select} FROM {table_name}", {}
+        if since is not None and change_columns:
+            # The audit columns are DATEs, so the boundary day is re-read with >= to avoid
+            # missing rows written later on the day the previous run finished.
+            query += " WHERE " + " OR ".join(f"{col} >= :since" for col in change_columns)
+            params['since'] = since
+            logging.info(f"Extracting rows changed since {since} from '{db_name}.{table_name}'...")
+        else:
+            logging.info(f"Extracting data from '{db_name}.{table_name}'...")
+        return text(query + ";"), params
+    @instrument('extract.mysql.{db_name}.{table_name}')
+    def extract_from_mysql(self, db_name, table_name, since=None, change_columns=None):
+        """Pulls a table, or only the rows changed on/after `since` when a watermark is given."""
         if self.engines.get(db_name) is None: return None
-        query = f"SELECT * FROM {table_name};"
-        logging.info(f"Extracting data from '{db_name}.{table_name}'...")
+        query, params = self._build_query(db_name, table_name, since, change_columns)
         try:
             with self.engines[db_name].connect() as connection:
-                df = pd.read_sql(text(query), connection)
+                df = pd.read_sql(query, connection, params=params)
                 logging.info(f"  > Success: Retrieved {len(df)} rows from '{db_name}.{table_name}'.")
                 return df
         except Exception as e:
             logging.error(f"  > FAILED to extract data from '{db_name}.{table_name}'. Error: {e}")
             return None
-    def extract_from_csv(self, file_path):
+    def extract_from_mysql_chunks(self, db_name, table_name, chunksize, since=None, change_columns=None):
+        """Streams a table in DataFrame batches of `chunksize` rows over a server-side cursor."""
+        if self.engines.get(db_name) is None: return
+        query, params = self._build_query(db_name, table_name, since, change_columns)
+        total = 0
+        try:
+            with self.engines[db_name].connect() as connection:
+                connection = connection.execution_options(stream_results=True, max_row_buffer=chunksize)
+                for chunk in pd.read_sql(query, connection, params=params, chunksize=chunksize):
+                    total += len(chunk)
+                    yield chunk
+            logging.info(f"  > Success: Streamed {total} rows from '{db_name}.{table_name}'.")
+        except Exception as e:
+            logging.error(f"  > FAILED to stream data from '{db_name}.{table_name}' after {total} rows. Error: {e}")
+    def extract_distinct(self, db_name, table_name, column, since=None, change_columns=None):
+        """Lets the database compute the distinct values of one column instead of shipping every row."""
+        if self.engines.get(db_name) is None: return None
+        query, params = self._build_query(db_name, table_name, since, change_columns, select=f"DISTINCT {column}")
+        try:
+            with self.engines[db_name].connect() as connection:
+                return pd.read_sql(query, connection, params=params)[column]
+        except Exception as e:
+            logging.error(f"  > FAILED to extract distinct '{column}' from '{db_name}.{table_name}'. Error: {e}")
+            return None
+    def extract_from_csv(self, file_path, usecols=None):
         logging.info(f"Reading data from CSV: '{file_path}'...")
         try:
-            df = pd.read_csv(file_path)
+            df = pd.read_csv(file_path, usecols=usecols)
             logging.info(f"  > Success: Retrieved {len(df)} rows from '{os.path.basename(file_path)}'.")
             return df
         except Exception as e:
             logging.error(f"  > FAILED to read CSV file '{file_path}'. Error: {e}")
             return None
+    def extract_from_csv_chunks(self, file_path, chunksize):
+        """Streams a CSV file in DataFrame batches of `chunksize` rows."""
+        logging.info(f"Streaming data from CSV: '{file_path}'...")
+        total = 0
+        try:
+            for chunk in pd.read_csv(file_path, chunksize=chunksize):
+                total += len(chunk)
+                yield chunk
+            logging.info(f"  > Success: Streamed {total} rows from '{os.path.basename(file_path)}'.")
+        except Exception as e:
+            logging.error(f"  > FAILED to stream CSV file '{file_path}' after {total} rows. Error: {e}")
+    def extract_claims_csv(self, file_path):
+        """Reads a claims CSV with the multithreaded Arrow reader and the declared CLAIMS_SCHEMA, keeping
+        only the planner's claims columns. Files that do not match the schema fall back to the untyped pandas reader."""
+        logging.info(f"Reading claims CSV with typed Arrow reader: '{file_path}'...")
+        with stage(f"extract.claims.{os.path.basename(file_path)}", table='claims') as record:
+            record.input(nbytes=os.path.getsize(file_path) if os.path.exists(file_path) else None)
+            try:
+                usecols = self.planner.claims_columns(file_path)
+                table = pa_csv.read_csv(
+                    file_path,
+                    read_options=pa_csv.ReadOptions(use_threads=True),
+                    convert_options=pa_csv.ConvertOptions(column_types={field.name: field.type for field in CLAIMS_SCHEMA}, include_columns=usecols),
+                )
+                df = table.to_pandas()
+                logging.info(f"  > Success: Retrieved {len(df)} rows from '{os.path.basename(file_path)}'.")
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                logging.warning(f"  > '{file_path}' does not match the declared claims schema ({e}). Falling back to pandas.")
+                df = self.extract_from_csv(file_path, usecols)
+            except Exception as e:
+                logging.error(f"  > FAILED to read CSV file '{file_path}'. Error: {e}")
+                df = None
+            record.output(df)
+            return df
+
+# Standardization helpers, shared by run_extraction and the streaming pipeline ---
+def standardize_columns(db_name, table_name, df):
+    """Renames source-specific columns to the common data model, in place."""
+    renames = SOURCE_COLUMN_RENAMES.get((db_name, table_name))
+    if renames:
+        df.rename(columns=renames, inplace=True)
+    return df
+
+def add_unified_patient_id(patients_df):
+    patients_df['unified_patient_id'] = patients_df['source_hospital'].str.replace('hospital_', '').str.upper() + '-' + patients_df['PatientID'].astype(str)
+    return patients_df
+
+def concat_frames(dfs):
+    """Concatenates frames (e.g. hospital shards) without losing categorical dtypes to a category mismatch."""
+    for col in dfs[0].columns if dfs else []:
+        if all(col in df.columns and isinstance(df[col].dtype, pd.CategoricalDtype) for df in dfs):
+            categories = pd.api.types.union_categoricals([df[col] for df in dfs]).categories
+            for df in dfs:
+                df[col] = df[col].cat.set_categories(categories)
+    return pd.concat(dfs, ignore_index=True)
+
+def claims_source(file_path, hospital_config=None):
+    """The hospital whose 'claims_files' patterns match the file name, or None when no hospital claims it."""
+    name = os.path.basename(file_path).lower()
+    for hospital, config in (hospital_config or HOSPITAL_CONFIG).items():
+        if any(fnmatch.fnmatch(name, pattern.lower()) for pattern in config.get('claims_files', [])):
+            return hospital
+    logging.warning(f"  > No hospital in the configuration claims '{file_path}'; skipping it.")
+    return None
 
 #Define the Main Orchestrator Function ---
-def run_extraction():
+@instrument('extract')
+def run_extraction(full_refresh=False, max_workers=EXTRACTION_WORKERS, use_snapshot=False, snapshot_dir=SNAPSHOT_DIR, watermarks=None):
     """
     Main entry point for the extraction and integration phase.
     This function will be called by our master pipeline script.
+    By default only rows changed since the last successful run are pulled from the
+    tables in INCREMENTAL_COLUMNS; pass full_refresh=True to re-pull everything.
+    The marks of `watermarks` (a WatermarkStore, by default the stored marks) are advanced in memory
+    only: the caller saves them once the extracted rows are staged or loaded, so a run that fails
+    later extracts the same rows again instead of skipping them.
+    All tables and claims files are fetched concurrently on up to `max_workers` threads.
+    Every run snapshots its output in a RawSnapshotCache. With use_snapshot=True, a snapshot of the
+    same mode is returned instead, without touching the databases: for a full refresh, the full
+    extraction that left the watermarks and claims files in their current state; otherwise the delta
+    extracted from the current watermarks. A delta is never returned for a full refresh.
     """
     logging.info("========================================")
     logging.info("  RUNNING DATA EXTRACTION SUB-PIPELINE")
     logging.info("========================================")
     
-    extractor = DataExtractor(DB_CONFIG)
-    
     # Extraction ---
-    tables_to_extract = ['departments', 'encounters', 'patients', 'providers', 'transactions']
-    
-    logging.info("--- Extracting all tables from all databases...")
-    data_hospital_a = {tbl: extractor.extract_from_mysql('hospital_a', tbl) for tbl in tables_to_extract}
-    data_hospital_b = {tbl: extractor.extract_from_mysql('hospital_b', tbl) for tbl in tables_to_extract}
+    tables_to_extract = SOURCE_TABLES
 
-    logging.info("--- Extracting all claims from all CSV files...")
+    watermarks = watermarks or WatermarkStore()
+    snapshots = RawSnapshotCache(snapshot_dir)
     claim_files = glob.glob(os.path.join(CLAIMS_FOLDER, '*.csv'))
-    claims_dfs_list = [extractor.extract_from_csv(f) for f in claim_files]
+    # A delta is keyed on the window it was extracted from, before the fetch advances the marks.
+    window = copy.deepcopy(watermarks.marks)
+    if use_snapshot:
+        snapshot = snapshots.load(RawSnapshotCache.source_key(window, claim_files, SOURCE_COLUMNS, incremental=not full_refresh))
+        if snapshot is not None:
+            logging.info("--- Reusing the raw snapshot of the last extraction; the databases are not queried.")
+            return snapshot
+        logging.info(f"--- No {'full' if full_refresh else 'incremental'} raw snapshot matches the stored watermarks and claims files; extracting.")
+
+    extractor = DataExtractor(DB_CONFIG, pool_size=min(max_workers, len(tables_to_extract)))
+    if full_refresh:
+        logging.info("--- Full refresh requested: ignoring stored watermarks.")
+
+    def extract_table(db_name, table_name):
+        change_columns = INCREMENTAL_COLUMNS.get(table_name)
+        since = None if full_refresh or not change_columns else watermarks.get(db_name, table_name)
+        df = extractor.extract_from_mysql(db_name, table_name, since=since, change_columns=change_columns)
+        if change_columns:
+            watermarks.update(db_name, table_name, df, change_columns)
+        return df
+    
+    logging.info(f"--- Extracting all tables and claims files concurrently ({max_workers} workers)...")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        table_futures = {(db_name, tbl): pool.submit(extractor.timed, f"{db_name}.{tbl}", extract_table, db_name, tbl)
+                         for db_name in HOSPITALS for tbl in tables_to_extract}
+        claim_futures = [pool.submit(extractor.timed, os.path.basename(f), extractor.extract_claims_csv, f) for f in claim_files]
+        extracted = {key: future.result() for key, future in table_futures.items()}
+        claims_dfs_list = [future.result() for future in claim_futures]
+    elapsed = time.perf_counter() - start
+
+    logging.info(f"--- Extraction finished in {elapsed:.2f}s wall clock ({sum(extractor.timings.values()):.2f}s summed over sources):")
+    for source, seconds in sorted(extractor.timings.items(), key=lambda item: -item[1]):
+        logging.info(f"  > {source}: {seconds:.2f}s")
     
     # Standardization & Integration ---
     logging.info("--- Standardizing and integrating all data sources...")
     
-    # Standardize in 'patients' table columns.
-    if 'patients' in data_hospital_b and data_hospital_b['patients'] is not None:
-        data_hospital_b['patients'].rename(columns={
-            'ID': 'PatientID', 'F_Name': 'FirstName', 'L_Name': 'LastName', 'M_Name': 'MiddleName'
-        }, inplace=True)
-        logging.info("  > Standardized column names for 'hospital_b.patients'.")
-
-    # Integrate the database tables.
+    # Standardize each hospital's column names (column_renames in the hospital config), then
+    # integrate a table only when every hospital delivered it.
     integrated_db_data = {}
     for table_name in tables_to_extract:
-        df_a, df_b = data_hospital_a.get(table_name), data_hospital_b.get(table_name)
-        if df_a is not None and df_b is not None:
-            df_a['source_hospital'] = 'hospital_a'
-            df_b['source_hospital'] = 'hospital_b'
-            integrated_db_data[table_name] = pd.concat([df_a, df_b], ignore_index=True)
+        frames = [extracted[(db_name, table_name)] for db_name in HOSPITALS]
+        if not frames or any(df is None for df in frames): continue
+        for db_name, df in zip(HOSPITALS, frames):
+            standardize_columns(db_name, table_name, df)
+            df['source_hospital'] = db_name
+        integrated_db_data[table_name] = pd.concat(frames, ignore_index=True)
     
     # Create the unified_patient_id on the now-integrated patients table.
-    if 'patients' in integrated_db_data and not integrated_db_data['patients'].empty:
-         integrated_db_data['patients']['unified_patient_id'] = integrated_db_data['patients']['source_hospital'].str.replace('hospital_', '').str.upper() + '-' + integrated_db_data['patients']['PatientID'].astype(str)
+    if 'patients' in integrated_db_data:
+         add_unified_patient_id(integrated_db_data['patients'])
          logging.info("  > Created 'unified_patient_id' to uniquely identify all patients.")
     
     # Integrate the claims CSV files (schemas are identical, so this is straightforward).
     integrated_claims_df = pd.DataFrame()
     if claims_dfs_list:
-        valid_claims_dfs = [df for i, df in enumerate(claims_dfs_list) if df is not None]
-        for i, df in enumerate(valid_claims_dfs):
-            # We determine the source from the filename as a best practice
-            source = 'hospital_a' if 'hospital1' in claim_files[i].lower() else 'hospital_b'
+        valid_claims_dfs = []
+        for file_path, df in zip(claim_files, claims_dfs_list):
+            source = claims_source(file_path) if df is not None else None
+            if source is None: continue
             df['source_hospital'] = source
-        integrated_claims_df = pd.concat(valid_claims_dfs, ignore_index=True)
+            valid_claims_dfs.append(df)
+        integrated_claims_df = concat_frames(valid_claims_dfs)
         logging.info(f"  > Successfully integrated {len(integrated_claims_df)} claim records from {len(valid_claims_dfs)} files.")
     
+    snapshot_marks = watermarks.marks if full_refresh else window
+    snapshots.save(RawSnapshotCache.source_key(snapshot_marks, claim_files, SOURCE_COLUMNS, incremental=not full_refresh), integrated_db_data, integrated_claims_df)
+
     # The function returns the two key data structures for the next phase.
     return integrated_db_data, integrated_claims_df
 
 # Isolated Test Block ---
 if __name__ == "__main__":
-    db_data, claims_data = run_extraction()
+    if '--refresh-snapshot' in sys.argv:
+        RawSnapshotCache().invalidate()
+    db_data, claims_data = run_extraction(full_refresh='--full-refresh' in sys.argv, use_snapshot='--from-snapshot' in sys.argv)
 
     print("\n\n--- EXTRACTION SCRIPT TEST RUN COMPLETE ---")
     
@@ -0,0 +1,113 @@
+# EXTRACTION PLAN: Projection pushdown for the source reads, derived from the columns the pipeline uses
+import pandas as pd
+import argparse
+import logging
+import csv
+import threading
+
+from sqlalchemy import inspect
+
+from dimensional_modeling import MODELING_SOURCE_COLUMNS
+from patient_matching import MATCH_COLUMNS
+from data_quality import QUALITY_RULES
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+def required_columns(*extra) -> dict:
+    """
+    The common-model columns read from each source table: those the star schema is built from
+    (MODELING_SOURCE_COLUMNS), the identity fields patient matching compares, the columns of the
+    quality rules on source tables, and every {table: columns} mapping in `extra` (e.g. the audit
+    columns incremental extraction keeps watermarks on).
+    """
+    required = {}
+    def add(table_name, columns):
+        required[table_name] = list(dict.fromkeys(required.get(table_name, []) + [col for col in columns if col]))
+    for sources in MODELING_SOURCE_COLUMNS.values():
+        for table_name, columns in sources.items():
+            add(table_name, columns)
+    add('patients', MATCH_COLUMNS)
+    for table_name, rules in QUALITY_RULES.items():
+        if not table_name.startswith(('dim_', 'fact_')):
+            for rule in rules.values():
+                add(table_name, rule.get('columns', [rule.get('column')]))
+    for columns_by_table in extra:
+        for table_name, columns in columns_by_table.items():
+            add(table_name, columns)
+    return required
+
+class ExtractionPlanner:
+    """
+    Decides which columns extraction pulls from each source: the `required` columns the source has,
+    under the source's own names (its column_renames, reversed). Database tables are read with an
+    explicit select list aliasing those names back to the common model (ID AS PatientID), so rows
+    arrive already standardized and the columns nothing reads (MedicaidID, ICDCode, MiddleName, ...)
+    never leave the database. Claims files are read with only their required columns.
+    Tables without declared columns, and tables whose columns cannot be listed, are read whole.
+    """
+    def __init__(self, renames: dict, required: dict, prune=True):
+        self.renames, self.required, self.prune = renames, required, prune
+        self._available, self._lock = {}, threading.Lock()
+
+    def _table_columns(self, db_name, table_name, engine):
+        """The columns of a source table, listed once per process from the database catalog."""
+        with self._lock:
+            if (db_name, table_name) not in self._available:
+                try:
+                    self._available[(db_name, table_name)] = [column['name'] for column in inspect(engine).get_columns(table_name)]
+                except Exception as e:
+                    logging.warning(f"  > Could not list the columns of '{db_name}.{table_name}' ({e}); reading it whole.")
+                    self._available[(db_name, table_name)] = None
+            return self._available[(db_name, table_name)]
+
+    def columns(self, db_name, table_name, available) -> list:
+        """(source name, common-model name) of every required column among the `available` source columns, in table order."""
+        renames = self.renames.get((db_name, table_name), {})
+        required = set(self.required[table_name])
+        return [(col, renames.get(col, col)) for col in available if renames.get(col, col) in required]
+
+    def select_list(self, db_name, table_name, engine) -> str:
+        """The select list of a source table read: the pruned, aliased columns, or '*'."""
+        if not self.prune or table_name not in self.required: return "*"
+        available = self._table_columns(db_name, table_name, engine)
+        columns = self.columns(db_name, table_name, available) if available else []
+        return ", ".join(source if source == model else f"{source} AS {model}" for source, model in columns) or "*"
+
+    def claims_columns(self, file_path):
+        """The required columns of a claims file, from its header line, or None to read every column."""
+        if not self.prune or 'claims' not in self.required: return None
+        with open(file_path, newline='', encoding='utf-8') as f:
+            header = next(csv.reader(f), [])
+        return [col for col in self.required['claims'] if col in header] or None
+
+def compare_plans(tables=None) -> pd.DataFrame:
+    """Extracts every source table with and without pruning and compares the columns and memory of the two."""
+    from extraction import DataExtractor, DB_CONFIG, HOSPITALS, SOURCE_TABLES, SOURCE_COLUMNS, SOURCE_COLUMN_RENAMES
+    extractors = {'full': DataExtractor(DB_CONFIG, planner=ExtractionPlanner(SOURCE_COLUMN_RENAMES, SOURCE_COLUMNS, prune=False)),
+                  'pruned': DataExtractor(DB_CONFIG)}
+    rows = []
+    for db_name in HOSPITALS:
+        for table_name in tables or SOURCE_TABLES:
+            row = {'source': f"{db_name}.{table_name}"}
+            for name, extractor in extractors.items():
+                df = extractor.extract_from_mysql(db_name, table_name)
+                if df is None: continue
+                row.update({f'{name}_columns': df.shape[1], f'{name}_bytes': int(df.memory_usage(deep=True).sum()), 'rows': len(df)})
+            rows.append(row)
+    comparison = pd.DataFrame(rows)
+    comparison['saved'] = (1 - comparison['pruned_bytes'] / comparison['full_bytes']).round(3)
+    return comparison
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prints the columns extraction pulls from every source table.")
+    parser.add_argument('--compare', action='store_true', help="Extract every table with and without pruning and compare their memory.")
+    args = parser.parse_args()
+    if args.compare:
+        print(compare_plans().to_string(index=False))
+    else:
+        from extraction import DataExtractor, DB_CONFIG, HOSPITALS, SOURCE_TABLES
+        extractor = DataExtractor(DB_CONFIG)
+        for db_name in HOSPITALS:
+            for table_name in SOURCE_TABLES:
+                if extractor.engines.get(db_name) is None: continue
+                print(f"{db_name}.{table_name}: SELECT {extractor.planner.select_list(db_name, table_name, extractor.engines[db_name])} FROM {table_name}")
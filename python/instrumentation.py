@@ -0,0 +1,222 @@
+# INSTRUMENTATION: Per-stage timings, memory and row counts, exported as a JSON run report and a Chrome trace
+import pandas as pd
+import pyarrow as pa
+import logging
+import cProfile
+import fnmatch
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import resource  # Not available on Windows; psutil is used there when it is installed.
+except ImportError:
+    resource = None
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+PROFILE_DIR = './Data/profiles'
+RUN_REPORT_FILE = './Data/profiles/run_report.json'
+TRACE_FILE = './Data/profiles/run_trace.json'
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of a sampled stage.
+
+def peak_rss_mb():
+    """The process's peak resident set size so far, in MB, or None when the platform cannot tell."""
+    if resource is not None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10  # bytes on macOS, KB on Linux
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss) / 2**20
+    return None
+
+def measure(obj):
+    """(rows, bytes) of a DataFrame, Series or Arrow table, summed over dicts, lists and tuples of them.
+    Bytes are the shallow in-memory size, so strings held as Python objects count as pointers only."""
+    if isinstance(obj, (pd.DataFrame, pd.Series)):
+        return len(obj), int(obj.memory_usage(index=False).sum() if isinstance(obj, pd.DataFrame) else obj.memory_usage(index=False))
+    if isinstance(obj, pa.Table):
+        return obj.num_rows, obj.nbytes
+    if isinstance(obj, (dict, list, tuple)):
+        sizes = [measure(item) for item in (obj.values() if isinstance(obj, dict) else obj)]
+        sizes = [size for size in sizes if size is not None]
+        return (sum(rows for rows, _ in sizes), sum(nbytes for _, nbytes in sizes)) if sizes else None
+    return None
+
+class StageRecord:
+    """The measurements of one run of one stage. Stages call input()/output() to report what they processed."""
+    def __init__(self, name, category, table):
+        self.name, self.category, self.table = name, category, table
+        self.pid, self.thread_id, self.thread_name = os.getpid(), threading.get_ident(), threading.current_thread().name
+        self.start = self.wall_s = self.cpu_s = self.peak_rss_mb = None
+        self.rows_in = self.rows_out = self.bytes_in = self.bytes_out = None
+        self.status = 'running'
+
+    def input(self, obj=None, rows=None, nbytes=None):
+        size = measure(obj) if obj is not None else None
+        self.rows_in, self.bytes_in = (size or (rows, nbytes))
+
+    def output(self, obj=None, rows=None, nbytes=None):
+        size = measure(obj) if obj is not None else None
+        self.rows_out, self.bytes_out = (size or (rows, nbytes))
+
+    def as_dict(self):
+        return {key: value for key, value in vars(self).items() if key != 'thread_id'}
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread every `interval` seconds into collapsed-stack counts (flame graph input)."""
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.target, self.interval, self.stacks = thread_id, interval, Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame, stack = sys._current_frames().get(self.target), []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            if stack: self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+class RunProfiler:
+    """
+    Collects a StageRecord for every instrumented stage of a run: wall time, CPU time of the stage's
+    thread, the process's peak RSS when the stage ended, and the rows and bytes it took in and put out.
+    Stages may run concurrently and nest; each is recorded on the thread that ran it. Stages whose name
+    matches a pattern given to configure() are also profiled with cProfile (<stage>.prof) or a stack
+    sampler (<stage>.folded) into the profile directory.
+    """
+    def __init__(self):
+        self.records, self._lock, self._profiling = [], threading.Lock(), False
+        self.profile_patterns, self.sample_patterns, self.profile_dir = [], [], PROFILE_DIR
+        self.epoch = time.perf_counter()
+
+    def configure(self, profile=(), sample=(), profile_dir=PROFILE_DIR):
+        """`profile` and `sample` are stage name patterns, e.g. ['transform.*', 'fact_claims']."""
+        self.profile_patterns, self.sample_patterns, self.profile_dir = list(profile or []), list(sample or []), profile_dir
+
+    def merge(self, records):
+        """Adds the records of stages that ran in a worker process. perf_counter is a system-wide
+        monotonic clock, so their start times line up with this process's."""
+        with self._lock:
+            self.records.extend(records)
+
+    def reset(self):
+        with self._lock:
+            self.records = []
+            self.epoch = time.perf_counter()
+
+    @staticmethod
+    def _matches(name, patterns):
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+    def _profile_path(self, name, suffix):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        return os.path.join(self.profile_dir, f"{name.replace(os.sep, '_')}{suffix}")
+
+    @contextmanager
+    def stage(self, name, category=None, table=None):
+        """Times the enclosed block as stage `name`; yields its StageRecord for input()/output()."""
+        record = StageRecord(name, category or name.split('.')[0], table)
+        profile = sampler = None
+        if self._matches(name, self.profile_patterns):
+            with self._lock:  # Only one cProfile can be active at a time, e.g. for nested or concurrent stages.
+                profile, self._profiling = (cProfile.Profile(), True) if not self._profiling else (None, True)
+            if profile is None:
+                logging.warning(f"  > Cannot cProfile '{name}' while another stage is being profiled.")
+            else:
+                profile.enable()
+        if self._matches(name, self.sample_patterns):
+            sampler = _StackSampler(record.thread_id)
+            sampler.start()
+        record.start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield record
+            record.status = 'ok'
+        except BaseException:
+            record.status = 'failed'
+            raise
+        finally:
+            record.wall_s = time.perf_counter() - record.start
+            record.cpu_s = time.thread_time() - cpu_start
+            record.peak_rss_mb = peak_rss_mb()
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(self._profile_path(name, '.prof'))
+                self._profiling = False
+            if sampler is not None:
+                sampler.stop()
+                with open(self._profile_path(name, '.folded'), 'w') as f:
+                    f.writelines(f"{stack} {count}\n" for stack, count in sampler.stacks.most_common())
+            with self._lock:
+                self.records.append(record)
+
+    def instrument(self, name, category=None, output=None):
+        """
+        Decorator form of stage(). `name` may use the call's arguments, e.g. 'scd.{self.name}'.
+        The first DataFrame, Arrow table or dict of them among the arguments is taken as the stage
+        input and the return value (or `output(return_value)`) as its output.
+        """
+        def decorator(func):
+            signature = inspect.signature(func)
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                bound = signature.bind(*args, **kwargs)
+                with self.stage(name.format(**bound.arguments), category) as record:
+                    inputs = [size for size in map(measure, bound.arguments.values()) if size is not None]
+                    if inputs: record.input(rows=inputs[0][0], nbytes=inputs[0][1])
+                    result = func(*args, **kwargs)
+                    record.output(output(result) if output else result)
+                    return result
+            return wrapper
+        return decorator
+
+    def report(self) -> dict:
+        """The run report: every stage record, with start times relative to the start of the run."""
+        with self._lock:
+            records = sorted(self.records, key=lambda r: r.start)
+        stages = [dict(record.as_dict(), start=round(record.start - self.epoch, 6)) for record in records]
+        return {'created': time.time(), 'pid': os.getpid(), 'peak_rss_mb': peak_rss_mb(), 'stages': stages}
+
+    def trace(self) -> dict:
+        """The run as a Chrome trace (chrome://tracing, Perfetto): one complete event per stage, one row per process and thread."""
+        with self._lock:
+            records = list(self.records)
+        events, threads = [], {}
+        for record in records:
+            threads[(record.pid, record.thread_id)] = record.thread_name
+            args = {key: value for key, value in record.as_dict().items() if key not in ('name', 'category', 'start', 'pid', 'thread_name')}
+            events.append({'name': record.name, 'cat': record.category, 'ph': 'X', 'pid': record.pid, 'tid': record.thread_id,
+                           'ts': (record.start - self.epoch) * 1e6, 'dur': record.wall_s * 1e6, 'args': args})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for (pid, tid), name in threads.items()]
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def export(self, report_path=RUN_REPORT_FILE, trace_path=TRACE_FILE):
+        """Writes the JSON run report and the Chrome trace, and logs the slowest stages."""
+        for path, content in [(report_path, self.report()), (trace_path, self.trace())]:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(content, f, indent=1, default=str)
+        logging.info(f"--- Run report saved to '{report_path}', trace to '{trace_path}'. Slowest stages:")
+        for record in sorted(self.records, key=lambda r: -r.wall_s)[:10]:
+            rows = f", {record.rows_in} -> {record.rows_out} rows" if record.rows_out is not None else ""
+            logging.info(f"  > {record.name}: {record.wall_s:.2f}s wall, {record.cpu_s:.2f}s CPU{rows}")
+
+# The profiler of this process. The pipeline modules record into it; scripts export it when they finish.
+profiler = RunProfiler()
+stage = profiler.stage
+instrument = profiler.instrument
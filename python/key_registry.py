@@ -0,0 +1,142 @@
+# SURROGATE KEY REGISTRY: Stable natural-key -> surrogate-key mappings persisted between runs
+import pandas as pd
+import numpy as np
+import logging
+import glob
+import os
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+KEY_REGISTRY_DIR = './Data/key_registry'
+
+# Natural key and surrogate key column of every registered dimension. Versioned dimensions are
+# tracked with SCD Type 2, so each (natural key, version) pair gets its own surrogate key.
+DIMENSION_KEYS = {
+    'patients': {'natural_key': ['unified_patient_id'], 'surrogate_key': 'patient_sk', 'versioned': True},
+    'providers': {'natural_key': ['ProviderID', 'source_hospital'], 'surrogate_key': 'provider_sk', 'versioned': True},
+    'departments': {'natural_key': ['DeptID', 'source_hospital'], 'surrogate_key': 'department_sk', 'versioned': False},
+    'procedures': {'natural_key': ['ProcedureCode'], 'surrogate_key': 'procedure_sk', 'versioned': False},
+}
+
+class KeyRegistry:
+    """
+    An append-only, on-disk map from a dimension's natural key to its surrogate key.
+    Existing members always get back the key they were first given; only members never
+    seen before are allocated new keys, which are appended as a new part file.
+    """
+    def __init__(self, name, natural_key, surrogate_key, versioned=False, registry_dir=KEY_REGISTRY_DIR):
+        self.name, self.surrogate_key = name, surrogate_key
+        self.key_columns = list(natural_key) + (['version'] if versioned else [])
+        self.path = os.path.join(registry_dir, name)
+        self._lock = threading.Lock()
+        parts = sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+        if parts:
+            self.keys = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+            if 'version' in self.key_columns and 'version' not in self.keys.columns:
+                self.keys['version'] = 1  # Registered before the dimension became versioned.
+        else:
+            self.keys = pd.DataFrame({col: pd.Series(dtype=object) for col in self.key_columns} | {surrogate_key: pd.Series(dtype=np.int64)})
+        self._parts = len(parts)
+        self._build_index()
+
+    def _members_index(self, members: pd.DataFrame) -> pd.Index:
+        frame = members[self.key_columns]
+        frame = frame.astype({col: frame[col].cat.categories.dtype for col in frame.columns if isinstance(frame[col].dtype, pd.CategoricalDtype)})
+        return pd.Index(frame.iloc[:, 0]) if len(self.key_columns) == 1 else pd.MultiIndex.from_frame(frame)
+
+    def _build_index(self):
+        self._index = self._members_index(self.keys)
+        self._values = self.keys[self.surrogate_key].to_numpy(dtype=np.int64)
+
+    def _with_version(self, members: pd.DataFrame) -> pd.DataFrame:
+        # Rows coming straight from extraction describe the first version of a member.
+        if 'version' in self.key_columns and 'version' not in members.columns:
+            members = members.assign(version=1)
+        return members
+
+    def lookup(self, members: pd.DataFrame) -> np.ndarray:
+        """Vectorized bulk lookup. Returns the surrogate key of every row, or -1 for unknown members."""
+        positions = self._index.get_indexer(self._members_index(self._with_version(members)))
+        return np.where(positions >= 0, self._values.take(positions, mode='clip') if len(self._values) else -1, -1)
+
+    def assign(self, members: pd.DataFrame) -> np.ndarray:
+        """Returns the surrogate key of every row, allocating keys for new members first."""
+        members = self._with_version(members)
+        with self._lock:
+            sks = self.lookup(members)
+            unknown = sks < 0
+            if unknown.any():
+                new_members = members.loc[unknown, self.key_columns].drop_duplicates().reset_index(drop=True)
+                next_key = int(self._values.max()) + 1 if len(self._values) else 0
+                new_members[self.surrogate_key] = np.arange(next_key, next_key + len(new_members), dtype=np.int64)
+                os.makedirs(self.path, exist_ok=True)
+                new_members.to_parquet(os.path.join(self.path, f"part-{self._parts:05d}.parquet"), index=False)
+                self._parts += 1
+                self.keys = new_members if self.keys.empty else pd.concat([self.keys, new_members], ignore_index=True)
+                self._build_index()
+                logging.info(f"  > Key registry '{self.name}': allocated {len(new_members)} new keys ({len(self.keys)} total).")
+                sks = self.lookup(members)
+        return sks
+
+def open_registry(name, registry_dir=KEY_REGISTRY_DIR) -> KeyRegistry:
+    """Opens the registry of one of the DIMENSION_KEYS dimensions."""
+    config = DIMENSION_KEYS[name]
+    return KeyRegistry(name, config['natural_key'], config['surrogate_key'], config['versioned'], registry_dir)
+
+# Dimension keys remembered per fact row, for facts that resolve their keys through another fact.
+# Claims find their patient through their transaction, but an incremental run extracts only the
+# transactions that changed, so every transaction ever staged keeps its patient_sk here.
+FACT_KEY_MAPS = {
+    'transaction_patients': {'natural_key': ['TransactionID', 'source_hospital'], 'values': ['patient_sk']},
+}
+
+class FactKeyMap:
+    """
+    An append-only, on-disk map from a fact's natural key to dimension keys resolved for it. Facts can
+    be re-extracted with new keys (a corrected patient, a later SCD version), so unlike the KeyRegistry
+    the latest part holding a key wins. update() appends only the rows that are new or changed.
+    """
+    def __init__(self, name, natural_key, values, registry_dir=KEY_REGISTRY_DIR):
+        self.name, self.key_columns, self.value_columns = name, list(natural_key), list(values)
+        self.path = os.path.join(registry_dir, name)
+        self._lock = threading.Lock()
+        parts = sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+        if parts:
+            rows = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+            self.rows = rows.drop_duplicates(self.key_columns, keep='last', ignore_index=True)
+        else:
+            self.rows = pd.DataFrame({col: pd.Series(dtype=object) for col in self.key_columns} | {col: pd.Series(dtype='Int64') for col in self.value_columns})
+        self._parts = len(parts)
+
+    def _plain(self, frame: pd.DataFrame) -> pd.DataFrame:
+        frame = frame[self.key_columns + self.value_columns].reset_index(drop=True)
+        return frame.astype({col: object for col in self.key_columns} | {col: 'Int64' for col in self.value_columns})
+
+    def _index(self, frame: pd.DataFrame) -> pd.Index:
+        return pd.Index(frame[self.key_columns[0]]) if len(self.key_columns) == 1 else pd.MultiIndex.from_frame(frame[self.key_columns])
+
+    def update(self, rows: pd.DataFrame) -> pd.DataFrame:
+        """Records the keys of `rows` and returns the map with them: every fact ever recorded, one row per natural key."""
+        rows = self._plain(rows).drop_duplicates(self.key_columns, keep='last', ignore_index=True)
+        with self._lock:
+            positions = self._index(self.rows).get_indexer(self._index(rows))
+            changed = positions < 0
+            for col in self.value_columns if len(self.rows) else []:
+                old = self.rows[col].take(positions.clip(0)).reset_index(drop=True)
+                same = (old == rows[col]).fillna(False) | (old.isna() & rows[col].isna())
+                changed |= ~same.to_numpy(dtype=bool)
+            if changed.any():
+                new_rows = rows[changed].reset_index(drop=True)
+                os.makedirs(self.path, exist_ok=True)
+                new_rows.to_parquet(os.path.join(self.path, f"part-{self._parts:05d}.parquet"), index=False)
+                self._parts += 1
+                kept = self.rows[~self._index(self.rows).isin(self._index(new_rows))] if len(self.rows) else self.rows
+                self.rows = new_rows if kept.empty else pd.concat([kept, new_rows], ignore_index=True)
+                logging.info(f"  > Fact key map '{self.name}': recorded {len(new_rows)} new or changed rows ({len(self.rows)} total).")
+            return self.rows
+
+def open_fact_map(name, registry_dir=KEY_REGISTRY_DIR) -> FactKeyMap:
+    """Opens one of the FACT_KEY_MAPS."""
+    config = FACT_KEY_MAPS[name]
+    return FactKeyMap(name, config['natural_key'], config['values'], registry_dir)
@@ -1,15 +1,354 @@
-import pandas as pd
+# PHASE 6: LOAD (Parallel direct-file load of the staged star schema into BigQuery)
+import pyarrow as pa
+import pyarrow.parquet as pq
 import logging
+import json
 import os
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
 from google.cloud.exceptions import NotFound
 
+from dimensional_modeling import DATE_DIM_START, DATE_DIM_END
+from scd_implementation import SCD_DIMENSIONS, history_parts
+from staging import STAGING_DIR, PARTITION_COLUMNS, list_tables, table_path, read_table, staged_incrementally
+from rollups import ROLLUPS
+from instrumentation import instrument, stage, profiler
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
 
 PROJECT_ID = 'healthcare-rcm-project'
 DATASET_ID = 'healthcare_rcm'
 KEY_FILE_PATH = r"C:\Users\durga\OneDrive\Pictures\Screenshots\healthcare-rcm-project-9b2d25a8f32a.json"
-STAGING_DIR = r'C:\Users\durga\OneDrive\Desktop\HealthCare Revenue Recycle\Data\staging'
+LOAD_WORKERS = 4  # Files uploaded concurrently; BigQuery then runs the load jobs in parallel.
+POLL_INTERVAL = 1.0  # Seconds between status checks of the outstanding load jobs.
+LOAD_STATE_FILE = './Data/load_state.json'
+
+# --- Define Schemas that EXACTLY match your Parquet files ---
+TABLE_SCHEMAS = {
+    'dim_patients': [
+        bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("unified_patient_id", "STRING"),
+        bigquery.SchemaField("enterprise_patient_id", "STRING"),
+        bigquery.SchemaField("FirstName", "STRING"), bigquery.SchemaField("LastName", "STRING"),
+        bigquery.SchemaField("Gender", "STRING"), bigquery.SchemaField("age", "FLOAT"),
+        bigquery.SchemaField("Address", "STRING"), bigquery.SchemaField("source_hospital", "STRING"),
+        bigquery.SchemaField("version", "INTEGER"), bigquery.SchemaField("effective_date", "DATE"),
+        bigquery.SchemaField("expiry_date", "DATE"), bigquery.SchemaField("is_current", "BOOLEAN"),
+        bigquery.SchemaField("row_hash", "INTEGER")
+    ],
+    'dim_providers': [
+        bigquery.SchemaField("provider_sk", "INTEGER"), bigquery.SchemaField("ProviderID", "STRING"),
+        bigquery.SchemaField("FirstName", "STRING"), bigquery.SchemaField("LastName", "STRING"),
+        bigquery.SchemaField("Specialization", "STRING"), bigquery.SchemaField("DepartmentName", "STRING"),
+        bigquery.SchemaField("NPI", "INTEGER"), bigquery.SchemaField("source_hospital", "STRING"),
+        bigquery.SchemaField("version", "INTEGER"), bigquery.SchemaField("effective_date", "DATE"),
+        bigquery.SchemaField("expiry_date", "DATE"), bigquery.SchemaField("is_current", "BOOLEAN"),
+        bigquery.SchemaField("row_hash", "INTEGER")
+    ],
+    'dim_procedures': [
+        bigquery.SchemaField("procedure_sk", "INTEGER"), bigquery.SchemaField("ProcedureCode", "INTEGER"),
+        bigquery.SchemaField("ProcedureDescription", "STRING"), bigquery.SchemaField("ProcedureCategory", "STRING"),
+        bigquery.SchemaField("CodeStatus", "STRING")
+    ],
+    'dim_date': [
+        bigquery.SchemaField("date_sk", "INTEGER"), bigquery.SchemaField("full_date", "DATE"),
+        bigquery.SchemaField("year", "INTEGER"), bigquery.SchemaField("month", "INTEGER"),
+        bigquery.SchemaField("quarter", "INTEGER"), bigquery.SchemaField("day_of_week", "STRING"),
+        bigquery.SchemaField("day_of_month", "INTEGER"), bigquery.SchemaField("month_name", "STRING"),
+        bigquery.SchemaField("iso_week", "INTEGER"), bigquery.SchemaField("week_start_date", "DATE"),
+        bigquery.SchemaField("is_weekend", "BOOLEAN"), bigquery.SchemaField("holiday_name", "STRING"),
+        bigquery.SchemaField("is_holiday", "BOOLEAN"), bigquery.SchemaField("fiscal_year", "INTEGER"),
+        bigquery.SchemaField("fiscal_month", "INTEGER"), bigquery.SchemaField("fiscal_quarter", "INTEGER")
+    ],
+    'dim_departments': [
+        bigquery.SchemaField("department_sk", "INTEGER"), bigquery.SchemaField("DeptID", "STRING"),
+        bigquery.SchemaField("Name", "STRING"), bigquery.SchemaField("source_hospital", "STRING"),
+    ],
+    'fact_transactions': [
+        bigquery.SchemaField("TransactionID", "STRING"), bigquery.SchemaField("EncounterID", "STRING"),
+        bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("provider_sk", "INTEGER"),
+        bigquery.SchemaField("procedure_sk", "INTEGER"), bigquery.SchemaField("date_sk", "INTEGER"),
+        bigquery.SchemaField("paid_date_sk", "INTEGER"),
+        bigquery.SchemaField("Amount", "FLOAT"), bigquery.SchemaField("PaidAmount", "FLOAT"),
+        bigquery.SchemaField("source_hospital", "STRING"), bigquery.SchemaField("service_year", "INTEGER"),
+        bigquery.SchemaField("service_month", "INTEGER")
+        # REMOVED: The 'ServiceDate' column, as it does not exist in the file.
+    ],
+    'fact_claims': [
+        bigquery.SchemaField("ClaimID", "STRING"), bigquery.SchemaField("TransactionID", "STRING"),
+        bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("date_sk", "INTEGER"),
+        bigquery.SchemaField("claim_date_sk", "INTEGER"),
+        bigquery.SchemaField("ClaimAmount", "FLOAT"), bigquery.SchemaField("PaidAmount", "FLOAT"),
+        bigquery.SchemaField("ClaimStatus", "STRING"), bigquery.SchemaField("PayorType", "STRING"),
+        bigquery.SchemaField("Deductible", "FLOAT"), bigquery.SchemaField("Coinsurance", "FLOAT"),
+        bigquery.SchemaField("Copay", "FLOAT"), bigquery.SchemaField("days_to_payment", "FLOAT"),
+        bigquery.SchemaField("source_hospital", "STRING"), bigquery.SchemaField("service_year", "INTEGER"),
+        bigquery.SchemaField("service_month", "INTEGER")
+        # REMOVED: The 'ServiceDate' column, as it does not exist in the file.
+    ],
+    'agg_claims_monthly': [
+        bigquery.SchemaField("source_hospital", "STRING"), bigquery.SchemaField("PayorType", "STRING"),
+        bigquery.SchemaField("ClaimStatus", "STRING"), bigquery.SchemaField("service_year", "INTEGER"),
+        bigquery.SchemaField("service_month", "INTEGER"), bigquery.SchemaField("claim_count", "INTEGER"),
+        bigquery.SchemaField("claim_amount", "FLOAT"), bigquery.SchemaField("paid_amount", "FLOAT"),
+        bigquery.SchemaField("days_to_payment_sum", "FLOAT"), bigquery.SchemaField("days_to_payment_count", "INTEGER")
+    ],
+    'agg_patient_lifetime': [
+        bigquery.SchemaField("unified_patient_id", "STRING"), bigquery.SchemaField("claim_count", "INTEGER"),
+        bigquery.SchemaField("claim_amount", "FLOAT"), bigquery.SchemaField("paid_amount", "FLOAT")
+    ],
+    'agg_procedures_monthly': [
+        bigquery.SchemaField("procedure_sk", "INTEGER"), bigquery.SchemaField("source_hospital", "STRING"),
+        bigquery.SchemaField("service_year", "INTEGER"), bigquery.SchemaField("service_month", "INTEGER"),
+        bigquery.SchemaField("transaction_count", "INTEGER"), bigquery.SchemaField("amount", "FLOAT"),
+        bigquery.SchemaField("paid_amount", "FLOAT")
+    ]
+}
+
+CLUSTERING_FIELDS = {
+    'fact_transactions': ['patient_sk'],
+    'fact_claims': ['patient_sk'],
+    'dim_patients': ['unified_patient_id', 'is_current'],
+}
+# date_sk is an integer YYYYMMDD key, so facts use integer-range partitioning on it with
+# one partition per month (an interval of 100 covers DD 00-99) over the dim_date calendar.
+DATE_KEY_PARTITIONING = {'fact_transactions': 'date_sk', 'fact_claims': 'date_sk'}
+
+# Upsert keys of the incremental load. Source IDs repeat across hospitals, so facts are keyed
+# per hospital. SCD dimensions are keyed per version and only their closing columns ever change.
+PRIMARY_KEYS = {
+    'fact_transactions': ['TransactionID', 'source_hospital'],
+    'fact_claims': ['ClaimID', 'source_hospital'],
+    'dim_patients': ['patient_sk', 'version'],
+    'dim_providers': ['provider_sk', 'version'],
+    'dim_procedures': ['procedure_sk'],
+    'dim_date': ['date_sk'],
+    # Rollups are keyed on their group columns; the staged rollups are whole, so every changed group is upserted.
+    **{name: spec['group_by'] for name, spec in ROLLUPS.items()},
+}
+SCD_UPDATE_COLUMNS = ['expiry_date', 'is_current']
+
+class LoadState:
+    """Persists how many SCD history parts of each dimension are already in the warehouse.
+    Loads of different tables may run concurrently, so save() merges only the entries this
+    instance changed into the file on disk."""
+    _lock = threading.Lock()
+    def __init__(self, path=LOAD_STATE_FILE):
+        self.path = path
+        self.loaded_parts, self.changed = self._read(), {}
+    def _read(self):
+        if not os.path.exists(self.path): return {}
+        with open(self.path) as f:
+            return json.load(f)
+    def mark_loaded(self, table_name, parts):
+        self.loaded_parts[table_name] = self.changed[table_name] = parts
+    def save(self):
+        with LoadState._lock:
+            merged = {**self._read(), **self.changed}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(merged, f, indent=2, sort_keys=True)
+
+def upsert_sql(dialect, target, source, table_name) -> str:
+    """
+    Upserts every row of `source` into `target` on the table's PRIMARY_KEYS: matched rows get the
+    update columns of the source row, the others are inserted. BigQuery runs it as one MERGE; the
+    local SQLite stand-in has no MERGE, so it gets the equivalent INSERT ... ON CONFLICT DO UPDATE.
+    """
+    keys = PRIMARY_KEYS[table_name]
+    columns = [field.name for field in TABLE_SCHEMAS[table_name]]
+    updates = SCD_UPDATE_COLUMNS if table_name in SCD_DIMENSIONS else [col for col in columns if col not in keys]
+    if dialect == 'sqlite':
+        return (f'CREATE UNIQUE INDEX IF NOT EXISTS "{target}__pk" ON "{target}" ({", ".join(keys)});\n'
+                f'INSERT INTO "{target}" ({", ".join(columns)}) SELECT {", ".join(columns)} FROM "{source}" WHERE true\n'
+                f'ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {", ".join(f"{col} = excluded.{col}" for col in updates)};')
+    return (f"MERGE `{target}` T USING `{source}` S ON {' AND '.join(f'T.{key} = S.{key}' for key in keys)}\n"
+            f"WHEN MATCHED THEN UPDATE SET {', '.join(f'{col} = S.{col}' for col in updates)}\n"
+            f"WHEN NOT MATCHED THEN INSERT ({', '.join(columns)}) VALUES ({', '.join(f'S.{col}' for col in columns)})")
+
+def job_config_for(table_name, write_disposition="WRITE_TRUNCATE") -> bigquery.LoadJobConfig:
+    job_config = bigquery.LoadJobConfig(
+        schema=TABLE_SCHEMAS[table_name],
+        source_format=bigquery.SourceFormat.PARQUET,
+        write_disposition=write_disposition,
+    )
+    if table_name in CLUSTERING_FIELDS:
+        job_config.clustering_fields = CLUSTERING_FIELDS[table_name]
+    if table_name in DATE_KEY_PARTITIONING:
+        first_month = int(DATE_DIM_START.replace('-', '')) // 100 * 100
+        last_month = int(DATE_DIM_END.replace('-', '')) // 100 * 100 + 100
+        job_config.range_partitioning = bigquery.RangePartitioning(
+            field=DATE_KEY_PARTITIONING[table_name],
+            range_=bigquery.PartitionRange(start=first_month, end=last_month, interval=100),
+        )
+    return job_config
+
+def _cast_dates(table: pa.Table, table_name) -> pa.Table:
+    """Casts the timestamp columns that TABLE_SCHEMAS declares as DATE to Arrow dates."""
+    for field in TABLE_SCHEMAS[table_name]:
+        if field.field_type == 'DATE' and field.name in table.column_names:
+            i = table.schema.get_field_index(field.name)
+            table = table.set_column(i, field.name, table.column(i).cast(pa.date32()))
+    return table
+
+def prepare_upload(table_name, staging_dir=STAGING_DIR, work_dir=None):
+    """
+    Returns the path of a Parquet file holding the table exactly as TABLE_SCHEMAS declares it.
+    A staged single file that already matches is uploaded as is. Otherwise the table is read as
+    Arrow (never pandas): partition columns are materialized from the directory names and
+    timestamps declared as DATE are cast to dates, then it is written to one file in `work_dir`.
+    """
+    path = table_path(table_name, staging_dir)
+    date_fields = {field.name for field in TABLE_SCHEMAS[table_name] if field.field_type == 'DATE'}
+    if table_name not in PARTITION_COLUMNS:
+        file_schema = pq.read_schema(path)
+        if all(pa.types.is_date32(file_schema.field(name).type) for name in date_fields if name in file_schema.names):
+            return path
+    table = _cast_dates(read_table(table_name, staging_dir, as_arrow=True), table_name)
+    upload_path = os.path.join(work_dir or tempfile.gettempdir(), f"{table_name}.parquet")
+    pq.write_table(table, upload_path, compression='zstd')
+    return upload_path
+
+def prepare_delta(table_name, staging_dir, work_dir, state: LoadState):
+    """
+    Returns the path of a file with the rows this run changed, or None when nothing changed.
+    Staged facts already hold only the extracted delta, and the small non-SCD dimensions are sent
+    whole. SCD dimensions send only the history parts appended since the last load, keeping the
+    latest write of each version, since a version can be opened in one part and expired in a later one.
+    """
+    if table_name not in SCD_DIMENSIONS:
+        return prepare_upload(table_name, staging_dir, work_dir)
+    new_parts = history_parts(table_name, staging_dir)[state.loaded_parts.get(table_name, 0):]
+    if not new_parts: return None
+    table = pa.concat_tables([pq.read_table(p) for p in new_parts])
+    keys = table.select(PRIMARY_KEYS[table_name]).to_pandas()
+    table = _cast_dates(table.filter(pa.array(~keys.duplicated(keep='last').to_numpy())), table_name)
+    upload_path = os.path.join(work_dir, f"{table_name}__delta.parquet")
+    pq.write_table(table.select([field.name for field in TABLE_SCHEMAS[table_name]]), upload_path, compression='zstd')
+    return upload_path
+
+def table_exists(client, table_id):
+    try:
+        client.get_table(table_id)
+        return True
+    except NotFound:
+        return False
+
+def submit_load(client, table_name, path, destination=None, write_disposition="WRITE_TRUNCATE"):
+    """Uploads one Parquet file and starts its load job. Returns the job without waiting for it."""
+    full_table_id = destination or f"{client.project}.{DATASET_ID}.{table_name}"
+    logging.info(f"  > Submitting {os.path.basename(path)} ({os.path.getsize(path) / 2**20:.2f} MB) -> '{full_table_id}'...")
+    with open(path, 'rb') as source_file:
+        return client.load_table_from_file(source_file, full_table_id, job_config=job_config_for(table_name, write_disposition))
+
+def wait_for_jobs(jobs: dict, poll_interval=POLL_INTERVAL) -> dict:
+    """Polls all outstanding jobs together until every one has finished.
+    Returns {table_name: error or None}, in completion order."""
+    pending, outcomes = dict(jobs), {}
+    while pending:
+        for table_name, job in list(pending.items()):
+            if not job.done(): continue
+            del pending[table_name]
+            outcomes[table_name] = job.error_result
+            if job.error_result:
+                logging.error(f"  > Job for '{table_name}' FAILED: {job.error_result}")
+            else:
+                logging.info(f"  > Job for '{table_name}' finished ({len(pending)} still running).")
+        if pending: time.sleep(poll_interval)
+    return outcomes
+
+@instrument('load')
+def load_staging(client, staging_dir=STAGING_DIR, tables=None, max_workers=LOAD_WORKERS, poll_interval=POLL_INTERVAL,
+                 incremental=None, state_path=LOAD_STATE_FILE) -> dict:
+    """
+    Loads the staged tables with one load job each. Files are prepared and uploaded on up to
+    `max_workers` threads, largest first, and the jobs run concurrently in the warehouse, so the
+    whole load takes about as long as the largest table. `client` is a bigquery.Client or any
+    object with the same load interface, such as local_bigquery.LocalBigQueryClient.
+
+    With `incremental`, each existing table gets only this run's delta (see prepare_delta) in a
+    `<table>__delta` table, which is then upserted into it on PRIMARY_KEYS, so the bytes written scale
+    with the delta; tables that do not exist yet are loaded in full. Otherwise every table is replaced
+    (WRITE_TRUNCATE). By default the load follows the staging directory: staged facts of an incremental
+    extraction hold only the delta, so they are always upserted, and replacing tables with them is refused.
+    Returns the row count (full loads) or the number of upserted rows (incremental loads) of every table
+    that loaded successfully, 0 for tables without changes; tables that failed to load are missing.
+    """
+    staged_delta = staged_incrementally(staging_dir)
+    if incremental is None:
+        incremental = staged_delta
+    elif not incremental and staged_delta:
+        raise ValueError(f"'{staging_dir}' holds an incremental extraction; replacing the warehouse tables with it would drop "
+                         "their history. Load it incrementally, or stage a full refresh first.")
+    client.create_dataset(f"{client.project}.{DATASET_ID}", exists_ok=True)
+    tables = list(tables or list_tables(staging_dir))
+    for table_name in [t for t in tables if t not in TABLE_SCHEMAS]:
+        logging.warning(f"  > SKIPPING: No schema defined for table '{table_name}'.")
+        tables.remove(table_name)
+    tables.sort(key=lambda t: _staged_bytes(table_path(t, staging_dir)), reverse=True)
+    state = LoadState(state_path)
+    target_id = lambda t: f"{client.project}.{DATASET_ID}.{t}"
+    logging.info(f"Loading {len(tables)} staged tables ({'incremental' if incremental else 'full'}) on {max_workers} workers: {tables}")
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as work_dir, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        def prepare_and_submit(table_name):
+            with stage(f"load.submit.{table_name}", table=table_name) as record:
+                record.input(nbytes=_staged_bytes(table_path(table_name, staging_dir)))
+                if incremental and table_exists(client, target_id(table_name)):
+                    path = prepare_delta(table_name, staging_dir, work_dir, state)
+                    if path is None: return None
+                    destination = target_id(f"{table_name}__delta")
+                else:
+                    path, destination = prepare_upload(table_name, staging_dir, work_dir), target_id(table_name)
+                num_rows = pq.read_metadata(path).num_rows
+                record.output(rows=num_rows, nbytes=os.path.getsize(path))
+                return num_rows, destination, submit_load(client, table_name, path, destination)
+        submitted = {t: result for t, result in zip(tables, pool.map(prepare_and_submit, tables)) if result is not None}
+    loaded, merges = {}, {}
+    for table_name in [t for t in tables if t not in submitted]:
+        logging.info(f"  > '{table_name}' has no changes since the last load.")
+        loaded[table_name] = 0
+    # The delta tables only carry rows into the MERGE; they are dropped whatever its outcome.
+    deltas = [destination for table_name, (_, destination, _) in submitted.items() if destination != target_id(table_name)]
+    try:
+        with stage("load.wait_for_jobs"):
+            outcomes = wait_for_jobs({t: job for t, (_, _, job) in submitted.items()}, poll_interval)
+
+        dialect = getattr(client, 'sql_dialect', 'bigquery')
+        for table_name, (expected_rows, destination, _) in submitted.items():
+            if outcomes[table_name]: continue
+            if destination != target_id(table_name):
+                merges[table_name] = client.query(upsert_sql(dialect, target_id(table_name), destination, table_name))
+                continue
+            found = client.get_table(destination).num_rows
+            if found == expected_rows:
+                logging.info(f"  >  SUCCESS: Validated {found} rows in {table_name}.")
+                loaded[table_name] = found
+            else:
+                logging.error(f"  > FAILED ROW COUNT VALIDATION for {table_name}: Expected {expected_rows}, Found {found}")
+        with stage("load.wait_for_merges"):
+            merge_outcomes = wait_for_jobs(merges, poll_interval)
+        for table_name, error in merge_outcomes.items():
+            if error: continue
+            loaded[table_name] = merges[table_name].num_dml_affected_rows
+            logging.info(f"  >  SUCCESS: Upserted {loaded[table_name]} rows into {table_name} from {submitted[table_name][0]} delta rows.")
+    finally:
+        for destination in deltas:
+            client.delete_table(destination, not_found_ok=True)
+
+    for table_name in SCD_DIMENSIONS:
+        if table_name in loaded:
+            state.mark_loaded(table_name, len(history_parts(table_name, staging_dir)))
+    state.save()
+    logging.info(f"Loaded {len(loaded)}/{len(tables)} tables in {time.perf_counter() - start:.2f}s.")
+    return loaded
+
+def _staged_bytes(path):
+    if os.path.isfile(path): return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
 
 if __name__ == "__main__":
     try:
@@ -19,107 +358,12 @@ if __name__ == "__main__":
         
         logging.info("Authenticating with Google Cloud...")
         client = bigquery.Client.from_service_account_json(KEY_FILE_PATH, project=PROJECT_ID)
-        
-        dataset_ref = client.dataset(DATASET_ID)
-        try:
-            client.get_dataset(dataset_ref)
-        except NotFound:
-            client.create_dataset(dataset_ref)
-        logging.info(f"Successfully connected and ensured dataset '{DATASET_ID}' exists.")
-        
-        # --- Define Schemas that EXACTLY match your Parquet files ---
-        schemas = {
-            'dim_patients': [
-                bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("unified_patient_id", "STRING"),
-                bigquery.SchemaField("FirstName", "STRING"), bigquery.SchemaField("LastName", "STRING"),
-                bigquery.SchemaField("Gender", "STRING"), bigquery.SchemaField("age", "FLOAT"),
-                bigquery.SchemaField("Address", "STRING"), bigquery.SchemaField("source_hospital", "STRING"),
-                bigquery.SchemaField("version", "INTEGER"), bigquery.SchemaField("effective_date", "DATE"),
-                bigquery.SchemaField("expiry_date", "DATE"), bigquery.SchemaField("is_current", "BOOLEAN")
-            ],
-            'dim_providers': [
-                bigquery.SchemaField("provider_sk", "INTEGER"), bigquery.SchemaField("ProviderID", "STRING"),
-                bigquery.SchemaField("FirstName", "STRING"), bigquery.SchemaField("LastName", "STRING"),
-                bigquery.SchemaField("Specialization", "STRING"), bigquery.SchemaField("DepartmentName", "STRING"),
-                bigquery.SchemaField("NPI", "INTEGER"), bigquery.SchemaField("source_hospital", "STRING")
-            ],
-            'dim_procedures': [
-                bigquery.SchemaField("procedure_sk", "INTEGER"), bigquery.SchemaField("ProcedureCode", "INTEGER"),
-                bigquery.SchemaField("ProcedureDescription", "STRING")
-            ],
-            'dim_date': [
-                bigquery.SchemaField("date_sk", "INTEGER"), bigquery.SchemaField("full_date", "DATE"),
-                bigquery.SchemaField("year", "INTEGER"), bigquery.SchemaField("month", "INTEGER"),
-                bigquery.SchemaField("quarter", "INTEGER"), bigquery.SchemaField("day_of_week", "STRING")
-            ],
-            'dim_departments': [
-                bigquery.SchemaField("department_sk", "INTEGER"), bigquery.SchemaField("DeptID", "STRING"),
-                bigquery.SchemaField("Name", "STRING"), bigquery.SchemaField("source_hospital", "STRING"),
-            ],
-            'fact_transactions': [
-                bigquery.SchemaField("TransactionID", "STRING"), bigquery.SchemaField("EncounterID", "STRING"),
-                bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("provider_sk", "INTEGER"),
-                bigquery.SchemaField("procedure_sk", "INTEGER"), bigquery.SchemaField("date_sk", "INTEGER"),
-                bigquery.SchemaField("Amount", "FLOAT"), bigquery.SchemaField("PaidAmount", "FLOAT")
-                # REMOVED: The 'ServiceDate' column, as it does not exist in the file.
-            ],
-            'fact_claims': [
-                bigquery.SchemaField("ClaimID", "STRING"), bigquery.SchemaField("TransactionID", "STRING"),
-                bigquery.SchemaField("patient_sk", "INTEGER"), bigquery.SchemaField("date_sk", "INTEGER"),
-                bigquery.SchemaField("ClaimAmount", "FLOAT"), bigquery.SchemaField("PaidAmount", "FLOAT"),
-                bigquery.SchemaField("ClaimStatus", "STRING"), bigquery.SchemaField("PayorType", "STRING"),
-                bigquery.SchemaField("Deductible", "FLOAT"), bigquery.SchemaField("Coinsurance", "FLOAT"),
-                bigquery.SchemaField("Copay", "FLOAT"), bigquery.SchemaField("days_to_payment", "FLOAT")
-                # REMOVED: The 'ServiceDate' column, as it does not exist in the file.
-            ]
-        }
-        
-        files_to_load = [f for f in os.listdir(STAGING_DIR) if f.endswith('.parquet')]
-        logging.info(f"Found {len(files_to_load)} Parquet files to load: {files_to_load}")
-
-        for filename in files_to_load:
-            table_name = filename.replace('.parquet', '')
-            file_path = os.path.join(STAGING_DIR, filename)
-            
-            logging.info(f"--- Processing: {filename} -> {table_name} ---")
-            
-            if table_name not in schemas:
-                logging.warning(f"  > SKIPPING: No schema defined for table '{table_name}'.")
-                continue
-
-            df = pd.read_parquet(file_path)
-
-            full_table_id = f"{PROJECT_ID}.{DATASET_ID}.{table_name}"
-            job_config = bigquery.LoadJobConfig(
-                schema=schemas[table_name],
-                write_disposition="WRITE_TRUNCATE"
-            )
-            
-            # --- Configure partitioning and clustering ---
-            # REMOVED: Time partitioning because the date column does not exist.
-            if table_name in ['fact_transactions', 'fact_claims']:
-                job_config.clustering_fields = ["patient_sk"]
-            elif table_name == 'dim_patients':
-                job_config.clustering_fields = ["unified_patient_id", "is_current"]
-            
-            for schema_field in schemas[table_name]:
-                if schema_field.name in df.columns and schema_field.field_type == 'DATE':
-                    df[schema_field.name] = pd.to_datetime(df[schema_field.name], errors='coerce')
-            
-            df.replace({pd.NaT: None}, inplace=True)
-
-            logging.info(f"  > Loading {len(df)} rows into BigQuery table '{full_table_id}'...")
-            job = client.load_table_from_dataframe(df, full_table_id, job_config=job_config)
-            job.result()
-            
-            table_info = client.get_table(full_table_id)
-            if len(df) == table_info.num_rows:
-                logging.info(f"  >  SUCCESS: Validated {table_info.num_rows} rows in {table_name}.")
-            else:
-                 logging.error(f"  > FAILED ROW COUNT VALIDATION for {table_name}: Expected {len(df)}, Found {table_info.num_rows}")
+        load_staging(client, incremental=True if '--incremental' in sys.argv else None)
             
         logging.info("<< FINAL LOAD TO BIGQUERY COMPLETE >>")
         print("\n\n Congratulations, buddy! The entire pipeline is complete and all data is in BigQuery! ✅")
         
     except Exception as e:
-        logging.error("<< PIPELINE FAILED >>", exc_info=True)
\ No newline at end of file
+        logging.error("<< PIPELINE FAILED >>", exc_info=True)
+    finally:
+        profiler.export()
@@ -0,0 +1,79 @@
+# LOCAL WAREHOUSE: An in-process, SQLite-backed stand-in for the BigQuery client used by load.py
+import pyarrow.parquet as pq
+import logging
+import sqlite3
+import threading
+import time
+from types import SimpleNamespace
+from google.api_core.exceptions import NotFound
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+class LocalJob:
+    """A finished-after-`seconds` job with the parts of bigquery.LoadJob/QueryJob that the loader uses."""
+    def __init__(self, job_id, destination=None, job_config=None, output_rows=None, num_dml_affected_rows=None, seconds=0.0):
+        self.job_id, self.destination, self.job_config = job_id, destination, job_config
+        self.output_rows, self.num_dml_affected_rows = output_rows, num_dml_affected_rows
+        self.error_result = None
+        self._finishes_at = time.monotonic() + seconds
+    def done(self):
+        return time.monotonic() >= self._finishes_at
+    def result(self):
+        time.sleep(max(0.0, self._finishes_at - time.monotonic()))
+        return self
+
+class LocalBigQueryClient:
+    """
+    Runs the loader against a local SQLite database instead of BigQuery. Uploaded Parquet files
+    become SQLite tables named by their full table id, queries run as SQLite scripts, and every
+    job is recorded in `jobs`. The loader generates SQLite upserts for it (sql_dialect), since
+    SQLite has no MERGE. `job_seconds` makes every job take that long, to exercise concurrent polling.
+    """
+    sql_dialect = 'sqlite'
+
+    def __init__(self, project='local-project', database=':memory:', job_seconds=0.0):
+        self.project, self.job_seconds = project, job_seconds
+        self.connection = sqlite3.connect(database, check_same_thread=False)
+        self.datasets, self.jobs = set(), []
+        self._lock = threading.Lock()
+
+    def _record(self, job_id_prefix, **job):
+        job = LocalJob(f"local-{job_id_prefix}-{len(self.jobs):05d}", seconds=self.job_seconds, **job)
+        self.jobs.append(job)
+        return job
+
+    def create_dataset(self, dataset_id, exists_ok=False):
+        self.datasets.add(dataset_id)
+        return SimpleNamespace(dataset_id=dataset_id)
+
+    def load_table_from_file(self, file_obj, destination, job_config=None):
+        df = pq.read_table(file_obj).to_pandas()
+        truncate = job_config is None or job_config.write_disposition == "WRITE_TRUNCATE"
+        with self._lock:
+            df.to_sql(destination, self.connection, if_exists='replace' if truncate else 'append', index=False)
+            job = self._record('load', destination=destination, job_config=job_config, output_rows=len(df))
+        logging.info(f"  > [local] Load job {job.job_id}: {len(df)} rows -> '{destination}'.")
+        return job
+
+    def query(self, sql):
+        with self._lock:
+            changes_before = self.connection.total_changes
+            self.connection.executescript(sql)
+            return self._record('query', num_dml_affected_rows=self.connection.total_changes - changes_before)
+
+    def delete_table(self, table_id, not_found_ok=False):
+        with self._lock:
+            exists = self.connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table_id,)).fetchone()
+            if not exists:
+                if not_found_ok: return
+                raise NotFound(f"Table {table_id} not found")
+            self.connection.execute(f'DROP TABLE "{table_id}"')
+            self.connection.commit()
+
+    def get_table(self, table_id):
+        with self._lock:
+            try:
+                num_rows = self.connection.execute(f'SELECT COUNT(*) FROM "{table_id}"').fetchone()[0]
+            except sqlite3.OperationalError:
+                raise NotFound(f"Table {table_id} not found")
+        return SimpleNamespace(table_id=table_id, num_rows=num_rows)
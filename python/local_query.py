@@ -0,0 +1,166 @@
+# LOCAL QUERY RUNNER: Runs the BigQuery analysis SQL against the staged Parquet with an embedded DuckDB
+import pandas as pd
+import argparse
+import logging
+import glob
+import json
+import os
+import re
+import time
+
+from staging import STAGING_DIR, PARTITION_COLUMNS, list_tables, table_path, staged_incrementally
+from instrumentation import stage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+ANALYSIS_DIR = './Analysis/Big query'
+QUERY_RESULTS_DIR = './Data/query_results'
+QUERY_REPORT_FILE = './Data/query_results/query_report.json'
+
+# `project.dataset.table` or `dataset.table` references; the table name becomes a local view.
+TABLE_REFERENCE = re.compile(r"`(?:[\w-]+\.)?\w+\.(\w+)`")
+QUERY_TITLE = re.compile(r"^\s*--\s*(Query\s+\d+[^\n]*)", re.MULTILINE)
+
+def rewrite_table_references(sql) -> str:
+    """Points the warehouse table references of a BigQuery statement at the local views."""
+    return TABLE_REFERENCE.sub(lambda match: f'"{match.group(1)}"', sql)
+
+def split_statements(sql) -> list:
+    """Splits a SQL file on the semicolons that end a line; the analysis files hold no other semicolons."""
+    statements = [statement.strip() for statement in re.split(r";[ \t]*(?:\n|$)", sql)]
+    return [s for s in statements if re.sub(r"--[^\n]*", '', s).strip()]
+
+def result_path(results_dir, file_name, title):
+    slug = re.sub(r"\W+", '_', f"{os.path.splitext(file_name)[0]}_{title}").strip('_').lower()
+    return os.path.join(results_dir, f"{slug}.csv")
+
+def analysis_queries(analysis_dir=ANALYSIS_DIR) -> list:
+    """Every statement of the analysis files, as (file name, query title, BigQuery SQL), in file order."""
+    queries = []
+    for path in sorted(p for p in glob.glob(os.path.join(analysis_dir, '*')) if os.path.isfile(p) and not p.endswith('.pdf')):
+        with open(path, encoding='utf-8') as f:
+            statements = split_statements(f.read())
+        for number, sql in enumerate(statements, start=1):
+            title = QUERY_TITLE.search(sql)
+            queries.append((os.path.basename(path), title.group(1).strip() if title else f"statement {number}", sql))
+    return queries
+
+class LocalQueryRunner:
+    """
+    An in-process DuckDB database with one view per staged table, so the BigQuery analysis queries
+    run on the staging Parquet without a load. Partitioned facts are read with hive partitioning,
+    so filters on source_hospital, service_year or service_month skip whole directories, and DuckDB
+    reads only the columns a query uses.
+    """
+    def __init__(self, staging_dir=STAGING_DIR, threads=None):
+        try:
+            import duckdb
+        except ImportError:
+            raise ImportError("The local query runner needs DuckDB: pip install duckdb") from None
+        self.staging_dir = staging_dir
+        self.connection = duckdb.connect()
+        if threads: self.connection.execute(f"SET threads TO {int(threads)}")
+        self.tables = list_tables(staging_dir)
+        for name in self.tables:
+            self.connection.execute(f'CREATE VIEW "{name}" AS SELECT * FROM {self._scan(name)}')
+        logging.info(f"  > Created local views over {len(self.tables)} staged tables: {self.tables}")
+
+    def _scan(self, name):
+        path = table_path(name, self.staging_dir).replace("'", "''")
+        if name in PARTITION_COLUMNS:
+            return f"read_parquet('{os.path.join(path, '**', '*.parquet')}', hive_partitioning = true)"
+        return f"read_parquet('{path}')"
+
+    def query(self, sql) -> pd.DataFrame:
+        """Runs one BigQuery statement locally and returns its result."""
+        return self.connection.execute(rewrite_table_references(sql)).df()
+
+    def run_suite(self, queries, repeats=1, results_dir=None) -> list:
+        """
+        Runs every (file, title, sql) query `repeats` times and reports the best wall time of each,
+        its row count and any error. With `results_dir`, each result is saved there as a CSV file.
+        A failing query is reported and the suite goes on.
+        """
+        report = []
+        for file_name, title, sql in queries:
+            entry = {'file': file_name, 'query': title, 'seconds': None, 'rows': None, 'error': None}
+            try:
+                best = float('inf')
+                for _ in range(repeats):
+                    with stage(f"query.{file_name}.{title}", 'query') as record:
+                        result = self.query(sql)
+                        record.output(result)
+                    best = min(best, record.wall_s)
+                entry.update(seconds=round(best, 4), rows=len(result))
+                logging.info(f"  > {file_name} / {title}: {len(result)} rows in {best:.3f}s")
+                if results_dir:
+                    os.makedirs(results_dir, exist_ok=True)
+                    result.to_csv(result_path(results_dir, file_name, title), index=False)
+            except Exception as e:
+                entry['error'] = str(e).splitlines()[0]
+                logging.error(f"  > {file_name} / {title} FAILED: {entry['error']}")
+            report.append(entry)
+        return report
+
+def run_analysis_suite(staging_dir=STAGING_DIR, analysis_dir=ANALYSIS_DIR, repeats=1, results_dir=QUERY_RESULTS_DIR,
+                       report_path=QUERY_REPORT_FILE, allow_incremental=False) -> list:
+    """
+    Runs every analysis query against the staging directory and saves the timing report. Staging
+    written by an incremental extraction holds only the changed facts, so its revenue and collection
+    figures are not the warehouse's: the suite refuses it (ValueError) unless `allow_incremental` is
+    set, e.g. to time the queries only, and the report records which kind of staging it ran on.
+    """
+    incremental = staged_incrementally(staging_dir)
+    if incremental:
+        message = f"Staging '{staging_dir}' holds an incremental delta, not every fact, so the analysis metrics would cover only the changed rows; stage a --full-refresh run first."
+        if not allow_incremental:
+            logging.error(message)
+            raise ValueError(message)
+        logging.warning(f"  > {message}")
+    runner = LocalQueryRunner(staging_dir)
+    queries = analysis_queries(analysis_dir)
+    logging.info(f"Running {len(queries)} analysis queries locally (best of {repeats})...")
+    start = time.perf_counter()
+    report = runner.run_suite(queries, repeats, results_dir)
+    failed = sum(1 for entry in report if entry['error'])
+    logging.info(f"Ran {len(queries)} queries in {time.perf_counter() - start:.2f}s, {failed} failed.")
+    os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump({'created': time.time(), 'staging_dir': staging_dir, 'incremental': incremental, 'repeats': repeats, 'queries': report}, f, indent=2)
+    logging.info(f"Saved query report to '{report_path}'.")
+    return report
+
+def compare_query_runs(baseline_path, current_path) -> pd.DataFrame:
+    """Joins two saved query reports on (file, query); `slowdown` is current/baseline seconds, flagged
+    above the benchmark REGRESSION_THRESHOLD, and a changed row count is flagged too."""
+    from benchmarks import REGRESSION_THRESHOLD
+    runs = []
+    for path in [baseline_path, current_path]:
+        with open(path) as f:
+            runs.append(pd.DataFrame(json.load(f)['queries']))
+    comparison = runs[0].merge(runs[1], on=['file', 'query'], suffixes=('_baseline', '_current'))
+    comparison['slowdown'] = (comparison['seconds_current'] / comparison['seconds_baseline']).round(2)
+    comparison['regression'] = (comparison['slowdown'] > REGRESSION_THRESHOLD) | (comparison['rows_current'] != comparison['rows_baseline'])
+    return comparison[['file', 'query', 'rows_baseline', 'rows_current', 'seconds_baseline', 'seconds_current', 'slowdown', 'regression']]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the Analysis/Big query SQL files against the staged Parquet with DuckDB.")
+    parser.add_argument('--staging-dir', default=STAGING_DIR)
+    parser.add_argument('--analysis-dir', default=ANALYSIS_DIR)
+    parser.add_argument('--repeats', type=int, default=1, help="Run every query this many times and report the best time.")
+    parser.add_argument('--sql', help="Run this one statement instead of the analysis files, and print its result.")
+    parser.add_argument('--show', action='store_true', help="Print the result of every query.")
+    parser.add_argument('--allow-incremental', action='store_true', help="Run the suite on incrementally extracted staging too (timings only: the metrics cover just the delta).")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'CURRENT'), help="Compare two saved query reports.")
+    args = parser.parse_args()
+    if args.compare:
+        print(compare_query_runs(*args.compare).to_string(index=False))
+    elif args.sql:
+        print(LocalQueryRunner(args.staging_dir).query(args.sql).to_string(index=False))
+    else:
+        report = run_analysis_suite(args.staging_dir, args.analysis_dir, args.repeats, allow_incremental=args.allow_incremental)
+        if args.show:
+            for entry in [e for e in report if not e['error']]:
+                print(f"\n--- {entry['file']} / {entry['query']} ---")
+                print(pd.read_csv(result_path(QUERY_RESULTS_DIR, entry['file'], entry['query'])).to_string(index=False))
+        print(pd.DataFrame(report).to_string(index=False))
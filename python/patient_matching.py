@@ -0,0 +1,329 @@
+# PATIENT MATCHING: Blocked cross-hospital entity resolution behind the enterprise patient ID
+import pandas as pd
+import numpy as np
+import argparse
+import logging
+import glob
+import hmac
+import json
+import os
+import secrets
+import threading
+
+from key_registry import KEY_REGISTRY_DIR
+from instrumentation import instrument, stage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+PATIENT_INDEX_NAME = 'enterprise_patients'  # Kept in the key registry directory, next to the surrogate key registries.
+MATCH_COLUMNS = ['unified_patient_id', 'source_hospital', 'FirstName', 'LastName', 'Gender', 'DOB', 'SSN', 'PhoneNumber']
+ENTERPRISE_ID_PREFIX, ENTERPRISE_ID_DIGITS = 'EP', 10
+MAX_BLOCK_SIZE = 1000  # Larger blocks (a shared family phone, a placeholder DOB) do not discriminate and are skipped.
+# SSN features are HMAC-SHA256 values under a secret key, so the index cannot be brute-forced over the
+# 10^9 possible SSNs without it. The key comes from the environment, or else from a key file created on
+# first use; keep it out of version control and back it up with the index, which is useless without it.
+MATCH_KEY_ENV = 'RCM_PATIENT_MATCH_KEY'
+MATCH_KEY_FILE = './config/patient_match.key'
+KEY_CHECK_FILE = 'match_key.json'  # In the index directory: a fingerprint of the key the index was built with.
+
+# Blocking passes: a candidate pair is two patients of different hospitals sharing all the keys of at
+# least one pass. Each pass catches the matches another one misses: a typo in the SSN, a changed last
+# name, a missing phone number. Rows with a missing key do not take part in that pass.
+BLOCKING_KEYS = {
+    'dob_soundex': ['dob', 'last_soundex'],
+    'ssn_suffix': ['ssn_suffix', 'birth_year'],
+    'phone': ['phone'],
+}
+# Score of a candidate pair: the weight of every agreeing field, names weighted by their similarity,
+# minus the penalty of disagreeing identifiers. Fields missing on either side count for nothing.
+MATCH_WEIGHTS = {'ssn': 5.0, 'ssn_mismatch': -5.0, 'dob': 2.0, 'dob_mismatch': -2.0, 'last_name': 2.5, 'first_name': 2.0,
+                 'phone': 1.5, 'gender_mismatch': -1.0}
+NAME_SIMILARITY_FLOOR = 0.7  # Jaro-Winkler similarity scoring no name weight; the weight grows linearly up to 1.0.
+MATCH_THRESHOLD = 7.0  # e.g. SSN + DOB + last name, or DOB + both names + phone when the SSN is missing.
+
+SOUNDEX_CODES = {letter: digit for digit, letters in {'1': 'BFPV', '2': 'CGJKQSXZ', '3': 'DT', '4': 'L', '5': 'MN', '6': 'R'}.items()
+                 for letter in letters}
+
+def soundex(name) -> str:
+    """American Soundex of an upper-case A-Z name, e.g. ROBERT and RUPERT -> R163."""
+    if not name: return None
+    digits, previous = [], SOUNDEX_CODES.get(name[0], '')
+    for letter in name[1:]:
+        digit = SOUNDEX_CODES.get(letter, '')
+        if digit and digit != previous: digits.append(digit)
+        if letter not in 'HW': previous = digit
+    return (name[0] + ''.join(digits) + '000')[:4]
+
+def jaro_winkler(a, b, prefix_scale=0.1) -> float:
+    if a == b: return 1.0
+    if not a or not b: return 0.0
+    window = max(max(len(a), len(b)) // 2 - 1, 0)
+    a_matched, b_matched = [False] * len(a), [False] * len(b)
+    matches = 0
+    for i, letter in enumerate(a):
+        for j in range(max(0, i - window), min(len(b), i + window + 1)):
+            if not b_matched[j] and b[j] == letter:
+                a_matched[i] = b_matched[j] = True
+                matches += 1
+                break
+    if not matches: return 0.0
+    a_letters = [letter for letter, matched in zip(a, a_matched) if matched]
+    b_letters = [letter for letter, matched in zip(b, b_matched) if matched]
+    transpositions = sum(x != y for x, y in zip(a_letters, b_letters)) // 2
+    jaro = (matches / len(a) + matches / len(b) + (matches - transpositions) / matches) / 3
+    prefix = 0
+    for x, y in zip(a[:4], b[:4]):
+        if x != y: break
+        prefix += 1
+    return jaro + prefix * prefix_scale * (1 - jaro)
+
+def match_key(path=MATCH_KEY_FILE) -> bytes:
+    """The secret key of the SSN features: MATCH_KEY_ENV if set, else the key file, created with a random key when missing."""
+    if os.environ.get(MATCH_KEY_ENV):
+        return os.environ[MATCH_KEY_ENV].encode()
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        try:
+            with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+                f.write(secrets.token_hex(32))
+            logging.warning(f"  > Created a new patient match key in '{path}'; set {MATCH_KEY_ENV} to share one key between machines.")
+        except FileExistsError:
+            pass  # Another process created it first.
+    with open(path) as f:
+        return f.read().strip().encode()
+
+def key_fingerprint(key: bytes) -> str:
+    return hmac.digest(key, b'fingerprint', 'sha256').hex()[:16]
+
+def keyed_hash(values: pd.Series, key: bytes, purpose) -> pd.arrays.IntegerArray:
+    """HMAC-SHA256 of every value under `key`, truncated to an int64 and computed once per distinct value;
+    `purpose` separates the hashes of different fields. Nulls stay null."""
+    digest = lambda value: int.from_bytes(hmac.digest(key, f"{purpose}:{value}".encode(), 'sha256')[:8], 'big', signed=True)
+    return pd.array(_map_distinct(values, digest).to_numpy(), dtype='Int64')
+
+def _map_distinct(series: pd.Series, func) -> pd.Series:
+    """Applies a scalar function once per distinct value; names repeat a lot, so this is a few thousand calls."""
+    codes, uniques = pd.factorize(series)
+    mapped = np.array([func(value) for value in uniques] + [None], dtype=object)
+    return pd.Series(mapped[codes], index=series.index)
+
+def name_similarity(left: pd.Series, right: pd.Series) -> np.ndarray:
+    """Jaro-Winkler similarity of aligned name columns, computed once per distinct pair of differing names."""
+    left, right = left.to_numpy(dtype=object), right.to_numpy(dtype=object)
+    missing = pd.isna(left) | pd.isna(right)
+    similarity = np.where(missing, np.nan, 0.0)
+    equal = ~missing & (left == right)
+    similarity[equal] = 1.0
+    differ = ~missing & ~equal
+    if differ.any():
+        pairs = pd.Series(left[differ] + '|' + right[differ])
+        similarity[differ] = _map_distinct(pairs, lambda pair: jaro_winkler(*pair.split('|'))).to_numpy(dtype=np.float64)
+    return similarity
+
+def match_features(patients: pd.DataFrame, key: bytes = None) -> pd.DataFrame:
+    """
+    The normalized comparison fields of every patient, one row per unified_patient_id: names as A-Z only,
+    DOB as days since the epoch, the SSN and its last four digits as keyed hashes (see keyed_hash; no SSN
+    digits are stored), and the phone as its ten digits without a leading country code or a trailing extension.
+    """
+    key = key or match_key()
+    patients = patients[MATCH_COLUMNS].drop_duplicates('unified_patient_id', keep='last').reset_index(drop=True)
+    features = pd.DataFrame({'unified_patient_id': patients['unified_patient_id'].astype(object),
+                             'source_hospital': patients['source_hospital'].astype(object)})
+    for col, feature in [('FirstName', 'first_name'), ('LastName', 'last_name')]:
+        names = patients[col].astype(object).str.upper().str.replace(r'[^A-Z]', '', regex=True)
+        features[feature] = names.where(names.notna() & (names != '') & (names != 'UNKNOWN'), None)
+    features['last_soundex'] = _map_distinct(features['last_name'], soundex)
+    gender = patients['Gender'].astype(object).str.upper().str[:1]
+    features['gender'] = gender.where(gender.isin(['M', 'F']), None)
+    dob = pd.to_datetime(patients['DOB'], errors='coerce')
+    features['dob'] = (dob - pd.Timestamp('1970-01-01')).dt.days.astype('Int64')
+    features['birth_year'] = dob.dt.year.astype('Int64')
+    ssn = patients['SSN'].astype(object).str.replace(r'\D', '', regex=True)
+    valid = ssn.str.len().eq(9) & ~ssn.isin(['000000000', '999999999', '123456789'])
+    features['ssn_hash'] = keyed_hash(ssn.where(valid, None), key, 'ssn')
+    features['ssn_suffix'] = keyed_hash(ssn.str[-4:].where(valid, None), key, 'ssn_suffix')
+    # PhoneNumber is digits only after cleaning: drop the US country code, then any extension after the ten digits.
+    phone = patients['PhoneNumber'].astype(object).fillna('').str.replace(r'\D', '', regex=True)
+    phone = phone.where(~(phone.str.len().ge(11) & phone.str.startswith('1')), phone.str[1:]).str[:10]
+    features['phone'] = phone.where(phone.str.len() == 10, None)
+    return features
+
+def candidate_pairs(features: pd.DataFrame, is_new: np.ndarray) -> pd.DataFrame:
+    """
+    The (left, right) row pairs of `features` worth comparing: same block in some BLOCKING_KEYS pass,
+    different hospitals, and at least one of the two rows new. Blocks without a new row are dropped
+    before the self-join, so an incremental run only joins the blocks its new patients fall into.
+    """
+    hospital = pd.factorize(features['source_hospital'])[0]
+    pairs = []
+    for name, keys in BLOCKING_KEYS.items():
+        blocked = features[keys].notna().all(axis=1).to_numpy()
+        rows = pd.DataFrame({'row': np.flatnonzero(blocked), 'hospital': hospital[blocked], 'is_new': is_new[blocked]})
+        rows['block'] = features.loc[blocked, keys].groupby(keys, sort=False).ngroup().to_numpy()
+        block = rows.groupby('block')
+        size, has_new, hospitals = block['row'].transform('size'), block['is_new'].transform('any'), block['hospital'].transform('nunique')
+        oversized = rows.loc[size > MAX_BLOCK_SIZE, 'block'].nunique()
+        if oversized: logging.warning(f"  > Blocking pass '{name}': skipped {oversized} blocks of more than {MAX_BLOCK_SIZE} patients.")
+        rows = rows[(size <= MAX_BLOCK_SIZE) & has_new & (hospitals > 1)]
+        joined = rows.merge(rows, on='block', suffixes=('_left', '_right'))
+        joined = joined[(joined['hospital_left'] < joined['hospital_right']) & (joined['is_new_left'] | joined['is_new_right'])]
+        pairs.append(joined[['row_left', 'row_right']])
+        logging.info(f"  > Blocking pass '{name}': {rows['block'].nunique()} blocks, {len(joined)} candidate pairs.")
+    pairs = pd.concat(pairs, ignore_index=True).drop_duplicates(ignore_index=True)
+    return pairs.rename(columns={'row_left': 'left', 'row_right': 'right'})
+
+def score_pairs(features: pd.DataFrame, pairs: pd.DataFrame) -> np.ndarray:
+    """The MATCH_WEIGHTS score of every candidate pair, computed column by column over all pairs at once."""
+    left, right = features.iloc[pairs['left'].to_numpy()], features.iloc[pairs['right'].to_numpy()]
+    def compare(col):
+        a, b = left[col].to_numpy(dtype=object), right[col].to_numpy(dtype=object)
+        both = ~(pd.isna(a) | pd.isna(b))
+        agree = both.copy()
+        agree[both] = a[both] == b[both]
+        return agree, both & ~agree
+    score = np.zeros(len(pairs))
+    for col, weight, penalty in [('ssn_hash', 'ssn', 'ssn_mismatch'), ('dob', 'dob', 'dob_mismatch'), ('phone', 'phone', None), ('gender', None, 'gender_mismatch')]:
+        agree, disagree = compare(col)
+        if weight: score += agree * MATCH_WEIGHTS[weight]
+        if penalty: score += disagree * MATCH_WEIGHTS[penalty]
+    for col in ['first_name', 'last_name']:
+        similarity = name_similarity(left[col], right[col])
+        score += np.nan_to_num(np.clip((similarity - NAME_SIMILARITY_FLOOR) / (1 - NAME_SIMILARITY_FLOOR), 0, 1)) * MATCH_WEIGHTS[col]
+    return score
+
+def connected_components(n, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    """Component label (its smallest row) of each of n rows under the match edges: min-label propagation
+    over all edges at once plus pointer jumping, a few array passes instead of a union-find loop."""
+    labels = np.arange(n)
+    while True:
+        low = np.minimum(labels[left], labels[right])
+        updated = labels.copy()
+        np.minimum.at(updated, left, low)
+        np.minimum.at(updated, right, low)
+        updated = updated[updated]
+        if np.array_equal(updated, labels): return labels
+        labels = updated
+
+def format_enterprise_ids(keys: np.ndarray) -> np.ndarray:
+    ids = ENTERPRISE_ID_PREFIX + pd.Series(keys, dtype=np.int64).astype(str).str.zfill(ENTERPRISE_ID_DIGITS)
+    return ids.to_numpy(dtype=object)
+
+class PatientMatcher:
+    """
+    The enterprise patient index: every unified_patient_id (one hospital's patient) with the enterprise
+    key of the person it belongs to and the match features it was matched on. Like the key registry it is
+    append-only: patients keep the enterprise ID they were first given, and only patients never seen before
+    are matched, against each other and against the indexed patients of the blocks they fall into.
+    A new patient matching several existing persons joins the one with the smallest key; existing persons
+    are never merged or split, so an enterprise ID handed to the warehouse stays valid.
+    The SSN features are only comparable under the key they were hashed with, so the index records the
+    fingerprint of its key and refuses to open under another one.
+    """
+    def __init__(self, index_dir=os.path.join(KEY_REGISTRY_DIR, PATIENT_INDEX_NAME), key=None):
+        self.index_dir, self.key = index_dir, key or match_key()
+        self._lock = threading.Lock()
+        parts = sorted(glob.glob(os.path.join(index_dir, 'part-*.parquet')))
+        self.members = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True) if parts else pd.DataFrame()
+        self._parts = len(parts)
+        if parts: self._check_key(parts)
+        self._build_index()
+
+    def _check_key(self, parts):
+        path = os.path.join(self.index_dir, KEY_CHECK_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                if json.load(f)['fingerprint'] != key_fingerprint(self.key):
+                    raise ValueError(f"The patient index in '{self.index_dir}' was built with a different match key; "
+                                     f"set {MATCH_KEY_ENV} (or {MATCH_KEY_FILE}) to that key.")
+            return
+        # An index from before the SSN features were keyed holds unkeyed SSN hashes and clear last-four
+        # digits. Neither can be re-keyed, so they are erased from its parts; these patients keep their
+        # enterprise IDs and later patients match them on DOB, names and phone only.
+        logging.warning(f"  > Erasing the unkeyed SSN features of {len(self.members)} patients in '{self.index_dir}'.")
+        erase = lambda frame: frame.drop(columns=['ssn_last4'], errors='ignore').assign(
+            **{col: pd.array([None] * len(frame), dtype='Int64') for col in ['ssn_hash', 'ssn_suffix']})
+        self.members = erase(self.members)
+        for path in parts:
+            erase(pd.read_parquet(path)).to_parquet(path + '.tmp', index=False)
+            os.replace(path + '.tmp', path)
+        self._save_key_check()
+
+    def _save_key_check(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        with open(os.path.join(self.index_dir, KEY_CHECK_FILE), 'w') as f:
+            json.dump({'fingerprint': key_fingerprint(self.key)}, f)
+
+    def _build_index(self):
+        ids = self.members['unified_patient_id'] if not self.members.empty else pd.Series(dtype=object)
+        self._index = pd.Index(ids.astype(object))
+        self._keys = self.members['enterprise_key'].to_numpy(dtype=np.int64) if not self.members.empty else np.empty(0, dtype=np.int64)
+
+    def lookup(self, patients: pd.DataFrame) -> np.ndarray:
+        """The enterprise key of every row, or -1 for patients not in the index."""
+        positions = self._index.get_indexer(patients['unified_patient_id'].astype(object))
+        return np.where(positions >= 0, self._keys.take(positions, mode='clip') if len(self._keys) else -1, -1)
+
+    @instrument('transform.match_patients')
+    def match(self, new_features: pd.DataFrame) -> np.ndarray:
+        """Resolves new patients: returns the enterprise key of every row of `new_features`, existing or newly allocated."""
+        existing = self.members.drop(columns='enterprise_key') if not self.members.empty else new_features.iloc[:0]
+        features = pd.concat([existing, new_features], ignore_index=True)
+        is_new = np.arange(len(features)) >= len(existing)
+        with stage('transform.match_patients.score') as record:
+            pairs = candidate_pairs(features, is_new)
+            scores = score_pairs(features, pairs)
+            matched = pairs[scores >= MATCH_THRESHOLD]
+            record.output(matched)
+        labels = connected_components(len(features), matched['left'].to_numpy(), matched['right'].to_numpy())
+        # Every component takes the smallest existing key among its members, or a new key when it has none.
+        component_key = pd.Series(self._keys, index=labels[:len(existing)]).groupby(level=0).min() if len(existing) else pd.Series(dtype=np.int64)
+        new_labels = labels[is_new]
+        keys = component_key.reindex(new_labels).to_numpy(dtype=np.float64, copy=True)
+        unresolved = np.isnan(keys)
+        next_key = int(self._keys.max()) + 1 if len(self._keys) else 0
+        keys[unresolved] = next_key + pd.factorize(new_labels[unresolved])[0]
+        linked = int((~unresolved).sum())
+        logging.info(f"  > Matched {len(new_features)} new patients: {linked} joined existing persons, "
+                     f"{len(new_features) - linked} formed {int(len(np.unique(new_labels[unresolved])))} new persons "
+                     f"({len(matched)} of {len(pairs)} candidate pairs matched).")
+        return keys.astype(np.int64)
+
+    def assign(self, patients: pd.DataFrame) -> np.ndarray:
+        """Returns the enterprise patient ID of every row, matching and indexing unseen patients first."""
+        with self._lock:
+            keys = self.lookup(patients)
+            unknown = keys < 0
+            if unknown.any():
+                new_features = match_features(patients[unknown], self.key)
+                new_features['enterprise_key'] = self.match(new_features)
+                if not self._parts: self._save_key_check()
+                new_features.to_parquet(os.path.join(self.index_dir, f"part-{self._parts:05d}.parquet"), index=False)
+                self._parts += 1
+                self.members = new_features if self.members.empty else pd.concat([self.members, new_features], ignore_index=True)
+                self._build_index()
+                keys = self.lookup(patients)
+        return format_enterprise_ids(keys)
+
+    def summary(self) -> pd.DataFrame:
+        """Persons by the number of hospitals they were seen at."""
+        if self.members.empty: return pd.DataFrame(columns=['hospitals', 'persons', 'patients'])
+        persons = self.members.groupby('enterprise_key').agg(hospitals=('source_hospital', 'nunique'), patients=('unified_patient_id', 'size'))
+        return persons.groupby('hospitals').agg(persons=('patients', 'size'), patients=('patients', 'sum')).reset_index()
+
+def open_matcher(registry_dir=KEY_REGISTRY_DIR) -> PatientMatcher:
+    """Opens the enterprise patient index kept with the key registries in `registry_dir`."""
+    return PatientMatcher(os.path.join(registry_dir, PATIENT_INDEX_NAME))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarizes the enterprise patient index.")
+    parser.add_argument('--registry-dir', default=KEY_REGISTRY_DIR)
+    parser.add_argument('--person', metavar='ENTERPRISE_ID', help="List the hospital patients of this enterprise patient ID.")
+    args = parser.parse_args()
+    matcher = open_matcher(args.registry_dir)
+    if args.person:
+        key = int(args.person[len(ENTERPRISE_ID_PREFIX):])
+        print(matcher.members[matcher.members['enterprise_key'] == key].to_string(index=False))
+    else:
+        print(f"{len(matcher.members)} hospital patients, {matcher.members['enterprise_key'].nunique() if not matcher.members.empty else 0} enterprise patients.")
+        print(matcher.summary().to_string(index=False))
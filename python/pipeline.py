@@ -0,0 +1,289 @@
+# PIPELINE RUNNER: All phases as one dependency graph of stages, run concurrently where independent
+import pandas as pd
+import argparse
+import logging
+import glob
+import os
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from extraction import (DataExtractor, WatermarkStore, DB_CONFIG, HOSPITALS, SOURCE_TABLES, CLAIMS_FOLDER, INCREMENTAL_COLUMNS,
+                        standardize_columns, add_unified_patient_id, concat_frames, claims_source)
+from transform import DataTransformer
+from dimensional_modeling import DimensionalModeler
+from scd_implementation import SCDType2Engine, SCD_DIMENSIONS, scd_versions
+from execution_backend import open_backend, BACKENDS, DEFAULT_BACKEND
+from staging import STAGING_DIR, write_table, mark_extract
+from rollups import RollupMaintainer, ROLLUPS
+from instrumentation import profiler, PROFILE_DIR
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+PIPELINE_CACHE_DIR = './Data/pipeline_cache'
+PIPELINE_WORKERS = 8
+DIMENSIONS = ['dim_patients', 'dim_providers', 'dim_procedures', 'dim_date']
+FACTS = ['fact_transactions', 'fact_claims']
+
+class Stage:
+    """
+    One node of the pipeline graph. `func` receives a dict of the results of its `deps`, keyed by
+    stage name. `group` names the phase, so a phase can be run on its own; results of cacheable
+    stages are pickled so a later sub-graph run can start from them.
+    """
+    def __init__(self, name, group, func, deps=(), cacheable=True):
+        self.name, self.group, self.func, self.deps, self.cacheable = name, group, func, list(deps), cacheable
+
+class PipelineRunner:
+    """Runs a set of stages on a thread pool, starting every stage as soon as all of its dependencies are done."""
+    def __init__(self, stages, cache_dir=PIPELINE_CACHE_DIR, max_workers=PIPELINE_WORKERS, cache_results=True):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir, self.max_workers, self.cache_results = cache_dir, max_workers, cache_results
+        self.timings = {}
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            if missing: raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}.")
+
+    def select(self, names=None) -> list:
+        """Expands stage names and group names into the stages to run; all stages when `names` is empty."""
+        if not names: return list(self.stages)
+        selected = [s for s in self.stages.values() if s.name in names or s.group in names]
+        unknown = set(names) - {s.name for s in selected} - {s.group for s in selected}
+        if unknown: raise ValueError(f"Unknown stages or groups: {sorted(unknown)}")
+        return [s.name for s in selected]
+
+    def _cache_path(self, name):
+        return os.path.join(self.cache_dir, f"{name}.pkl")
+
+    def _load_cached(self, name):
+        path = self._cache_path(name)
+        if not self.stages[name].cacheable or not os.path.exists(path):
+            raise RuntimeError(f"Stage '{name}' is needed as an input but has no cached result; include it in the run.")
+        with open(path, 'rb') as f:
+            logging.info(f"  > Using cached result of '{name}'.")
+            return pickle.load(f)
+
+    def _run_stage(self, stage, inputs):
+        logging.info(f"--- [START] {stage.name} ---")
+        start = time.perf_counter()
+        with profiler.stage(stage.name, stage.group) as record:
+            result = stage.func(inputs)
+            record.output(result)
+        if self.cache_results and stage.cacheable:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self._cache_path(stage.name), 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.timings[stage.name] = time.perf_counter() - start
+        logging.info(f"--- [DONE] {stage.name} in {self.timings[stage.name]:.2f}s ---")
+        return result
+
+    def run(self, names=None) -> dict:
+        """
+        Runs the selected stages and returns their results. Dependencies outside the selection are
+        read from the cache of an earlier run, so e.g. run(['modeling']) rebuilds the star schema
+        from the cached transform outputs without touching the source databases.
+        """
+        selected = self.select(names)
+        results = {}
+        for dep in {dep for name in selected for dep in self.stages[name].deps} - set(selected):
+            results[dep] = self._load_cached(dep)
+        pending, running = set(selected), {}
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                for name in sorted(pending):
+                    if all(dep in results for dep in self.stages[name].deps):
+                        inputs = {dep: results[dep] for dep in self.stages[name].deps}
+                        running[pool.submit(self._run_stage, self.stages[name], inputs)] = name
+                        pending.discard(name)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        logging.error(f"--- [FAILED] {name} ---")
+                        for other in running: other.cancel()
+                        raise
+        logging.info(f"Ran {len(selected)} stages in {time.perf_counter() - start:.2f}s wall clock ({sum(self.timings[n] for n in selected):.2f}s summed over stages).")
+        return results
+
+def build_pipeline(staging_dir=STAGING_DIR, full_refresh=False, client=None, incremental_load=None, backend=DEFAULT_BACKEND) -> list:
+    """
+    Declares every phase as stages:
+      extract.<hospital>.<table>, extract.claims -> integrate.<table> -> transform.<entity>
+      -> dim_*, dim_versions -> fact_* -> validate -> scd.<dimension>, rollups -> stage.<table> -> load.<table>
+    `client` is the warehouse client for the load stages; by default a BigQuery client is
+    created from load.KEY_FILE_PATH the first time a load stage runs. Fact assembly and the SCD match
+    run on the execution `backend` (execution_backend.BACKENDS).
+    An incremental extraction stages only the delta, so it is always upserted into the warehouse;
+    `incremental_load` defaults to that, and tables are only replaced after a `full_refresh`.
+    """
+    if incremental_load is None:
+        incremental_load = not full_refresh
+    elif not incremental_load and not full_refresh:
+        raise ValueError("An incremental extraction stages only the delta and must be loaded incrementally; "
+                         "replacing the warehouse tables needs a full refresh.")
+    transformer, modeler, backend = DataTransformer(), DimensionalModeler(), open_backend(backend)
+    watermarks = WatermarkStore()
+    stages = []
+    add = lambda *args, **kwargs: stages.append(Stage(*args, **kwargs))
+
+    # --- Extraction: one stage per (hospital, table) and one for the claims files ---
+    def connect(_):
+        return DataExtractor(DB_CONFIG), watermarks
+    add('extract.connect', 'extract', connect, cacheable=False)
+
+    def extract_table(db_name, table_name):
+        def run(inputs):
+            extractor, watermarks = inputs['extract.connect']
+            change_columns = INCREMENTAL_COLUMNS.get(table_name)
+            since = None if full_refresh or not change_columns else watermarks.get(db_name, table_name)
+            df = extractor.extract_from_mysql(db_name, table_name, since=since, change_columns=change_columns)
+            if df is None: raise RuntimeError(f"Extraction of '{db_name}.{table_name}' failed.")
+            if change_columns:
+                watermarks.update(db_name, table_name, df, change_columns)
+            df = standardize_columns(db_name, table_name, df)
+            df['source_hospital'] = db_name
+            return df
+        return run
+    for db_name in HOSPITALS:
+        for table_name in SOURCE_TABLES:
+            add(f'extract.{db_name}.{table_name}', 'extract', extract_table(db_name, table_name), ['extract.connect'])
+
+    def extract_claims(inputs):
+        extractor, _ = inputs['extract.connect']
+        claims_dfs = []
+        for file_path in glob.glob(os.path.join(CLAIMS_FOLDER, '*.csv')):
+            source = claims_source(file_path)
+            df = extractor.extract_claims_csv(file_path) if source else None
+            if df is not None:
+                df['source_hospital'] = source
+                claims_dfs.append(df)
+        return concat_frames(claims_dfs) if claims_dfs else pd.DataFrame()
+    add('extract.claims', 'extract', extract_claims, ['extract.connect'])
+
+    # --- Integration and transformation: one stage per entity ---
+    def integrate(table_name):
+        def run(inputs):
+            df = pd.concat([inputs[f'extract.{db_name}.{table_name}'] for db_name in HOSPITALS], ignore_index=True)
+            return add_unified_patient_id(df) if table_name == 'patients' else df
+        return run
+    for table_name in SOURCE_TABLES:
+        add(f'integrate.{table_name}', 'integrate', integrate(table_name), [f'extract.{db_name}.{table_name}' for db_name in HOSPITALS])
+
+    def transform(table_name):
+        def run(inputs):
+            df = inputs[f'integrate.{table_name}']
+            if table_name == 'patients':
+                df = transformer.clean_and_enrich_patients(df)
+            if table_name in ['patients', 'providers', 'departments']:
+                df = transformer.generate_surrogate_keys({table_name: df})[table_name]
+            return transformer.compact_dtypes(df, table_name)
+        return run
+    for table_name in SOURCE_TABLES:
+        add(f'transform.{table_name}', 'transform', transform(table_name), [f'integrate.{table_name}'])
+    add('transform.claims', 'transform', lambda inputs: transformer.compact_dtypes(transformer.clean_and_enrich_claims(inputs['extract.claims']), 'claims'), ['extract.claims'])
+
+    # --- Dimensional modeling ---
+    add('dim_patients', 'modeling', lambda inputs: modeler.build_dim_patients(inputs['transform.patients']), ['transform.patients'])
+    add('dim_providers', 'modeling', lambda inputs: modeler.build_dim_providers(inputs['transform.providers'], inputs['transform.departments']), ['transform.providers', 'transform.departments'])
+    add('dim_procedures', 'modeling', lambda inputs: modeler.build_dim_procedures(inputs['transform.transactions']['ProcedureCode']), ['transform.transactions'])
+    add('dim_date', 'modeling', lambda inputs: modeler.build_dim_date())
+    # Every version of the SCD dimensions, with this run's changes, so facts resolve to the version in
+    # effect on their service date. It reads the staged history, so it is never served from the cache.
+    add('dim_versions', 'modeling', lambda inputs: scd_versions(inputs, staging_dir, modeler.registry_dir), list(SCD_DIMENSIONS), cacheable=False)
+    add('fact_lookups', 'modeling', lambda inputs: backend.create_lookups(modeler, inputs, inputs['dim_versions']), DIMENSIONS + ['dim_versions'], cacheable=False)
+    def fact_transactions(inputs):
+        fact, _ = backend.fact_transactions(modeler, inputs['transform.transactions'], inputs['fact_lookups'])
+        return fact
+    add('fact_transactions', 'modeling', fact_transactions, ['transform.transactions', 'fact_lookups'])
+    def fact_claims(inputs):
+        trans_lookup = modeler.staged_transactions(inputs['fact_transactions'][['TransactionID', 'patient_sk', 'source_hospital']])
+        return backend.fact_claims(modeler, inputs['transform.claims'], trans_lookup, inputs['fact_lookups'])
+    add('fact_claims', 'modeling', fact_claims, ['transform.claims', 'fact_transactions', 'fact_lookups'])
+    def validate(inputs):
+        modeler.log_unmatched_keys()
+        sources = {name: inputs[f'transform.{name}'] for name in ['transactions', 'encounters']}
+        dimensions, facts = modeler.validate_schema({n: inputs[n] for n in FACTS}, {n: inputs[n] for n in DIMENSIONS}, sources=sources, versions=inputs['dim_versions'])
+        return {**dimensions, **facts}
+    add('validate', 'modeling', validate, DIMENSIONS + FACTS + ['dim_versions', 'transform.transactions', 'transform.encounters'])
+
+    # --- SCD Type 2 ---
+    def scd(name):
+        def run(inputs):
+            engine = SCDType2Engine.for_dimension(name, staging_dir=staging_dir, backend=backend)
+            engine.apply(inputs['validate'][name])
+            return engine.load_history()
+        return run
+    for name in SCD_DIMENSIONS:
+        add(f'scd.{name}', 'scd', scd(name), ['validate'])
+
+    # --- Rollups: this run's validated facts are folded into the aggregate tables ---
+    add('rollups', 'rollups', lambda inputs: RollupMaintainer().update({n: inputs['validate'][n] for n in FACTS}), ['validate'])
+
+    # --- Staging and load: every table is written and loaded as soon as its own input is ready ---
+    def stage_table(name, source):
+        def run(inputs):
+            df = inputs[source][name] if source in ('validate', 'rollups') else inputs[source]
+            write_table(df, name, staging_dir)
+            return name
+        return run
+    def load_table(name):
+        def run(inputs):
+            from load import load_staging
+            loaded = load_staging(inputs['load.connect'], staging_dir, tables=[name], incremental=incremental_load)
+            if name not in loaded: raise RuntimeError(f"Loading '{name}' failed.")
+            return loaded
+        return run
+    def connect_warehouse(_):
+        if client is not None: return client
+        from google.cloud import bigquery
+        from load import KEY_FILE_PATH, PROJECT_ID
+        return bigquery.Client.from_service_account_json(KEY_FILE_PATH, project=PROJECT_ID)
+    add('load.connect', 'load', connect_warehouse, cacheable=False)
+    add('stage.manifest', 'stage', lambda _: mark_extract(staging_dir, incremental=not full_refresh), cacheable=False)
+    for name in DIMENSIONS + FACTS + list(ROLLUPS):
+        source = f'scd.{name}' if name in SCD_DIMENSIONS else 'rollups' if name in ROLLUPS else 'validate'
+        add(f'stage.{name}', 'stage', stage_table(name, source), [source], cacheable=False)
+        add(f'load.{name}', 'load', load_table(name), ['load.connect', 'stage.manifest', f'stage.{name}'], cacheable=False)
+    # The advanced watermarks are committed last, once every table is in the warehouse: a run failing
+    # before that leaves the marks where they were, so its rows are extracted again by the next run.
+    add('load.watermarks', 'load', lambda _: watermarks.save(), [s.name for s in stages if s.group == 'load'], cacheable=False)
+    return stages
+
+def run_pipeline(only=None, staging_dir=STAGING_DIR, full_refresh=False, client=None, incremental_load=None,
+                 max_workers=PIPELINE_WORKERS, cache_dir=PIPELINE_CACHE_DIR, backend=DEFAULT_BACKEND) -> dict:
+    """Builds the stage graph and runs it, or only the stages and groups named in `only`."""
+    engine = open_backend(backend)
+    try:
+        stages = build_pipeline(staging_dir, full_refresh, client, incremental_load, engine)
+        return PipelineRunner(stages, cache_dir, max_workers).run(only)
+    finally:
+        if engine is not backend: engine.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Runs the RCM pipeline, or a sub-graph of it, as a stage graph.")
+    parser.add_argument('--only', nargs='+', help="Stage or group names to run (extract, integrate, transform, modeling, scd, rollups, stage, load); "
+                                                  "inputs from outside the selection are read from the cache of an earlier run.")
+    parser.add_argument('--full-refresh', action='store_true', help="Ignore the extraction watermarks.")
+    parser.add_argument('--incremental-load', action=argparse.BooleanOptionalAction, default=None,
+                        help="Upsert deltas into the warehouse instead of replacing tables (the default unless --full-refresh).")
+    parser.add_argument('--workers', type=int, default=PIPELINE_WORKERS)
+    parser.add_argument('--backend', default=DEFAULT_BACKEND, choices=list(BACKENDS), help="Execution backend of fact assembly and the SCD match.")
+    parser.add_argument('--profile', nargs='+', default=[], metavar='PATTERN', help="Run cProfile on the stages matching these patterns, e.g. 'transform.*'.")
+    parser.add_argument('--sample', nargs='+', default=[], metavar='PATTERN', help="Sample the stacks of the stages matching these patterns (collapsed-stack output).")
+    parser.add_argument('--profile-dir', default=PROFILE_DIR, help="Where the run report, trace and profiles are written.")
+    args = parser.parse_args()
+    profiler.configure(args.profile, args.sample, args.profile_dir)
+    try:
+        run_pipeline(args.only, full_refresh=args.full_refresh, incremental_load=args.incremental_load, max_workers=args.workers, backend=args.backend)
+        print("\n" + "="*80)
+        print("✅  SUCCESS: PIPELINE COMPLETE. ")
+        print("="*80)
+    except Exception as e:
+        logging.error("<<<<<<<<<< PIPELINE FAILED >>>>>>>>>>", exc_info=True)
+        sys.exit(1)
+    finally:
+        profiler.export(os.path.join(args.profile_dir, 'run_report.json'), os.path.join(args.profile_dir, 'run_trace.json'))
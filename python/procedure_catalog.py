@@ -0,0 +1,155 @@
+# PROCEDURE CATALOG: The CPT code reference, compiled once into a memory-mapped binary index
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+CPT_CATALOG_FILE = './Data/cptcode/cptcodes.csv'
+CPT_INDEX_FILE = './Data/cptcode/cptcodes.index.arrow'
+CPT_CODE_LENGTH = 5  # CPT codes are five characters: digits, or four digits and a letter (Category II/III, e.g. 0585T).
+CATALOG_COLUMNS = {'Procedure Code Category': 'ProcedureCategory', 'CPT Codes': 'ProcedureCode',
+                   'Procedure Code Descriptions': 'ProcedureDescription', 'Code Status': 'CodeStatus'}
+NO_CODE = 0  # Key of a null or malformed code; no real code packs to 0, since '0' is byte 48.
+
+def encode_codes(codes) -> np.ndarray:
+    """
+    Packs CPT codes into uint64 keys, the five ASCII bytes of the zero-padded code big-endian, so keys
+    sort like the codes do. Integer codes (ProcedureCode is an int in the source databases) are turned
+    into digits with array arithmetic, without formatting any strings.
+    """
+    series = pd.Series(codes)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # Encode the few categories, then broadcast by category code; code -1 (null) picks NO_CODE.
+        return np.append(encode_codes(series.cat.categories), np.uint64(NO_CODE))[series.cat.codes.to_numpy()]
+    if pd.api.types.is_numeric_dtype(series):
+        values = pd.to_numeric(series, errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        digits = (values[:, None] // 10 ** np.arange(CPT_CODE_LENGTH - 1, -1, -1)) % 10 + ord('0')
+        valid = (values >= 0) & (values < 10 ** CPT_CODE_LENGTH)
+    else:
+        text = series.astype(object).where(series.notna(), '').astype(str).str.strip().str.upper().str.zfill(CPT_CODE_LENGTH)
+        valid = ((text.str.len() == CPT_CODE_LENGTH) & text.str.isascii()).to_numpy() & series.notna().to_numpy()
+        digits = np.frombuffer(text.where(valid, '0' * CPT_CODE_LENGTH).to_numpy(dtype=f'S{CPT_CODE_LENGTH}').tobytes(), dtype=np.uint8).reshape(-1, CPT_CODE_LENGTH)
+    keys = np.zeros(len(series), dtype=np.uint64)
+    for i in range(CPT_CODE_LENGTH):
+        keys = (keys << np.uint64(8)) | digits[:, i].astype(np.uint64)
+    keys[~valid] = NO_CODE
+    return keys
+
+def _fingerprint(path) -> dict:
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+
+class ProcedureCatalog:
+    """
+    The CPT catalog as a sorted array of packed code keys (see encode_codes) with its string tables:
+    category and status are dictionary-encoded, descriptions one offsets-plus-bytes string column.
+    It is stored as one uncompressed Arrow IPC file and memory-mapped on load, so opening it costs no
+    parsing and no copy, and looking up a column of codes is a single np.searchsorted.
+    The source CSV's fingerprint is kept in the file's metadata; open() rebuilds the index when it changes.
+    """
+    def __init__(self, table: pa.Table):
+        self.table = table
+        self.keys = table.column('code_key').to_numpy()
+        self._columns = {}
+
+    @classmethod
+    def build(cls, csv_path=CPT_CATALOG_FILE, index_path=CPT_INDEX_FILE) -> 'ProcedureCatalog':
+        """Parses the catalog CSV and writes the binary index next to it."""
+        df = pd.read_csv(csv_path, dtype=str).rename(columns=CATALOG_COLUMNS)
+        df = df[list(CATALOG_COLUMNS.values())].apply(lambda col: col.str.strip())
+        df['code_key'] = encode_codes(df['ProcedureCode'])
+        malformed = int((df['code_key'] == NO_CODE).sum())
+        if malformed: logging.warning(f"  > Skipping {malformed} malformed codes in '{csv_path}'.")
+        df = df[df['code_key'] != NO_CODE].drop_duplicates('code_key', keep='last').sort_values('code_key')
+        table = pa.table({
+            'code_key': pa.array(df['code_key'].to_numpy(), pa.uint64()),
+            'ProcedureCode': pa.array(df['ProcedureCode'], pa.string()),
+            'ProcedureCategory': pa.array(df['ProcedureCategory'], pa.string()).dictionary_encode(),
+            'ProcedureDescription': pa.array(df['ProcedureDescription'], pa.string()),
+            'CodeStatus': pa.array(df['CodeStatus'], pa.string()).dictionary_encode(),
+        }).replace_schema_metadata({'source': json.dumps(_fingerprint(csv_path))})
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        with pa.OSFile(index_path + '.tmp', 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(index_path + '.tmp', index_path)
+        logging.info(f"  > Compiled {table.num_rows} CPT codes from '{csv_path}' into '{index_path}'.")
+        return cls.load(index_path)
+
+    @classmethod
+    def load(cls, index_path=CPT_INDEX_FILE) -> 'ProcedureCatalog':
+        with pa.memory_map(index_path) as source:
+            return cls(pa.ipc.open_file(source).read_all())
+
+    @staticmethod
+    def source_of(index_path=CPT_INDEX_FILE):
+        """The fingerprint of the CSV an index was compiled from, or None when there is no readable index."""
+        try:
+            with pa.memory_map(index_path) as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+            return json.loads(metadata.get(b'source', b'null'))
+        except (OSError, pa.ArrowException, ValueError):
+            return None
+
+    @classmethod
+    def open(cls, csv_path=CPT_CATALOG_FILE, index_path=CPT_INDEX_FILE) -> 'ProcedureCatalog':
+        """Loads the index, compiling it first when it is missing or the CSV changed. Only a CSV whose
+        size or mtime differs is hashed, and only a different hash triggers a rebuild."""
+        indexed = cls.source_of(index_path)
+        stat = os.stat(csv_path)
+        if indexed and (indexed['size'], indexed['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            return cls.load(index_path)
+        if indexed and indexed['sha256'] == _fingerprint(csv_path)['sha256']:
+            return cls.load(index_path)
+        return cls.build(csv_path, index_path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def positions(self, codes) -> np.ndarray:
+        """The catalog row of every code, or -1 for codes that are not in the catalog."""
+        keys = encode_codes(codes)
+        positions = np.searchsorted(self.keys, keys).clip(0, max(len(self.keys) - 1, 0))
+        found = (self.keys[positions] == keys) & (keys != NO_CODE) if len(self.keys) else np.zeros(len(keys), dtype=bool)
+        return np.where(found, positions, -1)
+
+    def contains(self, codes) -> np.ndarray:
+        return self.positions(codes) >= 0
+
+    def _column(self, name) -> pd.Series:
+        if name not in self._columns:
+            self._columns[name] = self.table.column(name).to_pandas()
+        return self._columns[name]
+
+    def lookup(self, codes, columns=('ProcedureCategory', 'ProcedureDescription', 'CodeStatus')) -> pd.DataFrame:
+        """The catalog attributes of every code, row-aligned with `codes`; nulls for unknown codes."""
+        positions = self.positions(codes)
+        return pd.DataFrame({name: self._column(name).take(positions.clip(0)).reset_index(drop=True).where(positions >= 0).array
+                             for name in columns})
+
+_catalogs, _catalogs_lock = {}, threading.Lock()
+
+def open_catalog(csv_path=CPT_CATALOG_FILE, index_path=CPT_INDEX_FILE) -> ProcedureCatalog:
+    """The catalog of this process, opened (and rebuilt if needed) once per CSV and index path."""
+    with _catalogs_lock:
+        if (csv_path, index_path) not in _catalogs:
+            _catalogs[(csv_path, index_path)] = ProcedureCatalog.open(csv_path, index_path)
+        return _catalogs[(csv_path, index_path)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compiles the CPT catalog CSV into its binary index.")
+    parser.add_argument('--csv', default=CPT_CATALOG_FILE)
+    parser.add_argument('--index', default=CPT_INDEX_FILE)
+    parser.add_argument('--lookup', nargs='+', metavar='CODE', help="Look up these codes after building.")
+    args = parser.parse_args()
+    catalog = ProcedureCatalog.build(args.csv, args.index)
+    if args.lookup:
+        print(pd.concat([pd.Series(args.lookup, name='code'), catalog.lookup(args.lookup)], axis=1).to_string(index=False))
@@ -0,0 +1,271 @@
+# AGGREGATE ROLLUPS: Pre-aggregated RCM tables maintained incrementally from each run's fact delta
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
+import logging
+import glob
+import os
+
+from staging import STAGING_DIR, add_partition_columns, write_table
+from key_registry import open_registry, KEY_REGISTRY_DIR
+from instrumentation import instrument, stage
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+ROLLUP_DIR = './Data/rollups'
+LEDGER_PARTS_TO_COMPACT = 16  # The fact ledgers are compacted into one part once they have this many.
+UNKNOWN_NUMBER, UNKNOWN_TEXT = -1, 'Unknown'  # Group value of a null key, so every group has a non-null key to upsert on.
+LEDGER_PART_KEY = b'ledger_part'  # Parquet metadata of a saved rollup: the last ledger part it includes.
+
+# Natural key of every fact row. The incremental load upserts facts on the same keys.
+FACT_KEYS = {
+    'fact_transactions': ['TransactionID', 'source_hospital'],
+    'fact_claims': ['ClaimID', 'source_hospital'],
+}
+
+# Group columns that are not fact columns, with the fact column and key registry they are derived from.
+# patient_sk points to the SCD version in effect on the service date, so a patient's claims spread over
+# several patient_sk values; the registry maps each of them back to the one unified_patient_id.
+DERIVED_GROUP_COLUMNS = {'unified_patient_id': ('patient_sk', 'patients')}
+
+# Every measure is mergeable: ('sum', column) or ('count', column), where a count of None counts rows.
+# Averages are kept as a sum and a count, e.g. AVG(days_to_payment) = days_to_payment_sum / days_to_payment_count,
+# so two rollups of disjoint rows add up to the rollup of their union.
+ROLLUPS = {
+    'agg_claims_monthly': {
+        'fact': 'fact_claims',
+        'group_by': ['source_hospital', 'PayorType', 'ClaimStatus', 'service_year', 'service_month'],
+        'measures': {'claim_count': ('count', None), 'claim_amount': ('sum', 'ClaimAmount'), 'paid_amount': ('sum', 'PaidAmount'),
+                     'days_to_payment_sum': ('sum', 'days_to_payment'), 'days_to_payment_count': ('count', 'days_to_payment')},
+    },
+    'agg_patient_lifetime': {
+        'fact': 'fact_claims',
+        'group_by': ['unified_patient_id'],
+        'measures': {'claim_count': ('count', None), 'claim_amount': ('sum', 'ClaimAmount'), 'paid_amount': ('sum', 'PaidAmount')},
+    },
+    'agg_procedures_monthly': {
+        'fact': 'fact_transactions',
+        'group_by': ['procedure_sk', 'source_hospital', 'service_year', 'service_month'],
+        'measures': {'transaction_count': ('count', None), 'amount': ('sum', 'Amount'), 'paid_amount': ('sum', 'PaidAmount')},
+    },
+}
+
+def aggregate(contributions: pd.DataFrame, spec: dict, sign=1) -> pd.DataFrame:
+    """The rollup of `contributions` (ledger rows) under `spec`; with sign=-1, the rollup to subtract."""
+    group_by = spec['group_by']
+    values = contributions[group_by].copy()
+    for measure, (func, column) in spec['measures'].items():
+        if func == 'sum':
+            values[measure] = contributions[column].astype('float64').fillna(0.0).to_numpy() * sign
+        else:
+            counted = np.ones(len(contributions), dtype=bool) if column is None else contributions[column].notna().to_numpy()
+            values[measure] = counted.astype(np.int64) * sign
+    return values.groupby(group_by, sort=False).sum().reset_index()
+
+class RollupMaintainer:
+    """
+    Keeps the ROLLUPS up to date from fact deltas without re-aggregating the facts.
+    The incremental load upserts facts on FACT_KEYS, so a delta row may replace a row that an earlier
+    run already counted (a Pending claim that is now Paid). Every fact therefore has a ledger of the
+    rollup inputs of the rows counted so far (key, group and measure columns only); update() subtracts
+    the ledger rows of the keys in the delta and adds the delta, so applying the same delta twice
+    changes nothing. The ledger is append-only like the SCD history, the latest part holding a key
+    wins, and it is compacted every LEDGER_PARTS_TO_COMPACT runs. Rollups are small and rewritten whole.
+    The ledger part is written before the rollups, and every rollup records the last part it includes;
+    a rollup behind the ledger (a run stopped between the two writes) is rebuilt from the ledger first.
+    """
+    def __init__(self, rollup_dir=ROLLUP_DIR, rollups=ROLLUPS, registry_dir=KEY_REGISTRY_DIR):
+        self.rollup_dir, self.rollups, self.registry_dir = rollup_dir, rollups, registry_dir
+        self._registries = {}
+
+    def _rollup_path(self, name):
+        return os.path.join(self.rollup_dir, f"{name}.parquet")
+
+    def _ledger_parts(self, fact_name):
+        return sorted(glob.glob(os.path.join(self.rollup_dir, 'ledger', fact_name, 'part-*.parquet')))
+
+    def _latest_part(self, fact_name) -> int:
+        """The number of the newest ledger part of `fact_name`, or -1 before the first."""
+        parts = self._ledger_parts(fact_name)
+        return int(os.path.basename(parts[-1])[len('part-'):-len('.parquet')]) if parts else -1
+
+    def _ledger_fields(self, fact_name):
+        """The columns of the ledger rows of `fact_name`: its key, group and measure columns."""
+        columns = list(FACT_KEYS[fact_name])
+        for spec in self.rollups.values():
+            if spec['fact'] != fact_name: continue
+            columns += spec['group_by'] + [column for _, column in spec['measures'].values() if column is not None]
+        return list(dict.fromkeys(columns))
+
+    def ledger_columns(self, fact_name):
+        """The fact columns the rollups over `fact_name` read: its key, group and measure columns,
+        with the fact column each DERIVED_GROUP_COLUMNS column is derived from."""
+        return list(dict.fromkeys(DERIVED_GROUP_COLUMNS[col][0] if col in DERIVED_GROUP_COLUMNS else col for col in self._ledger_fields(fact_name)))
+
+    def _derive(self, column, fact_keys: pd.Series) -> pd.Series:
+        """The DERIVED_GROUP_COLUMNS `column` of every fact key, looked up in the key registry; null for unknown keys."""
+        _, registry_name = DERIVED_GROUP_COLUMNS[column]
+        if registry_name not in self._registries:
+            self._registries[registry_name] = open_registry(registry_name, self.registry_dir)
+        registry = self._registries[registry_name]
+        positions = pd.Index(registry.keys[registry.surrogate_key].astype('Int64')).get_indexer(pd.Index(pd.array(fact_keys, dtype='Int64')))
+        values = registry.keys[column].to_numpy(dtype=object)
+        return pd.Series(np.where(positions >= 0, values.take(positions, mode='clip') if len(values) else None, None), dtype=object)
+
+    def _with_derived(self, fact_name, frame: pd.DataFrame) -> pd.DataFrame:
+        """Adds the derived group columns `frame` lacks, e.g. to ledger parts written before a rollup grouped on them."""
+        for col in self._ledger_fields(fact_name):
+            source = DERIVED_GROUP_COLUMNS.get(col, (None,))[0]
+            if col not in frame.columns and source in frame.columns:
+                frame[col] = self._derive(col, frame[source]).fillna(UNKNOWN_TEXT).to_numpy()
+        return frame
+
+    def _contributions(self, fact_name, fact_df: pd.DataFrame) -> pd.DataFrame:
+        """The ledger rows of a fact frame: plain (non-categorical) values, null group keys replaced, one row per key."""
+        if 'service_year' not in fact_df.columns or 'service_month' not in fact_df.columns:
+            fact_df = add_partition_columns(fact_df)
+        group_columns = {col for spec in self.rollups.values() if spec['fact'] == fact_name for col in spec['group_by']}
+        rows = pd.DataFrame(index=range(len(fact_df)))
+        for col in self._ledger_fields(fact_name):
+            if col in DERIVED_GROUP_COLUMNS and col not in fact_df.columns:
+                values = self._derive(col, fact_df[DERIVED_GROUP_COLUMNS[col][0]])
+            else:
+                values = fact_df[col]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                values = values.astype(values.cat.categories.dtype)
+            values = values.reset_index(drop=True)
+            if col in group_columns:
+                values = values.fillna(UNKNOWN_NUMBER).astype(np.int64) if pd.api.types.is_numeric_dtype(values) else values.astype(object).fillna(UNKNOWN_TEXT)
+            rows[col] = values
+        return rows.drop_duplicates(subset=FACT_KEYS[fact_name], keep='last', ignore_index=True)
+
+    def _read_ledger(self, fact_name, keys: pd.DataFrame = None) -> pd.DataFrame:
+        """The latest ledger row of every key, or only of the keys in `keys`. The first key column is
+        pushed down to the scan, so row groups holding none of the delta's keys are skipped."""
+        key_columns = FACT_KEYS[fact_name]
+        filters = [(key_columns[0], 'in', keys[key_columns[0]].dropna().unique().tolist())] if keys is not None else None
+        parts = [pq.read_table(path, filters=filters).to_pandas() for path in self._ledger_parts(fact_name)]
+        parts = [self._with_derived(fact_name, part) for part in parts if not part.empty]
+        if not parts: return pd.DataFrame(columns=self._ledger_fields(fact_name))
+        ledger = pd.concat(parts, ignore_index=True).drop_duplicates(subset=key_columns, keep='last', ignore_index=True)
+        return ledger.merge(keys[key_columns], on=key_columns) if keys is not None else ledger
+
+    def _append_ledger(self, fact_name, contributions: pd.DataFrame) -> int:
+        """Writes `contributions` as the next ledger part and returns its number."""
+        parts = self._ledger_parts(fact_name)
+        ledger_dir = os.path.join(self.rollup_dir, 'ledger', fact_name)
+        os.makedirs(ledger_dir, exist_ok=True)
+        next_part = self._latest_part(fact_name) + 1
+        if len(parts) + 1 >= LEDGER_PARTS_TO_COMPACT:
+            # The compacted ledger takes the next part number, so the older parts can go once it is written.
+            compacted = pd.concat([self._read_ledger(fact_name), contributions], ignore_index=True)
+            contributions = compacted.drop_duplicates(subset=FACT_KEYS[fact_name], keep='last', ignore_index=True)
+        path = os.path.join(ledger_dir, f"part-{next_part:05d}.parquet")
+        contributions.to_parquet(path + '.tmp', index=False, compression='zstd')
+        os.replace(path + '.tmp', path)
+        if len(parts) + 1 >= LEDGER_PARTS_TO_COMPACT:
+            for path in parts: os.remove(path)
+            logging.info(f"  > Compacted the {fact_name} rollup ledger from {len(parts) + 1} parts into one of {len(contributions)} rows.")
+        return next_part
+
+    def _empty(self, name) -> pd.DataFrame:
+        spec = self.rollups[name]
+        return pd.DataFrame(columns=spec['group_by'] + list(spec['measures']))
+
+    def load(self, name) -> pd.DataFrame:
+        """The current rollup, or an empty one before the first update."""
+        if os.path.exists(self._rollup_path(name)):
+            return pd.read_parquet(self._rollup_path(name))
+        return self._empty(name)
+
+    def _saved_part(self, name):
+        """The last ledger part the saved rollup includes: -1 before the first update, None when it is not recorded."""
+        if not os.path.exists(self._rollup_path(name)): return -1
+        metadata = pq.read_schema(self._rollup_path(name)).metadata or {}
+        return int(metadata[LEDGER_PART_KEY]) if LEDGER_PART_KEY in metadata else None
+
+    def _save(self, name, rollup: pd.DataFrame, ledger_part):
+        os.makedirs(self.rollup_dir, exist_ok=True)
+        table = pa.Table.from_pandas(rollup, preserve_index=False)
+        table = table.replace_schema_metadata({**(table.schema.metadata or {}), LEDGER_PART_KEY: str(ledger_part).encode()})
+        pq.write_table(table, self._rollup_path(name) + '.tmp')
+        os.replace(self._rollup_path(name) + '.tmp', self._rollup_path(name))
+
+    def _merge(self, name, frames) -> pd.DataFrame:
+        """Adds up rollup frames group by group. Groups whose rows were all retracted are kept with zero
+        measures, so that an upsert on the group columns also overwrites them in the warehouse."""
+        spec = self.rollups[name]
+        measures = list(spec['measures'])
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames: return self._empty(name)
+        rollup = pd.concat(frames, ignore_index=True).groupby(spec['group_by'], sort=True)[measures].sum().reset_index()
+        row_count = next(measure for measure, (func, column) in spec['measures'].items() if func == 'count' and column is None)
+        sums = [measure for measure, (func, _) in spec['measures'].items() if func == 'sum']
+        rollup.loc[rollup[row_count] == 0, sums] = 0.0  # No float residue on emptied groups.
+        return rollup.astype({measure: 'float64' if measure in sums else 'int64' for measure in measures})
+
+    def _rebuilt(self, name) -> pd.DataFrame:
+        """The rollup recomputed from its fact's ledger. Groups of the saved rollup are kept with zero
+        measures, so the warehouse's copies of groups that no longer exist are overwritten too."""
+        spec = self.rollups[name]
+        saved = self.load(name)
+        emptied = saved.assign(**{measure: 0 for measure in spec['measures']}) if set(spec['group_by']) <= set(saved.columns) else self._empty(name)
+        return self._merge(name, [emptied[spec['group_by'] + list(spec['measures'])], aggregate(self._read_ledger(spec['fact']), spec)])
+
+    @instrument('rollups.update')
+    def update(self, facts: dict) -> dict:
+        """
+        Folds a run's fact delta, {fact_name: fact frame}, into every rollup over those facts and
+        returns the updated rollups. Facts missing from `facts` leave their rollups unchanged.
+        """
+        updated = {}
+        for fact_name in FACT_KEYS:
+            names = [name for name, spec in self.rollups.items() if spec['fact'] == fact_name]
+            if fact_name not in facts or not names: continue
+            with stage(f"rollups.delta.{fact_name}") as record:
+                contributions = self._contributions(fact_name, facts[fact_name])
+                retracted = self._read_ledger(fact_name, contributions[FACT_KEYS[fact_name]])
+                record.input(contributions)
+                record.output(retracted)
+            latest = self._latest_part(fact_name)
+            current = {}
+            for name in names:
+                if self._saved_part(name) == latest:
+                    current[name] = self.load(name)
+                else:
+                    logging.warning(f"  > Rollup '{name}' does not include the latest {fact_name} ledger part; rebuilding it from the ledger.")
+                    current[name] = self._rebuilt(name)
+            if not contributions.empty:
+                latest = self._append_ledger(fact_name, contributions)
+            for name in names:
+                with stage(f"rollups.{name}", table=name) as record:
+                    updated[name] = self._merge(name, [current[name], aggregate(contributions, self.rollups[name]), aggregate(retracted, self.rollups[name], sign=-1)])
+                    self._save(name, updated[name], latest)
+                    record.output(updated[name])
+            logging.info(f"  > Rolled up {len(contributions)} {fact_name} rows ({len(retracted)} replacing rows counted before).")
+        return updated
+
+    @instrument('rollups.rebuild')
+    def rebuild(self) -> dict:
+        """Recomputes every rollup from the ledgers, e.g. after a change to ROLLUPS or to drop float drift."""
+        rebuilt = {}
+        for name, spec in self.rollups.items():
+            rebuilt[name] = self._rebuilt(name)
+            self._save(name, rebuilt[name], self._latest_part(spec['fact']))
+        return rebuilt
+
+def update_rollups(facts: dict, staging_dir=STAGING_DIR, rollup_dir=ROLLUP_DIR, registry_dir=KEY_REGISTRY_DIR) -> dict:
+    """Updates the rollups from a run's facts and stages them next to the star schema."""
+    rollups = RollupMaintainer(rollup_dir, registry_dir=registry_dir).update(facts)
+    for name, df in rollups.items():
+        write_table(df, name, staging_dir)
+    return rollups
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuilds the rollups from their ledgers and stages them.")
+    parser.add_argument('--staging-dir', default=STAGING_DIR)
+    args = parser.parse_args()
+    for name, df in RollupMaintainer().rebuild().items():
+        write_table(df, name, args.staging_dir)
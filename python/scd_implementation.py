@@ -1,139 +1,210 @@
 #PHASE 5
 import pandas as pd
+import numpy as np
 from datetime import datetime, timedelta
 import logging
+import glob
 import os
+import sys
 
 # --- Assuming these modules exist in the same directory ---
-from extraction import run_extraction
+from extraction import run_extraction, WatermarkStore
 from transform import run_all_transformations
 from dimensional_modeling import run_modeling
+from sharding import run_sharded
+from key_registry import open_registry, KEY_REGISTRY_DIR
+from staging import STAGING_DIR, write_parquet_file, write_table, mark_extract
+from rollups import update_rollups
+from execution_backend import open_backend
+from instrumentation import instrument, profiler
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
-STAGING_DIR = r'C:\Users\durga\OneDrive\Desktop\HealthCare Revenue Recycle\Data\staging' # Using absolute path for clarity
-
-def apply_scd_type2(new_dim_patients: pd.DataFrame, existing_dim_patients: pd.DataFrame) -> pd.DataFrame:
-    """A robust function to apply SCD Type 2 logic for the patient dimension."""
-    logging.info("Applying SCD Type 2 logic to the patient dimension...")
-    attributes_to_track = ['Address', 'LastName']
-
-    # --- First Run Scenario ---
-    if existing_dim_patients.empty:
-        logging.info("  > This is the first run. Initializing dimension with version history.")
-        new_dim_patients['version'] = 1
-        new_dim_patients['effective_date'] = datetime.now().date()
-        new_dim_patients['expiry_date'] = pd.NaT
-        new_dim_patients['is_current'] = True
-        new_dim_patients.reset_index(drop=True, inplace=True)
-        new_dim_patients['patient_sk'] = new_dim_patients.index
-        return new_dim_patients
-
-    # --- Subsequent Runs ---
-    merged = pd.merge(
-        existing_dim_patients[existing_dim_patients['is_current']],
-        new_dim_patients,
-        on='unified_patient_id',
-        how='outer',
-        suffixes=('_old', '_new'),
-        indicator=True
-    )
-
-    new_cols = [c for c in merged.columns if c.endswith('_new')]
-    old_cols = [c for c in merged.columns if c.endswith('_old')]
-
-    # --- 1. Detect Records with Changes ---
-    changed_mask = (merged['_merge'] == 'both')
-    change_detected_mask = False
-    for attr in attributes_to_track:
-        change_detected_mask |= (merged[f'{attr}_old'].fillna('') != merged[f'{attr}_new'].fillna(''))
-    
-    changed_df = merged[changed_mask & change_detected_mask].copy()
-
-    expired_records = pd.DataFrame()
-    new_versions = pd.DataFrame()
-
-    if not changed_df.empty:
-        logging.info(f"  > Found {len(changed_df)} patients with updated attributes.")
-        expired_records = changed_df[['unified_patient_id'] + old_cols].copy()
-        expired_records.columns = ['unified_patient_id'] + [c.replace('_old', '') for c in old_cols]
-        expired_records['is_current'] = False
-        expired_records['expiry_date'] = datetime.now().date() - timedelta(days=1)
-        
-        new_versions = changed_df[['unified_patient_id'] + new_cols].copy()
-        new_versions.columns = ['unified_patient_id'] + [c.replace('_new', '') for c in new_cols]
-        new_versions['version'] = changed_df['version_old'].values + 1
-        new_versions['effective_date'] = datetime.now().date()
-        new_versions['expiry_date'] = pd.NaT
-        new_versions['is_current'] = True
-
-    # --- 2. Isolate Brand New Records ---
-    new_records_df = merged[merged['_merge'] == 'right_only'].copy()
-    new_records = pd.DataFrame()
-    if not new_records_df.empty:
-        logging.info(f"  > Found {len(new_records_df)} new patient records.")
-        new_records = new_records_df[['unified_patient_id'] + new_cols].copy()
-        new_records.columns = ['unified_patient_id'] + [c.replace('_new', '') for c in new_cols]
-        new_records['version'] = 1
-        new_records['effective_date'] = datetime.now().date()
-        new_records['expiry_date'] = pd.NaT
-        new_records['is_current'] = True
-
-    # --- 3. Keep Unaffected Records ---
-    keys_of_changed_patients = changed_df['unified_patient_id'].tolist()
-    final_unchanged = existing_dim_patients[
-        ~existing_dim_patients['unified_patient_id'].isin(keys_of_changed_patients)
-    ].copy()
-
-    # --- 4. Assemble and Finalize the Dimension ---
-    final_dimension = pd.concat([
-        final_unchanged,
-        expired_records,
-        new_versions,
-        new_records
-    ], ignore_index=True)
-
-    final_dimension.sort_values(by=['unified_patient_id', 'version'], inplace=True)
-    final_dimension.reset_index(drop=True, inplace=True)
-    final_dimension['patient_sk'] = final_dimension.index
-
-    return final_dimension
+
+# Dimensions kept as SCD Type 2, with the natural key and the attributes whose changes open a new version.
+SCD_DIMENSIONS = {
+    'dim_patients': {'registry': 'patients', 'natural_key': ['unified_patient_id'], 'tracked_attributes': ['Address', 'LastName']},
+    'dim_providers': {'registry': 'providers', 'natural_key': ['ProviderID', 'source_hospital'], 'tracked_attributes': ['LastName', 'Specialization', 'DepartmentName']},
+}
+SCD_COLUMNS = ['version', 'effective_date', 'expiry_date', 'is_current', 'row_hash']
+
+def history_parts(name, staging_dir=STAGING_DIR):
+    """The append-only history part files of an SCD dimension, oldest first."""
+    return sorted(glob.glob(os.path.join(staging_dir, f"{name}_history", 'part-*.parquet')))
+
+class SCDType2Engine:
+    """
+    Hash-diff SCD Type 2 for one dimension.
+    Every version row carries a `row_hash` of its tracked attributes, so change detection is one
+    hash comparison per member against an index on the natural key of the current versions.
+    History is append-only: each run writes a single part file holding just the rows it expires
+    (re-written with is_current=False) and the versions it opens. Existing parts are never rewritten,
+    and the latest write of a surrogate key wins when the history is read back.
+    Matching the incoming members to the current versions runs on the execution `backend` (pandas by default).
+    """
+    def __init__(self, name, natural_key, tracked_attributes, registry_name, staging_dir=STAGING_DIR, registry_dir=KEY_REGISTRY_DIR, backend=None):
+        self.name, self.natural_key, self.tracked_attributes = name, list(natural_key), list(tracked_attributes)
+        self.backend = open_backend(backend or 'pandas')
+        self.staging_dir, self.history_dir = staging_dir, os.path.join(staging_dir, f"{name}_history")
+        self.registry = open_registry(registry_name, registry_dir)
+        self.surrogate_key = self.registry.surrogate_key
+
+    @classmethod
+    def for_dimension(cls, name, staging_dir=STAGING_DIR, registry_dir=KEY_REGISTRY_DIR, backend=None):
+        config = SCD_DIMENSIONS[name]
+        return cls(name, config['natural_key'], config['tracked_attributes'], config['registry'], staging_dir, registry_dir, backend)
+
+    def row_hash(self, df: pd.DataFrame) -> np.ndarray:
+        """Stable 64-bit hash of the tracked attributes; nulls hash like empty strings."""
+        attributes = df[self.tracked_attributes].astype(object)
+        return pd.util.hash_pandas_object(attributes.where(attributes.notna(), ''), index=False).to_numpy().view(np.int64)
+
+    def _parts(self):
+        return history_parts(self.name, self.staging_dir)
+
+    def load_history(self) -> pd.DataFrame:
+        """Materializes the full dimension: every version, with the latest write of each surrogate key."""
+        parts = self._parts()
+        if not parts: return pd.DataFrame()
+        history = pd.concat([pd.read_parquet(p) for p in parts], ignore_index=True)
+        history = history.drop_duplicates(subset=[self.surrogate_key], keep='last')
+        return history.sort_values(self.natural_key + ['version']).reset_index(drop=True)
+
+    @instrument('scd.load_current.{self.name}')
+    def load_current(self) -> pd.DataFrame:
+        """
+        Returns the current version of every member without materializing the history.
+        A version stays current until a later part re-writes its key as expired, so only the rows
+        written as current and the key column of the expired rows are read; the is_current filter
+        is pushed down to the row-group statistics of every part.
+        """
+        parts = self._parts()
+        if not parts: return pd.DataFrame()
+        current = pd.concat([pd.read_parquet(p, filters=[('is_current', '==', True)]) for p in parts], ignore_index=True)
+        expired = pd.concat([pd.read_parquet(p, columns=[self.surrogate_key], filters=[('is_current', '==', False)]) for p in parts], ignore_index=True)
+        current = current[~current[self.surrogate_key].isin(expired[self.surrogate_key])]
+        return current.sort_values(self.natural_key + ['version']).reset_index(drop=True)
+
+    @instrument('scd.versions.{self.name}')
+    def versions(self, new_dim: pd.DataFrame = None, as_of=None) -> pd.DataFrame:
+        """
+        Every version of every member with just the columns an as-of key lookup needs: the natural
+        key, source_hospital, the surrogate key and the version interval. With `new_dim`, the changes
+        apply() would make for it are included, without writing them, so facts built before the history
+        is appended already see the versions this run opens (the registry hands apply() the same keys).
+        """
+        columns = list(dict.fromkeys(self.natural_key + ['source_hospital', self.surrogate_key, 'version', 'effective_date', 'expiry_date']))
+        parts = self._parts()
+        history = pd.concat([pd.read_parquet(p, columns=columns) for p in parts], ignore_index=True) if parts else pd.DataFrame(columns=columns)
+        history = history.drop_duplicates(subset=[self.surrogate_key], keep='last')
+        if new_dim is not None:
+            current = self.load_current()
+            frames = [frame[columns] for frame in self.diff(new_dim, current, as_of) if not frame.empty]
+            if frames:
+                changed = pd.concat(frames, ignore_index=True)
+                history = pd.concat([history[~history[self.surrogate_key].isin(changed[self.surrogate_key])], changed], ignore_index=True)
+        return history.sort_values(self.natural_key + ['version']).reset_index(drop=True)
+
+    def diff(self, new_dim: pd.DataFrame, current: pd.DataFrame, as_of=None):
+        """
+        Pure change detection. Returns (expired, new_versions, new_members), each a frame of
+        dimension rows ready to be appended. Cost is linear in the incoming members; the
+        history enters only through the current versions.
+        """
+        today = pd.Timestamp(as_of or datetime.now()).normalize()
+        new_dim = new_dim.reset_index(drop=True)
+        new_hash = self.row_hash(new_dim)
+        positions = self.backend.match_positions(current, new_dim, self.natural_key)
+        is_new = positions < 0
+        current_hash = current['row_hash'].to_numpy()[positions[~is_new]] if not current.empty else np.empty(0, dtype=np.int64)
+        changed = np.zeros(len(new_dim), dtype=bool)
+        changed[~is_new] = current_hash != new_hash[~is_new]
+
+        expired = current.iloc[positions[changed]].copy()
+        expired['is_current'] = False
+        expired['expiry_date'] = today - timedelta(days=1)
+
+        new_versions = new_dim[changed].copy()
+        new_versions['version'] = current['version'].to_numpy()[positions[changed]] + 1 if changed.any() else 1
+        new_versions[self.surrogate_key] = self.registry.assign(new_versions)
+
+        new_members = new_dim[is_new].copy()
+        new_members['version'] = 1
+        new_members[self.surrogate_key] = self.registry.assign(new_members)
+
+        for frame, hashes in [(new_versions, new_hash[changed]), (new_members, new_hash[is_new])]:
+            frame['effective_date'] = today
+            frame['expiry_date'] = pd.NaT
+            frame['is_current'] = True
+            frame['row_hash'] = hashes
+        return expired, new_versions, new_members
+
+    @instrument('scd.apply.{self.name}')
+    def apply(self, new_dim: pd.DataFrame, as_of=None) -> pd.DataFrame:
+        """Diffs the incoming dimension against the current versions and appends only the
+        expired and newly opened version rows to the history. Returns those rows (the delta)."""
+        logging.info(f"Applying SCD Type 2 logic to '{self.name}'...")
+        expired, new_versions, new_members = self.diff(new_dim, self.load_current(), as_of)
+        logging.info(f"  > {len(new_members)} new members, {len(new_versions)} changed members, {len(new_dim) - len(new_members) - len(new_versions)} unchanged.")
+        frames = [frame for frame in [expired, new_versions, new_members] if not frame.empty]
+        delta = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if frames:
+            os.makedirs(self.history_dir, exist_ok=True)
+            path = os.path.join(self.history_dir, f"part-{len(self._parts()):05d}.parquet")
+            write_parquet_file(delta, path)
+            logging.info(f"  > Appended {len(delta)} version rows to '{path}'.")
+        return delta
+
+def scd_versions(dimensions: dict, staging_dir=STAGING_DIR, registry_dir=KEY_REGISTRY_DIR, as_of=None) -> dict:
+    """The versions (SCDType2Engine.versions) of every SCD dimension, including the changes of
+    this run's `dimensions`, for resolving facts to the version in effect on their date."""
+    return {name: SCDType2Engine.for_dimension(name, staging_dir, registry_dir).versions(dimensions.get(name), as_of) for name in SCD_DIMENSIONS}
+
+def apply_scd_type2(new_dim_patients: pd.DataFrame, existing_dim_patients: pd.DataFrame, registry_dir=KEY_REGISTRY_DIR) -> pd.DataFrame:
+    """In-memory SCD Type 2 for the patient dimension: returns the existing history with the
+    changes of `new_dim_patients` applied. Uses the same hash diff as SCDType2Engine."""
+    engine = SCDType2Engine.for_dimension('dim_patients', registry_dir=registry_dir)
+    existing = existing_dim_patients
+    if not existing.empty and 'row_hash' not in existing.columns:
+        existing = existing.assign(row_hash=engine.row_hash(existing))
+    current = existing[existing['is_current']] if not existing.empty else existing
+    expired, new_versions, new_members = engine.diff(new_dim_patients, current)
+    logging.info(f"  > Found {len(new_versions)} patients with updated attributes and {len(new_members)} new patient records.")
+    unaffected = existing[~existing[engine.surrogate_key].isin(expired[engine.surrogate_key])] if not existing.empty else existing
+    final_dimension = pd.concat([frame for frame in [unaffected, expired, new_versions, new_members] if not frame.empty], ignore_index=True)
+    return final_dimension.sort_values(by=['unified_patient_id', 'version']).reset_index(drop=True)
 
 if __name__ == "__main__":
     try:
         logging.info("<<<<<<<<<< STARTING FULL DATA PROCESSING PIPELINE (Phases 2-5) >>>>>>>>>>")
         
-        raw_db_data, raw_claims_data = run_extraction()
-        transformed_db_data, transformed_claims_data = run_all_transformations(raw_db_data, raw_claims_data)
-        final_dimensions, final_facts = run_modeling(transformed_db_data, transformed_claims_data)
-        
-        new_dim_patients_from_pipeline = final_dimensions['dim_patients']
-        
-        existing_dim_path = os.path.join(STAGING_DIR, 'dim_patients.parquet')
-        if os.path.exists(existing_dim_path):
-            logging.info(f"Found existing patient dimension at: {existing_dim_path}")
-            existing_dim_patients = pd.read_parquet(existing_dim_path)
+        watermarks = WatermarkStore()
+        if '--sharded' in sys.argv:
+            transformed_db_data, transformed_claims_data = run_sharded(full_refresh='--full-refresh' in sys.argv, watermarks=watermarks)
         else:
-            logging.info("No existing patient dimension found. This will be the first run.")
-            existing_dim_patients = pd.DataFrame()
-            
-        final_dim_patients_with_history = apply_scd_type2(new_dim_patients_from_pipeline, existing_dim_patients)
-        final_dimensions['dim_patients'] = final_dim_patients_with_history
+            raw_db_data, raw_claims_data = run_extraction(full_refresh='--full-refresh' in sys.argv, watermarks=watermarks)
+            transformed_db_data, transformed_claims_data = run_all_transformations(raw_db_data, raw_claims_data)
+        backend = open_backend('duckdb' if '--duckdb' in sys.argv else 'pandas')
+        final_dimensions, final_facts = run_modeling(transformed_db_data, transformed_claims_data, staging_dir=STAGING_DIR, backend=backend)
+        
+        for name in SCD_DIMENSIONS:
+            engine = SCDType2Engine.for_dimension(name, backend=backend)
+            engine.apply(final_dimensions[name])
+            final_dimensions[name] = engine.load_history()
         
         logging.info(f"--- Saving all final data models to: {STAGING_DIR} ---")
         os.makedirs(STAGING_DIR, exist_ok=True)
-        for name, df in final_dimensions.items():
-            path = os.path.join(STAGING_DIR, f"{name}.parquet")
-            df.to_parquet(path, index=False)
-            logging.info(f"  > Saved {name} with {len(df)} rows.")
-        for name, df in final_facts.items():
-            path = os.path.join(STAGING_DIR, f"{name}.parquet")
-            df.to_parquet(path, index=False)
-            logging.info(f"  > Saved {name} with {len(df)} rows.")
+        for name, df in {**final_dimensions, **final_facts}.items():
+            write_table(df, name, STAGING_DIR)
+        update_rollups(final_facts, STAGING_DIR)
+        mark_extract(STAGING_DIR, incremental='--full-refresh' not in sys.argv)
+        watermarks.save()  # Only now that every extracted row is staged.
 
         print("\n" + "="*80)
         print("✅  SUCCESS: DATA PROCESSING COMPLETE. ALL FINAL TABLES SAVED TO STAGING. ")
         print("="*80)
         
     except Exception as e:
-        logging.error("<<<<<<<<<< PIPELINE FAILED >>>>>>>>>>", exc_info=True)
\ No newline at end of file
+        logging.error("<<<<<<<<<< PIPELINE FAILED >>>>>>>>>>", exc_info=True)
+    finally:
+        profiler.export()
\ No newline at end of file
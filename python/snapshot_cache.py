@@ -0,0 +1,109 @@
+# RAW SNAPSHOT CACHE: Content-addressed Arrow IPC snapshots of the integrated extraction output
+import pandas as pd
+import pyarrow as pa
+import logging
+import glob
+import hashlib
+import json
+import os
+import time
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+SNAPSHOT_DIR = './Data/raw_snapshots'
+SNAPSHOTS_TO_KEEP = 3
+CLAIMS_TABLE = 'claims'
+
+class RawSnapshotCache:
+    """
+    Stores what run_extraction returned so downstream phases can be rerun without the source databases.
+    Every table is an uncompressed Arrow IPC (Feather v2) file under objects/, named by the SHA-256
+    of its bytes, so a table that did not change between runs is stored once. A manifest under
+    snapshots/ maps a source key (the extraction mode, its watermarks and the size and mtime of every
+    claims file) to the objects of one extraction. Reads memory-map the objects, so Arrow buffers are
+    not copied. A full extraction is keyed on the watermarks it ends at, i.e. the state of the sources
+    it holds; an incremental one on the watermarks it starts from, since it holds only the rows changed
+    after them. The mode is part of the key, so a delta is never served as a full extraction.
+    """
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR):
+        self.objects_dir = os.path.join(snapshot_dir, 'objects')
+        self.manifests_dir = os.path.join(snapshot_dir, 'snapshots')
+
+    @staticmethod
+    def source_key(watermarks: dict, claim_files, columns=None, incremental=False) -> str:
+        """`columns` are the columns extracted per table, so a snapshot is not reused after the extraction plan changed."""
+        claims = {os.path.basename(f): [os.path.getsize(f), os.stat(f).st_mtime_ns] for f in sorted(claim_files)}
+        key = {'mode': 'incremental' if incremental else 'full', 'watermarks': watermarks, 'claims': claims, 'columns': columns}
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+    def _manifest_path(self, key):
+        return os.path.join(self.manifests_dir, f"{key}.json")
+
+    def _write_object(self, df: pd.DataFrame) -> str:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        data = sink.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        path = os.path.join(self.objects_dir, f"{digest}.arrow")
+        if not os.path.exists(path):
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        return digest
+
+    def _read_object(self, digest) -> pd.DataFrame:
+        with pa.memory_map(os.path.join(self.objects_dir, f"{digest}.arrow")) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+
+    def save(self, key, db_data: dict, claims_df: pd.DataFrame):
+        """Snapshots one extraction. Failures are logged, never raised: the cache is only an optimization."""
+        try:
+            os.makedirs(self.objects_dir, exist_ok=True)
+            os.makedirs(self.manifests_dir, exist_ok=True)
+            tables = {name: self._write_object(df) for name, df in db_data.items()}
+            tables[CLAIMS_TABLE] = self._write_object(claims_df)
+            with open(self._manifest_path(key), 'w') as f:
+                json.dump({'created': time.time(), 'tables': tables}, f, indent=2)
+            logging.info(f"  > Saved raw snapshot '{key}' ({len(tables)} tables).")
+            self._prune()
+        except (pa.ArrowException, OSError, ValueError, TypeError) as e:
+            logging.warning(f"  > Could not save raw snapshot '{key}': {e}")
+
+    def load(self, key):
+        """Returns (db_data, claims_df) of the snapshot for `key`, or None when there is none."""
+        if not os.path.exists(self._manifest_path(key)): return None
+        start = time.perf_counter()
+        with open(self._manifest_path(key)) as f:
+            tables = json.load(f)['tables']
+        try:
+            frames = {name: self._read_object(digest) for name, digest in tables.items()}
+        except (pa.ArrowException, OSError) as e:
+            logging.warning(f"  > Raw snapshot '{key}' is unreadable ({e}); ignoring it.")
+            return None
+        claims_df = frames.pop(CLAIMS_TABLE)
+        logging.info(f"  > Loaded raw snapshot '{key}' ({len(tables)} tables) in {time.perf_counter() - start:.3f}s.")
+        return frames, claims_df
+
+    def invalidate(self, key=None):
+        """Drops the snapshot for `key`, or every snapshot, and deletes objects no snapshot uses any more."""
+        for path in [self._manifest_path(key)] if key else glob.glob(os.path.join(self.manifests_dir, '*.json')):
+            if os.path.exists(path): os.remove(path)
+        self._collect_garbage()
+        logging.info(f"  > Invalidated {'raw snapshot ' + repr(key) if key else 'all raw snapshots'}.")
+
+    def _prune(self):
+        manifests = sorted(glob.glob(os.path.join(self.manifests_dir, '*.json')), key=os.path.getmtime)
+        for path in manifests[:-SNAPSHOTS_TO_KEEP]:
+            os.remove(path)
+        self._collect_garbage()
+
+    def _collect_garbage(self):
+        referenced = set()
+        for path in glob.glob(os.path.join(self.manifests_dir, '*.json')):
+            with open(path) as f:
+                referenced.update(json.load(f)['tables'].values())
+        for path in glob.glob(os.path.join(self.objects_dir, '*.arrow')):
+            if os.path.basename(path)[:-len('.arrow')] not in referenced:
+                os.remove(path)
@@ -0,0 +1,135 @@
+# STAGING LAYOUT: Partitioned Parquet writer and pushdown reader for the staging directory
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import logging
+import json
+import os
+import shutil
+
+from instrumentation import instrument
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+STAGING_DIR = r'C:\Users\durga\OneDrive\Desktop\HealthCare Revenue Recycle\Data\staging' # Using absolute path for clarity
+
+# Fact tables are hive-partitioned as <table>/source_hospital=.../service_year=.../service_month=.../,
+# so readers filtering on these columns only open the matching directories. The partition values live
+# in the directory names, not in the files. Dimensions are small and stay single <table>.parquet files.
+PARTITION_COLUMNS = {
+    'fact_transactions': ['source_hospital', 'service_year', 'service_month'],
+    'fact_claims': ['source_hospital', 'service_year', 'service_month'],
+}
+ROW_GROUP_SIZE = 128_000  # Rows per row group: large enough for efficient scans, small enough for statistics to prune.
+PARQUET_OPTIONS = {'compression': 'zstd', 'write_statistics': True}
+NULL_PARTITION = '__HIVE_DEFAULT_PARTITION__'  # Directory value of a null partition key, as pyarrow reads it back.
+EXTRACT_MANIFEST = '_extract.json'  # Records whether the staged facts hold every source row or only an incremental delta.
+
+def table_path(name, staging_dir=STAGING_DIR):
+    return os.path.join(staging_dir, name if name in PARTITION_COLUMNS else f"{name}.parquet")
+
+def list_tables(staging_dir=STAGING_DIR):
+    """Names of the staged tables: partitioned table directories and single-file tables."""
+    if not os.path.isdir(staging_dir): return []
+    names = [entry for entry in os.listdir(staging_dir) if entry in PARTITION_COLUMNS and os.path.isdir(os.path.join(staging_dir, entry))]
+    names += [entry[:-len('.parquet')] for entry in os.listdir(staging_dir) if entry.endswith('.parquet') and os.path.isfile(os.path.join(staging_dir, entry))]
+    return sorted(names)
+
+def mark_extract(staging_dir=STAGING_DIR, incremental=False):
+    """Records how the staged tables were extracted; a delta must be upserted into the warehouse, never replace it."""
+    os.makedirs(staging_dir, exist_ok=True)
+    path = os.path.join(staging_dir, EXTRACT_MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'incremental': bool(incremental)}, f)
+    os.replace(path + '.tmp', path)
+
+def staged_incrementally(staging_dir=STAGING_DIR) -> bool:
+    """Whether the staged facts hold only an incremental delta (False for staging written before the manifest existed)."""
+    path = os.path.join(staging_dir, EXTRACT_MANIFEST)
+    if not os.path.exists(path): return False
+    with open(path) as f:
+        return json.load(f).get('incremental', False)
+
+def add_partition_columns(fact_df: pd.DataFrame) -> pd.DataFrame:
+    """Derives the service year and month from the YYYYMMDD date_sk with integer arithmetic."""
+    date_sk = fact_df['date_sk'].astype('Int64')
+    return fact_df.assign(service_year=date_sk // 10000, service_month=date_sk // 100 % 100)
+
+def write_parquet_file(df: pd.DataFrame, path):
+    """Writes one frame to a single Parquet file with the staging compression and row-group settings."""
+    df.to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE, **PARQUET_OPTIONS)
+
+class StagingWriter:
+    """
+    Writes one staging table from one or more DataFrame batches, replacing any previous version.
+    Rows are buffered per partition and flushed as row groups of about ROW_GROUP_SIZE rows into one
+    file per partition directory (or the single file of an unpartitioned table).
+    """
+    def __init__(self, name, staging_dir=STAGING_DIR, schema=None):
+        self.name, self.path, self.schema = name, table_path(name, staging_dir), schema
+        self.partition_columns = PARTITION_COLUMNS.get(name, [])
+        self.writers, self.buffers, self.rows = {}, {}, 0
+        if os.path.isdir(self.path): shutil.rmtree(self.path)
+        elif os.path.exists(self.path): os.remove(self.path)
+        os.makedirs(self.path if self.partition_columns else staging_dir, exist_ok=True)
+
+    def _partition_path(self, key):
+        if not self.partition_columns: return self.path
+        parts = [f"{col}={NULL_PARTITION if pd.isna(value) else value}" for col, value in zip(self.partition_columns, key)]
+        return os.path.join(self.path, *parts, 'part-00000.parquet')
+
+    def write(self, df: pd.DataFrame):
+        if df.empty and self.partition_columns: return
+        if not self.partition_columns:
+            self._buffer((), df)
+        else:
+            df = add_partition_columns(df)
+            for key, part in df.groupby(self.partition_columns, sort=False, dropna=False, observed=True):
+                self._buffer(key, part.drop(columns=self.partition_columns))
+        self.rows += len(df)
+
+    def _buffer(self, key, df):
+        self.buffers.setdefault(key, []).append(df)
+        if sum(len(frame) for frame in self.buffers[key]) >= ROW_GROUP_SIZE:
+            self._flush(key)
+
+    def _flush(self, key):
+        frames = self.buffers.pop(key, [])
+        if not frames: return
+        if self.schema is None:
+            self.schema = pa.Schema.from_pandas(frames[0], preserve_index=False)
+        table = pa.Table.from_pandas(pd.concat(frames, ignore_index=True), schema=self.schema, preserve_index=False)
+        if key not in self.writers:
+            path = self._partition_path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.writers[key] = pq.ParquetWriter(path, self.schema, **PARQUET_OPTIONS)
+        self.writers[key].write_table(table, row_group_size=ROW_GROUP_SIZE)
+
+    def close(self):
+        for key in list(self.buffers):
+            self._flush(key)
+        for writer in self.writers.values():
+            writer.close()
+        logging.info(f"  > Saved {self.name} with {self.rows} rows in {len(self.writers)} file(s).")
+
+@instrument('staging.write.{name}')
+def write_table(df: pd.DataFrame, name, staging_dir=STAGING_DIR, schema=None):
+    """Stages a whole table in one call."""
+    writer = StagingWriter(name, staging_dir, schema)
+    try:
+        writer.write(df)
+    finally:
+        writer.close()
+
+def read_table(name, staging_dir=STAGING_DIR, columns=None, filters=None, as_arrow=False):
+    """
+    Reads a staged table, pushing `columns` and `filters` down to the scan. Filters use the pyarrow
+    form, e.g. [('source_hospital', '=', 'hospital_a'), ('service_year', '=', 2024)]: filters on
+    partition columns skip whole directories and the rest are checked against row-group statistics,
+    so only the matching partitions, row groups and columns are read. Returns a DataFrame, or the
+    pyarrow Table when `as_arrow` is set.
+    """
+    partitioning = ds.HivePartitioning.discover(infer_dictionary=False) if name in PARTITION_COLUMNS else None
+    table = pq.read_table(table_path(name, staging_dir), columns=columns, filters=filters, partitioning=partitioning)
+    return table if as_arrow else table.to_pandas()
@@ -0,0 +1,360 @@
+# SYNTHETIC DATA: Schema-faithful hospital databases and claims files at any scale, for benchmarks and load tests
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import argparse
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import zlib
+
+from extraction import CLAIMS_SCHEMA
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
+
+HOSPITAL_DBS_DIR = './SQL/hospital_dbs'
+SYNTHETIC_DIR = './Data/synthetic'
+CHUNK_ROWS = 1_000_000  # Rows generated and written per batch, so memory stays flat at 10^8 rows.
+DATA_START, DATA_DAYS = np.datetime64('2020-01-01'), 5 * 365
+CHANGE_DATE = np.datetime64('2025-01-01')  # ModifiedDate of rows changed in generation g is CHANGE_DATE + g days.
+
+# Source column names of the sample DDLs that differ from the common data model (hospital 2's patients).
+COLUMN_ALIASES = {'patients': {'ID': 'PatientID', 'F_Name': 'FirstName', 'L_Name': 'LastName', 'M_Name': 'MiddleName'}}
+
+# Declared DDL types and the Arrow types the generated columns are cast to.
+DDL_TYPES = {'nvarchar': pa.string(), 'varchar': pa.string(), 'date': pa.date32(), 'int': pa.int64(), 'bigint': pa.int64(), 'float': pa.float64()}
+
+FIRST_NAMES = ['James', 'Mary', 'Robert', 'Patricia', 'John', 'Jennifer', 'Michael', 'Linda', 'David', 'Elizabeth', 'William', 'Barbara',
+               'Richard', 'Susan', 'Joseph', 'Jessica', 'Thomas', 'Sarah', 'Carlos', 'Karen', 'Daniel', 'Lisa', 'Anthony', 'Nancy']
+LAST_NAMES = ['Smith', 'Johnson', 'Williams', 'Brown', 'Jones', 'Garcia', 'Miller', 'Davis', 'Rodriguez', 'Martinez', 'Hernandez', 'Lopez',
+              'Gonzalez', 'Wilson', 'Anderson', 'Thomas', 'Taylor', 'Moore', 'Jackson', 'Martin', 'Lee', 'Perez', 'Thompson', 'White']
+STREETS = ['Main', 'Oak', 'Pine', 'Maple', 'Cedar', 'Elm', 'Washington', 'Lake', 'Hill', 'Park', 'River', 'Sunset']
+STREET_SUFFIXES = ['St', 'Ave', 'Rd', 'Blvd', 'Ln', 'Dr']
+CITIES = ['Springfield', 'Riverside', 'Franklin', 'Greenville', 'Bristol', 'Clinton', 'Fairview', 'Salem', 'Madison', 'Georgetown']
+STATES = ['CA', 'TX', 'NY', 'FL', 'IL', 'PA', 'OH', 'GA', 'NC', 'MI']
+DEPARTMENT_NAMES = ['Emergency', 'Cardiology', 'Neurology', 'Oncology', 'Pediatrics', 'Orthopedics', 'Radiology', 'Dermatology',
+                    'Gastroenterology', 'Urology', 'Nephrology', 'Pulmonology', 'Endocrinology', 'Psychiatry', 'Ophthalmology',
+                    'Obstetrics', 'Anesthesiology', 'Pathology', 'Rheumatology', 'General Surgery']
+SPECIALIZATIONS = ['Cardiology', 'Oncology', 'Emergency Medicine', 'Pediatrics', 'Neurology', 'Orthopedics', 'Family Medicine',
+                   'Internal Medicine', 'Radiology', 'Dermatology', 'Psychiatry', 'General Surgery']
+ENCOUNTER_TYPES = ['Inpatient', 'Outpatient', 'Emergency', 'Telehealth']
+VISIT_TYPES = ['Routine', 'Emergency', 'Follow-up', 'Consultation']
+AMOUNT_TYPES = ['Medicare', 'Medicaid', 'Insurance', 'Co-pay', 'Self-pay']
+LINES_OF_BUSINESS = ['Commercial', 'Medicare', 'Medicaid', 'Self-Pay']
+CLAIM_PAYORS = ['Medicare', 'Medicaid', 'BlueCross', 'Aetna', 'Cigna', 'UnitedHealth']
+CLAIM_STATUSES = ['Approved', 'Pending', 'Denied', 'Paid']
+PAYOR_TYPES = ['Medicare', 'Medicaid', 'Private', 'Self-pay']
+
+def parse_ddl(path) -> dict:
+    """{table: [(column, Arrow type)]} from the CREATE TABLE statements of a ddl.sql, in declared order."""
+    with open(path) as f:
+        sql = f.read()
+    tables = {}
+    for table_name, body in re.findall(r'CREATE TABLE (\w+)\s*\((.*?)\n\);', sql, flags=re.S | re.I):
+        columns = [re.match(r'\s*(\w+)\s+(\w+)', line).groups() for line in body.strip().splitlines()
+                   if line.strip() and not line.strip().upper().startswith('CONSTRAINT')]
+        tables[table_name] = [(name, DDL_TYPES[sql_type.lower()]) for name, sql_type in columns]
+    return tables
+
+def create_table_statements(path) -> list:
+    with open(path) as f:
+        return re.findall(r'CREATE TABLE .*?\n\);', f.read(), flags=re.S | re.I)
+
+def hospital_name(number):
+    """hospital_a for hospital 1, hospital_b for hospital 2, and so on."""
+    return f"hospital_{chr(ord('a') + number - 1)}"
+
+def _mix(x):
+    """splitmix64 finalizer: a fast, well-distributed uint64 hash, applied element-wise."""
+    with np.errstate(over='ignore'):
+        x = x + np.uint64(0x9E3779B97F4A7C15)
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+def _pad(numbers, width):
+    return pc.utf8_lpad(pc.cast(pa.array(numbers), pa.string()), width, padding='0')
+
+def _join(*parts):
+    return pc.binary_join_element_wise(*parts, '')
+
+def _choose(values, codes):
+    return pa.DictionaryArray.from_arrays(pa.array(codes.astype(np.int32)), pa.array(values)).dictionary_decode()
+
+class SyntheticDataGenerator:
+    """
+    Generates the hospital tables declared in each hospital's ddl.sql, plus its claims file (columns of
+    extraction.CLAIMS_SCHEMA), for `n_hospitals` hospitals with `rows_per_hospital` transactions, encounters
+    and claims each. Every value is a hash of (seed, hospital, row, column), so any chunk of any table can be
+    generated on its own, references between tables always resolve, and reruns are identical.
+
+    `key_skew` concentrates encounters, transactions and procedure codes on a few hot keys (0 is uniform; at 2
+    the hottest 1% of patients get about a fifth of all encounters). Generation g > 0 is the same data after g
+    rounds of changes: each round changes the Address and LastName of `scd_change_rate` of the patients and the
+    Specialization of that share of providers, bumping their ModifiedDate, as the SCD Type 2 phase expects.
+    `shared_patient_rate` of the patients of every hospital after the first are the same person as hospital 1's
+    patient of the same row (same name, SSN, DOB, phone and gender), for patient matching to find.
+    """
+    def __init__(self, rows_per_hospital=10_000, n_hospitals=2, seed=42, key_skew=0.0, scd_change_rate=0.05,
+                 ddl_dir=HOSPITAL_DBS_DIR, chunk_rows=CHUNK_ROWS, shared_patient_rate=0.0):
+        self.rows, self.n_hospitals, self.seed = rows_per_hospital, n_hospitals, seed
+        self.key_skew, self.scd_change_rate, self.chunk_rows = key_skew, scd_change_rate, chunk_rows
+        self.shared_patient_rate = shared_patient_rate
+        self.ddl_dir = ddl_dir
+        self.sizes = {'departments': len(DEPARTMENT_NAMES), 'providers': max(25, rows_per_hospital // 400),
+                      'patients': max(100, rows_per_hospital // 2), 'encounters': rows_per_hospital,
+                      'transactions': rows_per_hospital, 'claims': rows_per_hospital}
+        self.id_width = max(6, len(str(rows_per_hospital)))
+
+    def ddl_path(self, hospital):
+        """Hospitals with a sample database use its DDL (hospital 2 names its patient columns differently); others use hospital 1's."""
+        path = os.path.join(self.ddl_dir, f"hospital{hospital}_db", 'ddl.sql')
+        return path if os.path.exists(path) else os.path.join(self.ddl_dir, 'hospital1_db', 'ddl.sql')
+
+    def schema(self, hospital) -> dict:
+        tables = parse_ddl(self.ddl_path(hospital))
+        tables['claims'] = [(field.name, pa.string() if pa.types.is_dictionary(field.type) else
+                             pa.date32() if pa.types.is_timestamp(field.type) else field.type) for field in CLAIMS_SCHEMA]
+        return tables
+
+    # --- Deterministic randomness: every draw is a function of (seed, hospital, salt, row) ---
+    def _hash(self, hospital, salt, rows):
+        stream = np.uint64(zlib.crc32(f"{self.seed}:{hospital}:{salt}".encode()))
+        return _mix(rows.astype(np.uint64) ^ _mix(np.full(1, stream))[0])
+
+    def _unit(self, hospital, salt, rows):
+        return (self._hash(hospital, salt, rows) >> np.uint64(11)).astype(np.float64) / 2.0**53
+
+    def _pick(self, hospital, salt, rows, n, skewed=False):
+        """Integers in [0, n); with `skewed`, low values are hot keys (u ** (1 + key_skew) piles mass near 0)."""
+        unit = self._unit(hospital, salt, rows)
+        if skewed and self.key_skew: unit = unit ** (1.0 + self.key_skew)
+        return np.minimum((unit * n).astype(np.int64), n - 1)
+
+    def _changed_in(self, hospital, salt, rows, generation):
+        """The last generation (1..generation) in which each row changed, 0 for never."""
+        last = np.zeros(len(rows), dtype=np.int64)
+        for g in range(1, generation + 1):
+            last[self._unit(hospital, f"{salt}.change{g}", rows) < self.scd_change_rate] = g
+        return last
+
+    # --- Keys shared between tables ---
+    def _patient_id(self, hospital, patients):
+        return _join(f"HOSP{hospital}-", _pad(patients + 1, 6))
+    def _provider_id(self, hospital, providers):
+        return _join(f"H{hospital}-PROV", _pad(providers + 1, 4))
+    def _dept_id(self, departments):
+        return _join("DEPT", _pad(departments + 1, 3))
+    def _encounter_of(self, hospital, transactions):
+        return self._pick(hospital, 'transaction.encounter', transactions, self.sizes['encounters'], skewed=True)
+    def _patient_of(self, hospital, encounters):
+        return self._pick(hospital, 'encounter.patient', encounters, self.sizes['patients'], skewed=True)
+    def _provider_of(self, hospital, encounters):
+        return self._pick(hospital, 'encounter.provider', encounters, self.sizes['providers'])
+    def _department_of(self, hospital, providers):
+        return self._pick(hospital, 'provider.department', providers, self.sizes['departments'])
+    def _procedure_of(self, hospital, encounters):
+        return 10000 + self._pick(hospital, 'encounter.procedure', encounters, 90000, skewed=True)
+    def _encounter_day(self, hospital, encounters):
+        return self._pick(hospital, 'encounter.date', encounters, DATA_DAYS)
+    def _amount(self, hospital, transactions):
+        return np.round(20 + 800 * -np.log1p(-self._unit(hospital, 'transaction.amount', transactions)), 2)
+
+    # --- Tables: each returns {canonical column: array} for the given rows ---
+    def _departments(self, hospital, rows, generation):
+        return {'DeptID': self._dept_id(rows), 'Name': _choose(DEPARTMENT_NAMES, rows % len(DEPARTMENT_NAMES))}
+
+    def _providers(self, hospital, rows, generation):
+        changed = self._changed_in(hospital, 'provider', rows, generation)
+        return {
+            'ProviderID': self._provider_id(hospital, rows),
+            'FirstName': _choose(FIRST_NAMES, self._pick(hospital, 'provider.first', rows, len(FIRST_NAMES))),
+            'LastName': _choose(LAST_NAMES, self._pick(hospital, 'provider.last', rows, len(LAST_NAMES))),
+            'Specialization': _choose(SPECIALIZATIONS, (self._pick(hospital, 'provider.specialization', rows, len(SPECIALIZATIONS)) + changed) % len(SPECIALIZATIONS)),
+            'DeptID': self._dept_id(self._department_of(hospital, rows)),
+            'NPI': 1_000_000_000 + self._pick(hospital, 'provider.npi', rows, 9_000_000_000),
+        }
+
+    def _address(self, hospital, rows, salt):
+        pick = lambda part, n: self._pick(hospital, f"{salt}.{part}", rows, n)
+        return _join(pc.cast(pa.array(1 + pick('number', 9999)), pa.string()), ' ', _choose(STREETS, pick('street', len(STREETS))), ' ',
+                     _choose(STREET_SUFFIXES, pick('suffix', len(STREET_SUFFIXES))), ', ', _choose(CITIES, pick('city', len(CITIES))), ', ',
+                     _choose(STATES, pick('state', len(STATES))), ' ', _pad(pick('zip', 100000), 5))
+
+    def _person(self, hospital, rows):
+        """The identity draws of each patient row; shared patients take those of hospital 1's patient of the same row."""
+        pick = lambda salt, n: self._pick(hospital, f"patient.{salt}", rows, n)
+        person = {'first': pick('first', len(FIRST_NAMES)), 'last': pick('last', len(LAST_NAMES)), 'ssn1': pick('ssn1', 899),
+                  'ssn2': pick('ssn2', 99), 'ssn3': pick('ssn3', 9999), 'area': pick('area', 800), 'exchange': pick('exchange', 1000),
+                  'line': pick('line', 10000), 'gender': pick('gender', 2), 'dob': pick('dob', 90 * 365)}
+        if hospital > 1 and self.shared_patient_rate:
+            shared = self._unit(hospital, 'patient.shared', rows) < self.shared_patient_rate
+            first_hospital = self._person(1, rows)
+            person = {draw: np.where(shared, first_hospital[draw], values) for draw, values in person.items()}
+        return person
+
+    def _patients(self, hospital, rows, generation):
+        changed = self._changed_in(hospital, 'patient', rows, generation)
+        pick = lambda salt, n: self._pick(hospital, f"patient.{salt}", rows, n)
+        person = self._person(hospital, rows)
+        last_name = (person['last'] + changed) % len(LAST_NAMES)
+        address = self._address(hospital, rows, 'patient.address')
+        for g in range(1, generation + 1):
+            if (changed == g).any():
+                address = pc.if_else(pa.array(changed == g), self._address(hospital, rows, f"patient.address{g}"), address)
+        modified = np.where(changed > 0, (CHANGE_DATE + changed).astype('datetime64[D]'), (DATA_START + pick('modified', DATA_DAYS)).astype('datetime64[D]'))
+        return {
+            'PatientID': self._patient_id(hospital, rows),
+            'FirstName': _choose(FIRST_NAMES, person['first']),
+            'LastName': _choose(LAST_NAMES, last_name),
+            'MiddleName': _choose([chr(c) for c in range(ord('A'), ord('Z') + 1)], pick('middle', 26)),
+            'SSN': _join(_pad(1 + person['ssn1'], 3), '-', _pad(1 + person['ssn2'], 2), '-', _pad(1 + person['ssn3'], 4)),
+            'PhoneNumber': _join(_pad(200 + person['area'], 3), '-', _pad(person['exchange'], 3), '-', _pad(person['line'], 4)),
+            'Gender': _choose(['Male', 'Female'], person['gender']),
+            'DOB': pa.array((np.datetime64('1930-01-01') + person['dob']).astype('datetime64[D]'), pa.date32()),
+            'Address': address,
+            'ModifiedDate': pa.array(modified, pa.date32()),
+        }
+
+    def _encounters(self, hospital, rows, generation):
+        day = self._encounter_day(hospital, rows)
+        providers = self._provider_of(hospital, rows)
+        inserted = day + self._pick(hospital, 'encounter.inserted', rows, 30)
+        return {
+            'EncounterID': _join("ENC", _pad(rows + 1, self.id_width)),
+            'PatientID': self._patient_id(hospital, self._patient_of(hospital, rows)),
+            'EncounterDate': pa.array((DATA_START + day).astype('datetime64[D]'), pa.date32()),
+            'EncounterType': _choose(ENCOUNTER_TYPES, self._pick(hospital, 'encounter.type', rows, len(ENCOUNTER_TYPES))),
+            'ProviderID': self._provider_id(hospital, providers),
+            'DepartmentID': self._dept_id(self._department_of(hospital, providers)),
+            'ProcedureCode': self._procedure_of(hospital, rows),
+            'InsertedDate': pa.array((DATA_START + inserted).astype('datetime64[D]'), pa.date32()),
+            'ModifiedDate': pa.array((DATA_START + inserted + self._pick(hospital, 'encounter.modified', rows, 60)).astype('datetime64[D]'), pa.date32()),
+        }
+
+    def _transactions(self, hospital, rows, generation):
+        encounters = self._encounter_of(hospital, rows)
+        providers = self._provider_of(hospital, encounters)
+        visit = self._encounter_day(hospital, encounters)
+        service = visit + self._pick(hospital, 'transaction.service', rows, 4)
+        paid = service + 5 + self._pick(hospital, 'transaction.paid', rows, 56)
+        amount = self._amount(hospital, rows)
+        as_date = lambda days: pa.array((DATA_START + days).astype('datetime64[D]'), pa.date32())
+        pick = lambda salt, n: self._pick(hospital, f"transaction.{salt}", rows, n)
+        return {
+            'TransactionID': _join("TRANS", _pad(rows + 1, self.id_width)),
+            'EncounterID': _join("ENC", _pad(encounters + 1, self.id_width)),
+            'PatientID': self._patient_id(hospital, self._patient_of(hospital, encounters)),
+            'ProviderID': self._provider_id(hospital, providers),
+            'DeptID': self._dept_id(self._department_of(hospital, providers)),
+            'VisitDate': as_date(visit), 'ServiceDate': as_date(service), 'PaidDate': as_date(paid),
+            'VisitType': _choose(VISIT_TYPES, pick('visit_type', len(VISIT_TYPES))),
+            'Amount': amount,
+            'AmountType': _choose(AMOUNT_TYPES, pick('amount_type', len(AMOUNT_TYPES))),
+            'PaidAmount': np.round(amount * (0.2 + 0.8 * self._unit(hospital, 'transaction.paid_share', rows)), 2),
+            'ClaimID': _join("CLAIM", _pad(rows + 1, self.id_width)),
+            'PayorID': _join("PAYOR", _pad(pick('payor', 10000), 4)),
+            'ProcedureCode': self._procedure_of(hospital, encounters),
+            'ICDCode': _join(_choose([chr(c) for c in range(ord('A'), ord('Z') + 1)], pick('icd_chapter', 26)), _pad(pick('icd_code', 100), 2), '.', _pad(pick('icd_sub', 10), 1)),
+            'LineOfBusiness': _choose(LINES_OF_BUSINESS, pick('lob', len(LINES_OF_BUSINESS))),
+            'MedicaidID': _join("MEDI", _pad(pick('medicaid', 100000), 5)),
+            'MedicareID': _join("MCARE", _pad(pick('medicare', 100000), 5)),
+            'InsertDate': as_date(paid), 'ModifiedDate': as_date(paid + pick('modified', 30)),
+        }
+
+    def _claims(self, hospital, rows, generation):
+        """One claim per transaction: claim i bills transaction i."""
+        transactions = self._transactions(hospital, rows, generation)
+        amount = self._amount(hospital, rows)
+        pick = lambda salt, n: self._pick(hospital, f"claim.{salt}", rows, n)
+        claim_date = pc.cast(pc.add(pc.cast(transactions['ServiceDate'], pa.int32()), pa.array(pick('claim_date', 11).astype(np.int32))), pa.date32())
+        return {
+            'ClaimID': transactions['ClaimID'], 'TransactionID': transactions['TransactionID'], 'PatientID': transactions['PatientID'],
+            'EncounterID': transactions['EncounterID'], 'ProviderID': transactions['ProviderID'], 'DeptID': transactions['DeptID'],
+            'ServiceDate': transactions['ServiceDate'], 'ClaimDate': claim_date,
+            'PayorID': _choose(CLAIM_PAYORS, pick('payor', len(CLAIM_PAYORS))),
+            'ClaimAmount': amount, 'PaidAmount': transactions['PaidAmount'],
+            'ClaimStatus': _choose(CLAIM_STATUSES, pick('status', len(CLAIM_STATUSES))),
+            'PayorType': _choose(PAYOR_TYPES, pick('payor_type', len(PAYOR_TYPES))),
+            'Deductible': np.round(amount * 0.1 * self._unit(hospital, 'claim.deductible', rows), 2),
+            'Coinsurance': np.round(amount * 0.2 * self._unit(hospital, 'claim.coinsurance', rows), 2),
+            'Copay': np.round(5 + 45 * self._unit(hospital, 'claim.copay', rows), 2),
+            'InsertDate': transactions['InsertDate'], 'ModifiedDate': transactions['ModifiedDate'],
+        }
+
+    def generate(self, hospital, table, generation=0):
+        """Yields `table` of hospital number `hospital` as Arrow tables of up to chunk_rows rows,
+        with the column names and types of that hospital's DDL."""
+        columns = self.schema(hospital)[table]
+        renames = COLUMN_ALIASES.get(table, {})
+        build = getattr(self, f"_{table}")
+        for offset in range(0, self.sizes[table], self.chunk_rows):
+            rows = np.arange(offset, min(offset + self.chunk_rows, self.sizes[table]), dtype=np.int64)
+            values = build(hospital, rows, generation)
+            missing = [name for name, _ in columns if renames.get(name, name) not in values]
+            if missing: raise ValueError(f"No generator for column(s) {missing} of '{table}'.")
+            yield pa.table({name: pa.array(values[renames.get(name, name)]).cast(arrow_type) for name, arrow_type in columns})
+
+    def write(self, out_dir=SYNTHETIC_DIR, generation=0) -> str:
+        """Writes the data in the layout of the samples: hospital_dbs/hospital<N>_db/<table>.csv with its
+        ddl.sql, and claims/hospital<N>_claim_data.csv. Returns `out_dir`."""
+        for hospital in range(1, self.n_hospitals + 1):
+            db_dir = os.path.join(out_dir, 'hospital_dbs', f"hospital{hospital}_db")
+            os.makedirs(db_dir, exist_ok=True)
+            shutil.copyfile(self.ddl_path(hospital), os.path.join(db_dir, 'ddl.sql'))
+            targets = [(table, os.path.join(db_dir, f"{table}.csv")) for table in parse_ddl(self.ddl_path(hospital))]
+            targets.append(('claims', os.path.join(out_dir, 'claims', f"hospital{hospital}_claim_data.csv")))
+            for table, path in targets:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                writer = None
+                for chunk in self.generate(hospital, table, generation):
+                    writer = writer or pa_csv.CSVWriter(path, chunk.schema)
+                    writer.write_table(chunk)
+                writer.close()
+            logging.info(f"  > Wrote {hospital_name(hospital)} ({self.rows} transactions) to '{out_dir}'.")
+        return out_dir
+
+    def load_sqlite(self, out_dir=SYNTHETIC_DIR, generation=0) -> dict:
+        """
+        Creates one SQLite database per hospital from the DDL and fills it with the generated tables,
+        as a local stand-in for the MySQL sources. Returns extraction-style DB configs that point
+        DataExtractor at them: {'hospital_a': {'url': 'sqlite:///...'}, ...}.
+        """
+        configs = {}
+        os.makedirs(os.path.join(out_dir, 'sqlite'), exist_ok=True)
+        for hospital in range(1, self.n_hospitals + 1):
+            path = os.path.abspath(os.path.join(out_dir, 'sqlite', f"{hospital_name(hospital)}.db"))
+            if os.path.exists(path): os.remove(path)
+            with sqlite3.connect(path) as connection:
+                for statement in create_table_statements(self.ddl_path(hospital)):
+                    connection.execute(statement)
+                for table in parse_ddl(self.ddl_path(hospital)):
+                    for chunk in self.generate(hospital, table, generation):
+                        chunk = pa.table({name: pc.cast(col, pa.string()) if pa.types.is_date32(col.type) else col
+                                          for name, col in zip(chunk.column_names, chunk.columns)})
+                        placeholders = ', '.join('?' * chunk.num_columns)
+                        for batch in chunk.to_batches(max_chunksize=100_000):
+                            connection.executemany(f"INSERT INTO {table} VALUES ({placeholders})", zip(*(col.to_pylist() for col in batch.columns)))
+            configs[hospital_name(hospital)] = {'url': f"sqlite:///{path}"}
+            logging.info(f"  > Loaded {hospital_name(hospital)} into SQLite database '{path}'.")
+        return configs
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates synthetic hospital databases and claims files from the DDL.")
+    parser.add_argument('--rows', type=int, default=10_000, help="Transactions, encounters and claims per hospital (10^4 to 10^8).")
+    parser.add_argument('--hospitals', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--skew', type=float, default=0.0, help="Key skew: 0 is uniform, higher concentrates rows on hot keys.")
+    parser.add_argument('--change-rate', type=float, default=0.05, help="Share of patients and providers changed per generation.")
+    parser.add_argument('--generation', type=int, default=0, help="Number of SCD change rounds applied.")
+    parser.add_argument('--shared-patients', type=float, default=0.0, help="Share of each later hospital's patients who are also hospital 1's patients.")
+    parser.add_argument('--out', default=SYNTHETIC_DIR)
+    parser.add_argument('--sqlite', action='store_true', help="Also load the databases into SQLite.")
+    args = parser.parse_args()
+    generator = SyntheticDataGenerator(args.rows, args.hospitals, args.seed, args.skew, args.change_rate, shared_patient_rate=args.shared_patients)
+    generator.write(args.out, args.generation)
+    if args.sqlite:
+        generator.load_sqlite(args.out, args.generation)
@@ -2,34 +2,72 @@
 # Import Necessary Libraries ---
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import logging
 from datetime import datetime
 
 # Import the REAL data handoff from our extraction script
 from extraction import run_extraction
+from key_registry import open_registry, KEY_REGISTRY_DIR
+from patient_matching import open_matcher
+from instrumentation import instrument
 
 #Configure Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - [%(filename)s] - %(message)s')
 
+# Low-cardinality columns stored as pandas categoricals by the compaction pass.
+CATEGORICAL_COLUMNS = ['Gender', 'source_hospital', 'ClaimStatus', 'PayorType', 'PayorID', 'AmountType',
+                       'VisitType', 'LineOfBusiness', 'EncounterType', 'Specialization']
+
+# Vectorized string helpers: these run on Arrow buffers, never on one Python object per row ---
+def _title_case(series: pd.Series) -> pd.Series:
+    titled = pc.utf8_title(pa.array(series.astype(object).where(series.notna(), None), type=pa.string(), from_pandas=True))
+    return pd.Series(titled.to_numpy(zero_copy_only=False), index=series.index)
+
+def _keep_digits(series: pd.Series) -> pd.Series:
+    """Equivalent of str.replace(r'\D', '') done with one mask over the UTF-8 bytes of the whole column.
+    Multi-byte characters never contain ASCII digit bytes, so dropping non-digit bytes drops them whole."""
+    arr = pa.array(series.astype(object).where(series.notna(), None), type=pa.string(), from_pandas=True)
+    offsets = np.frombuffer(arr.buffers()[1], dtype=np.int32, count=len(arr) + 1)
+    data = np.frombuffer(arr.buffers()[2], dtype=np.uint8, count=offsets[-1]) if arr.buffers()[2] is not None else np.empty(0, dtype=np.uint8)
+    keep = (data >= ord('0')) & (data <= ord('9'))
+    kept_before = np.concatenate([[0], np.cumsum(keep, dtype=np.int64)])
+    digits = pa.StringArray.from_buffers(len(arr), pa.py_buffer(kept_before[offsets].astype(np.int32)), pa.py_buffer(data[keep].tobytes()), arr.buffers()[0])
+    return pd.Series(digits.to_numpy(zero_copy_only=False), index=series.index)
+
+def _map_distinct(series: pd.Series, func) -> pd.Series:
+    """Applies `func` to the distinct values only and broadcasts the result back by position."""
+    codes, uniques = pd.factorize(series)
+    mapped = pd.Series(func(pd.Series(uniques, dtype=object))).to_numpy(dtype=object)
+    result = np.full(len(codes), None, dtype=object)
+    result[codes >= 0] = mapped[codes[codes >= 0]]
+    return pd.Series(result, index=series.index)
+
 #Define the Data Transformer Class ---
 class DataTransformer:
     """A collection of functions for cleaning and enriching our healthcare data."""
-    # (The contents of this class are perfect and need no changes)
+    def __init__(self, registry_dir=KEY_REGISTRY_DIR):
+        self.registry_dir = registry_dir
+
+    @instrument('transform.clean.patients')
     def clean_and_enrich_patients(self, patients_df: pd.DataFrame) -> pd.DataFrame:
         if patients_df.empty: return patients_df
         logging.info(f"Transforming {len(patients_df)} patient records...")
-        for col in ['FirstName', 'LastName', 'MiddleName']:
-            patients_df[col] = patients_df[col].str.title().fillna('Unknown')
+        for col in [c for c in ['FirstName', 'LastName', 'MiddleName'] if c in patients_df.columns]:
+            patients_df[col] = _title_case(patients_df[col]).fillna('Unknown')
         gender_map = {'M': 'Male', 'F': 'Female', 'O': 'Other'}
-        patients_df['Gender'] = patients_df['Gender'].str.upper().map(gender_map).fillna('Unknown')
-        patients_df['PhoneNumber'] = patients_df['PhoneNumber'].astype(str).str.replace(r'\D', '', regex=True).fillna('')
+        patients_df['Gender'] = _map_distinct(patients_df['Gender'], lambda g: g.str.upper().map(gender_map)).fillna('Unknown')
+        patients_df['PhoneNumber'] = _keep_digits(patients_df['PhoneNumber']).fillna('')
         patients_df['DOB'] = pd.to_datetime(patients_df['DOB'], errors='coerce')
+        # Age in whole years: subtract one when this year's birthday (as month*100 + day) is still ahead.
         current_date = datetime.now()
-        patients_df['age'] = patients_df['DOB'].apply(
-            lambda dob: current_date.year - dob.year - ((current_date.month, current_date.day) < (dob.month, dob.day)) if pd.notnull(dob) else None
-        )
+        dob = patients_df['DOB'].dt
+        birthday_ahead = (dob.month * 100 + dob.day) > (current_date.month * 100 + current_date.day)
+        patients_df['age'] = current_date.year - dob.year - birthday_ahead.astype(int)
         return patients_df
 
+    @instrument('transform.clean.claims')
     def clean_and_enrich_claims(self, claims_df: pd.DataFrame) -> pd.DataFrame:
         if claims_df.empty: return claims_df
         logging.info(f"Transforming {len(claims_df)} claim records...")
@@ -43,27 +81,71 @@ class DataTransformer:
         claims_df['claim_month'] = claims_df['ServiceDate'].dt.month
         return claims_df
 
+    @instrument('transform.surrogate_keys')
     def generate_surrogate_keys(self, database_data: dict) -> dict:
+        """Looks up each member's stable surrogate key in the on-disk key registry,
+        allocating keys only for members never seen before. Patients also get the enterprise patient ID
+        of the person they are across hospitals; only patients new to the match index are matched."""
         logging.info("Generating surrogate keys...")
-        dimensions_and_keys = {'patients': ['unified_patient_id'], 'providers': ['ProviderID', 'source_hospital'], 'departments': ['DeptID', 'source_hospital']}
-        for name, natural_key in dimensions_and_keys.items():
-            if name in database_data and not database_data[name].empty:
-                df = database_data[name]
-                unique_members = df[natural_key].drop_duplicates().reset_index(drop=True)
-                surrogate_key_col = f"{name.rstrip('s')}_sk"
-                unique_members[surrogate_key_col] = unique_members.index
-                database_data[name] = pd.merge(df, unique_members, on=natural_key, how='left')
+        for name in ['patients', 'providers', 'departments']:
+            if name in database_data:
+                registry = open_registry(name, self.registry_dir)
+                database_data[name][registry.surrogate_key] = registry.assign(database_data[name])
+        if 'patients' in database_data and not database_data['patients'].empty:
+            database_data['patients']['enterprise_patient_id'] = open_matcher(self.registry_dir).assign(database_data['patients'])
         return database_data
 
-def run_all_transformations(extracted_db_data: dict, extracted_claims_data: pd.DataFrame) -> (dict, pd.DataFrame):
+    @instrument('transform.compact.{table_name}')
+    def compact_dtypes(self, df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+        """Shrinks a table in place: downcasts ints, downcasts floats where float32 is lossless,
+        and turns the CATEGORICAL_COLUMNS into categoricals. Logs the bytes saved."""
+        if df.empty: return df
+        before = df.memory_usage(deep=True).sum()
+        for col in df.columns:
+            series = df[col]
+            if col in CATEGORICAL_COLUMNS:
+                if not isinstance(series.dtype, pd.CategoricalDtype):
+                    df[col] = series.astype('category')
+            elif pd.api.types.is_integer_dtype(series.dtype) and not pd.api.types.is_extension_array_dtype(series.dtype):
+                df[col] = pd.to_numeric(series, downcast='integer')
+            elif pd.api.types.is_float_dtype(series.dtype):
+                as_float32 = series.astype(np.float32)
+                if np.array_equal(as_float32.astype(np.float64).values, series.values, equal_nan=True):
+                    df[col] = as_float32
+        after = df.memory_usage(deep=True).sum()
+        logging.info(f"  > Compacted '{table_name}': {before / 2**20:.2f} MB -> {after / 2**20:.2f} MB ({(before - after) / 2**20:.2f} MB saved).")
+        return df
+
+@instrument('transform.shard')
+def transform_shard(db_data: dict, claims_df: pd.DataFrame) -> (dict, pd.DataFrame):
     """
-    Main orchestrator function for the transformation phase logic.
+    The row-level part of the transformation phase: cleaning and dtype compaction. It never looks at
+    another hospital's rows, so it runs inside each hospital shard; surrogate keys are assigned after
+    the shards are merged, since the key registry is shared.
     """
     transformer = DataTransformer()
+    if 'patients' in db_data:
+        db_data['patients'] = transformer.clean_and_enrich_patients(db_data['patients'])
+    claims_df = transformer.clean_and_enrich_claims(claims_df)
+    for name, df in db_data.items():
+        transformer.compact_dtypes(df, name)
+    transformer.compact_dtypes(claims_df, 'claims')
+    return db_data, claims_df
+
+@instrument('transform')
+def run_all_transformations(extracted_db_data: dict, extracted_claims_data: pd.DataFrame, registry_dir=KEY_REGISTRY_DIR) -> (dict, pd.DataFrame):
+    """
+    Main orchestrator function for the transformation phase logic.
+    """
+    transformer = DataTransformer(registry_dir)
     if 'patients' in extracted_db_data:
         extracted_db_data['patients'] = transformer.clean_and_enrich_patients(extracted_db_data['patients'])
     transformed_claims = transformer.clean_and_enrich_claims(extracted_claims_data)
     final_db_data_with_keys = transformer.generate_surrogate_keys(extracted_db_data)
+    logging.info("Compacting column dtypes...")
+    for name, df in final_db_data_with_keys.items():
+        transformer.compact_dtypes(df, name)
+    transformer.compact_dtypes(transformed_claims, 'claims')
     return final_db_data_with_keys, transformed_claims
 
 # --- Step 5: Main Execution Block ---